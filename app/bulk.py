@@ -0,0 +1,176 @@
+from app.deploy.container.orchestrator import orchestrator
+from deploy.metrics import Trace
+from queue import Queue
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+RUNNING, STOPPED = 'Запущен', 'Остановлен'
+
+# Actions in the order of execution: stops free ports and resources of the host before starts take them
+ACTIONS = ('stop', 'restart', 'start')
+# Project status after a successful action
+RESULT_STATUS = {'stop': STOPPED, 'restart': RUNNING, 'start': RUNNING}
+# Project status required by an action
+REQUIRED_STATUS = {'stop': {RUNNING}, 'restart': {RUNNING}, 'start': {STOPPED}}
+# Keys of a bulk item accepted from the client, the other parameters of the actions are set by the server
+ITEM_KEYS = ('id', 'name', 'action', 'repo_url', 'config', 'ext', 'force_rebuild')
+
+
+class BulkItem:
+    """
+    Action on a single project of a bulk operation
+
+    Attributes:
+        index (int): Position of the item in the request
+        key (tuple): Telegram user ID and project name
+        action (str): Action name (start, restart, stop)
+        params (dict): Parameters of the action passed to DjangoManager
+        project_id (int): Project ID
+        state (str): Item state (pending, succeeded, failed or skipped)
+        error (str): Error message of a failed or skipped item
+        timings (dict): Durations of the deployment phases
+    """
+
+    PENDING, SUCCEEDED, FAILED, SKIPPED = 'pending', 'succeeded', 'failed', 'skipped'
+
+    def __init__(self, index, key, action, params):
+        self.index = index
+        self.key = key
+        self.action = action
+        self.params = params
+        self.project_id = None
+        self.state = self.PENDING
+        self.error = None
+        self.timings = None
+
+    def finish(self, state, error=None):
+        self.state = state
+        self.error = error
+        return self
+
+    def to_dict(self):
+        """
+        Convert the item to a dictionary
+
+        :return: Dictionary with the item result
+        """
+        return {
+            'index': self.index,
+            'id': self.key[0],
+            'name': self.key[1],
+            'action': self.action,
+            'state': self.state,
+            'error': self.error,
+            'timings': self.timings,
+        }
+
+
+def plan(items, projects):
+    """
+    Deduplicating and ordering the items of a bulk operation
+
+    Repeated actions on a project are dropped, actions that the project status does not allow
+    (taking the previous actions of the same request into account) are skipped. The actions
+    of a project form a chain executed in the request order, chains are ordered by their first action.
+    The plan and the worker class chosen for a project are passed to its actions.
+
+    :param items: List of BulkItem in the request order
+    :param projects: Dict of (Telegram user ID, project name) -> (project ID, status, deployment options)
+    :return: List of chains (lists of BulkItem) and list of items finished without execution
+    :rtype: tuple
+    """
+    chains = {}
+    finished = []
+    for item in items:
+        if item.action not in ACTIONS:
+            finished.append(item.finish(BulkItem.FAILED, f'Неизвестное действие {item.action}'))
+            continue
+        if item.key not in projects:
+            finished.append(item.finish(BulkItem.FAILED, f'Проект с именем {item.key[1]} не существует'))
+            continue
+
+        item.project_id, status, options = projects[item.key]
+        item.params.update(options)
+        chain = chains.setdefault(item.key, [])
+        if chain:
+            if chain[-1].action == item.action:
+                finished.append(item.finish(BulkItem.SKIPPED, 'Повторное действие'))
+                continue
+            status = RESULT_STATUS[chain[-1].action]
+        if status not in REQUIRED_STATUS[item.action]:
+            finished.append(item.finish(BulkItem.SKIPPED, f'Проект уже {status}'))
+            continue
+        chain.append(item)
+
+    ordered = sorted((chain for chain in chains.values() if chain), key=lambda chain: ACTIONS.index(chain[0].action))
+    return ordered, finished
+
+
+class BulkRunner:
+    """
+    Executing the chains of a bulk operation with bounded parallelism
+
+    The chains run in parallel as tasks of the deployment event loop, the actions of a chain
+    one after another. Chains are run in groups by their first action in the ACTIONS order:
+    the chains starting with a stop are finished before the restarts begin, the restarts before the starts.
+    A failed action cancels the rest of its chain.
+    """
+
+    def __init__(self, actions, workers):
+        """
+        :param actions: Dict of action name -> DjangoManager coroutine method
+        :param workers: Max number of actions running at the same time
+        """
+        self.actions = actions
+        self.workers = workers
+
+    def run(self, chains):
+        """
+        Executing the chains
+
+        :param chains: List of chains (lists of BulkItem)
+        :return: Generator of the finished items in the order of completion
+        """
+        results = Queue()
+        remaining = sum(len(chain) for chain in chains)
+        future = orchestrator.submit(self.run_chains(chains, results))
+        try:
+            for _ in range(remaining):
+                yield results.get()
+        finally:
+            future.result()
+
+    async def run_chains(self, chains, results):
+        semaphore = asyncio.Semaphore(self.workers)
+        for action in ACTIONS:
+            await asyncio.gather(*(self.run_chain(chain, semaphore, results)
+                                   for chain in chains if chain[0].action == action))
+
+    async def run_chain(self, chain, semaphore, results):
+        for position, item in enumerate(chain):
+            async with semaphore:
+                results.put(await self.run_item(item))
+            if item.state != BulkItem.SUCCEEDED:
+                for cancelled in chain[position + 1:]:
+                    results.put(cancelled.finish(BulkItem.SKIPPED, 'Предыдущее действие завершилось с ошибкой'))
+                return
+
+    async def run_item(self, item):
+        """
+        Executing the action of an item
+
+        :param item: BulkItem
+        :return: The finished item
+        """
+        with Trace() as trace:
+            try:
+                result = await self.actions[item.action](**item.params)
+            except Exception as e:
+                logger.exception("%s of %s failed", item.action, item.key[1])
+                result, error = False, str(e)
+            else:
+                error = None if result or item.action == 'stop' else 'Настройки проекта не позволяют запустить проект'
+        item.timings = trace.to_dict()
+        return item.finish(BulkItem.FAILED if error else BulkItem.SUCCEEDED, error)
@@ -21,6 +21,20 @@ class Config:
 
         self.SQLALCHEMY_TRACK_MODIFICATIONS = True
 
+        # Deployment job queue
+        self.JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))  # Max number of deployments running in parallel
+        self.JOB_HISTORY = int(os.environ.get('JOB_HISTORY', 1000))  # Max number of finished jobs kept in memory
+        self.JOB_LOG_LIMIT = int(os.environ.get('JOB_LOG_LIMIT', 500))  # Max number of log lines kept per job
+        self.LOG_STREAM_KEEPALIVE = int(os.environ.get('LOG_STREAM_KEEPALIVE', 15))  # Keep-alive interval of log streams
+
+        # Bulk project operations
+        self.BULK_WORKERS = int(os.environ.get('BULK_WORKERS', 4))  # Max number of actions running in parallel
+        self.BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 1000))  # Max number of actions per request
+
+        # Project list pagination
+        self.PROJECTS_PAGE_SIZE = int(os.environ.get('PROJECTS_PAGE_SIZE', 100))  # Default number of projects per page
+        self.PROJECTS_PAGE_MAX = int(os.environ.get('PROJECTS_PAGE_MAX', 1000))  # Max number of projects per page
+
         # SSL options
         self.SSL_ENABLED = True
         self.SSL_CERTIFICATE = os.environ.get('SSL_CERT_PATH')
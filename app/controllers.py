@@ -1,7 +1,13 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context, url_for
+from app.deploy.container.images import image_warmer
+from app.deploy.settings import DEFAULT_PLAN, DEFAULT_WORKER_CLASS, RESOURCE_PLANS, WORKER_CLASSES
+from bulk import BulkItem, BulkRunner, ITEM_KEYS, RESULT_STATUS, plan
 from deploy.container.manager import DjangoManager
-from app.deploy.container.exceptions import SecurityIssueError
+from deploy.metrics import Trace, registry
 from models import *
+from run import job_queue
+import functools
+import json
 
 # Create a blueprint for the API
 api = Blueprint('api', __name__)
@@ -12,16 +18,35 @@ def get_user_projects(id):
     """
     Retrieving user projects by his Telegram ID
 
+    Projects are returned page by page ordered by name. Query parameters: 'limit' - page size,
+    'after' - cursor returned with the previous page.
+
     :param id: Telegram user ID
-    :return: JSON with user projects or error message
+    :return: JSON with user projects and the cursor of the next page or error message
     """
-    user = User.query.filter_by(tg_id=id).first()
-    if not user:
+    limit = min(request.args.get('limit', current_app.config['PROJECTS_PAGE_SIZE'], type=int),
+                current_app.config['PROJECTS_PAGE_MAX'])
+    page = Project.list_page(id, max(limit, 1), after=request.args.get('after'))
+    if page is None:
         return jsonify({'error': 'User not found'}), 404
 
-    projects = user.get_projects()
-    project_list = [project.to_dict() for project in projects]
-    return jsonify({'projects': project_list}), 200
+    project_list, next_cursor = page
+    return jsonify({'projects': project_list, 'next': next_cursor}), 200
+
+
+@api.route('/<int:id>/projects/<name>/status', methods=['GET'])
+def get_project_status(id, name):
+    """
+    Retrieving the deployment state of a project
+
+    :param id: Telegram user ID
+    :param name: Project name
+    :return: JSON with the project status and the running slot or error message
+    """
+    project = Project.find(id, name)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    return jsonify({'status': project.status, 'deployment': DjangoManager.status(id=id, name=name)}), 200
 
 
 @api.route('/projects/start', methods=['PUT'])
@@ -52,15 +77,252 @@ def stop_project():
     :return: JSON with a message about stopping the project or an error message
     """
     data = request.get_json()
-    project = Project.query.join(User).filter(User.tg_id == data.get('id'),
-                                              Project.name == data.get('name'),
-                                              Project.status == 'Запущен').first()
+    project = Project.find(data.get('id'), data.get('name'), Project.status == 'Запущен')
     if not project:
         return jsonify({'error': 'Проект с указанным именем не существует или он уже остановлен'}), 400
 
-    DjangoManager.stop()
-    project.update(status='Остановлен')
-    return jsonify({'message': 'Проект успешно остановлен!'}), 200
+    job = job_queue.submit('stop', (data.get('id'), data.get('name')),
+                           functools.partial(run_stop, project.id, data.get('id'), data.get('name'),
+                                             data.get('repo_url')))
+    return job_accepted(job)
+
+
+def run_stop(project_id, tg_id, name, repo_url=None):
+    """
+    Stopping the project in a background job
+
+    The status of the project is kept if the project could not be stopped.
+
+    :param project_id: Project ID
+    :param tg_id: Telegram user ID
+    :param name: Project name
+    :param repo_url: URL of the project repository, needed to stop a project without metadata
+    :return: Message about stopping the project
+    """
+    with Trace() as trace:
+        DjangoManager.stop(id=tg_id, name=name, repo_url=repo_url)
+    db.session.get(Project, project_id).update(status='Остановлен', timings=trace.to_dict())
+    return {'message': 'Проект успешно остановлен!', 'timings': trace.to_dict()}
+
+
+@api.route('/projects/plan', methods=['PUT'])
+def change_project_plan():
+    """
+    Changing the resource plan and the gunicorn worker class of the project
+
+    The body contains 'id', 'name' and 'plan' and/or 'worker_class'. A running project is moved
+    to the new resources by a background job without a full redeployment, a stopped project
+    gets them on the next start.
+
+    :return: JSON with the job ID, a message about the saved plan or an error message
+    """
+    data = request.get_json()
+    project = Project.find(data.get('id'), data.get('name'))
+    if not project:
+        return jsonify({'error': f"Проект с именем {data.get('name')} не существует"}), 400
+
+    plan = data.get('plan') or project.plan or DEFAULT_PLAN
+    worker_class = data.get('worker_class') or project.worker_class or DEFAULT_WORKER_CLASS
+    if plan not in RESOURCE_PLANS:
+        return jsonify({'error': f"Неизвестный план {plan}, доступны: {', '.join(RESOURCE_PLANS)}"}), 400
+    if worker_class not in WORKER_CLASSES:
+        return jsonify({'error': f"Неизвестный класс воркеров {worker_class}, "
+                                 f"доступны: {', '.join(WORKER_CLASSES)}"}), 400
+
+    if project.status != 'Запущен':
+        project.update(plan=plan, worker_class=worker_class)
+        return jsonify({'message': 'План сохранён и будет применён при следующем запуске проекта',
+                        'plan': plan, 'worker_class': worker_class}), 200
+
+    job = job_queue.submit('resize', (data.get('id'), data.get('name')),
+                           functools.partial(run_resize, project.id, data.get('id'), data.get('name'),
+                                             plan, worker_class))
+    return job_accepted(job)
+
+
+def run_resize(project_id, tg_id, name, plan, worker_class):
+    """
+    Moving a running project to another plan in a background job
+
+    The plan is saved once the project runs with the new resources.
+
+    :param project_id: Project ID
+    :param tg_id: Telegram user ID
+    :param name: Project name
+    :param plan: Resource plan
+    :param worker_class: Gunicorn worker class
+    :return: Message about the applied plan with the resources of the project
+    :raises RuntimeError: If the project is not running or did not start with the new resources
+    """
+    with Trace() as trace:
+        resources = DjangoManager.resize(id=tg_id, name=name, plan=plan, worker_class=worker_class)
+    project = db.session.get(Project, project_id)
+    project.update(timings=trace.to_dict())
+    if not resources:
+        raise RuntimeError('Не удалось применить план: проект не запущен или не прошёл проверки с новыми ресурсами')
+
+    project.update(plan=plan, worker_class=worker_class)
+    return {'message': 'План проекта изменён!', 'plan': plan, 'worker_class': worker_class,
+            'resources': resources, 'timings': trace.to_dict()}
+
+
+@api.route('/projects/bulk', methods=['POST'])
+def bulk_project_action():
+    """
+    Starting, restarting and stopping many projects at once
+
+    The body contains 'items' - list of {'id', 'name', 'action', 'repo_url', 'config', 'ext', 'force_rebuild'}
+    and optional 'parallelism', items with other keys are rejected. Repeated actions are dropped, actions on the same project run
+    in the request order. The projects whose first action is a stop are stopped before the restarts
+    and starts begin. Statuses of all projects are saved
+    in a single transaction once all actions are finished.
+
+    :return: Stream of per-item results in the NDJSON format, the last line contains the summary
+    """
+    data = request.get_json(silent=True)
+    raw_items = (data.get('items') or []) if isinstance(data, dict) else None
+    if (not isinstance(raw_items, list) or len(raw_items) > current_app.config['BULK_MAX_ITEMS']
+            or not all(isinstance(raw, dict) for raw in raw_items)):
+        return jsonify({'error': f"Передайте список из не более {current_app.config['BULK_MAX_ITEMS']} действий "
+                                 f"в виде объектов"}), 400
+    unknown = sorted({str(key) for raw in raw_items for key in raw if key not in ITEM_KEYS})
+    if unknown:
+        return jsonify({'error': f"Недопустимые параметры действий: {', '.join(unknown)}, "
+                                 f"доступны: {', '.join(ITEM_KEYS)}"}), 400
+    try:
+        parallelism = int(data.get('parallelism') or current_app.config['BULK_WORKERS'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'parallelism должен быть целым числом'}), 400
+
+    items = []
+    for index, raw in enumerate(raw_items):
+        params = {
+            'config': raw.get('config'),
+            'ext': raw.get('ext'),
+            'id': raw.get('id'),
+            'name': raw.get('name'),
+            'repo_url': raw.get('repo_url'),
+            'force_rebuild': bool(raw.get('force_rebuild', False)),
+        }
+        items.append(BulkItem(index, (raw.get('id'), raw.get('name')), raw.get('action'), params))
+    chains, finished = plan(items, Project.find_many(item.key for item in items))
+
+    workers = min(max(parallelism, 1), current_app.config['BULK_WORKERS'])
+    runner = BulkRunner({'start': DjangoManager.start_async, 'restart': DjangoManager.restart_async,
+                         'stop': DjangoManager.stop_async}, workers)
+
+    def generate():
+        summary = {state: 0 for state in (BulkItem.SUCCEEDED, BulkItem.FAILED, BulkItem.SKIPPED)}
+        statuses = {}
+        try:
+            for item in finished:
+                summary[item.state] += 1
+                yield json.dumps(item.to_dict(), ensure_ascii=False) + '\n'
+            for item in runner.run(chains):
+                summary[item.state] += 1
+                if item.state == BulkItem.SUCCEEDED:
+                    statuses[item.project_id] = {'id': item.project_id, 'status': RESULT_STATUS[item.action],
+                                                 'timings': item.timings}
+                yield json.dumps(item.to_dict(), ensure_ascii=False) + '\n'
+        finally:
+            Project.update_many(list(statuses.values()))
+        yield json.dumps({'summary': summary}, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Retrieving the state of a deployment job
+
+    :param job_id: Job ID
+    :return: JSON with job state, phase timings and result or error message
+    """
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict()), 200
+
+
+@api.route('/jobs/<job_id>/logs', methods=['GET'])
+def get_job_logs(job_id):
+    """
+    Retrieving the log of a deployment job
+
+    Query parameter 'offset' is the number of the first line to return.
+
+    :param job_id: Job ID
+    :return: JSON with log lines and the offset for the next request
+    """
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    offset, lines = job.get_logs(request.args.get('offset', 0, type=int))
+    return jsonify({'state': job.state, 'offset': offset, 'next_offset': offset + len(lines), 'logs': lines}), 200
+
+
+@api.route('/jobs/<job_id>/logs/stream', methods=['GET'])
+def stream_job_logs(job_id):
+    """
+    Streaming the log of a deployment job as Server-Sent Events
+
+    Every line is sent as an event with its offset as the event ID. The stream resumes from
+    the 'offset' query parameter or after the 'Last-Event-ID' header, lines dropped from
+    the job log in the meantime are skipped. The stream ends with an 'end' event once the job is finished.
+
+    :param job_id: Job ID
+    :return: Event stream with the job log or error message
+    """
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        offset = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+    keepalive = current_app.config['LOG_STREAM_KEEPALIVE']
+
+    def generate(offset):
+        while True:
+            finished = job.finished
+            start, lines = job.get_logs(offset)
+            if start > offset:
+                yield f': {start - offset} line(s) dropped\n\n'
+            for number, line in enumerate(lines, start):
+                data = ''.join(f'data: {part}\n' for part in line.split('\n'))
+                yield f'id: {number}\n{data}\n'
+            offset = start + len(lines)
+            if finished and not lines:
+                yield f'event: end\ndata: {json.dumps(job.to_dict(), ensure_ascii=False)}\n\n'
+                return
+            if not job.wait_for_logs(offset, keepalive):
+                yield ': keep-alive\n\n'
+
+    return Response(generate(offset), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@api.route('/images', methods=['GET'])
+def get_images():
+    """
+    Readiness of the base image cache
+
+    :return: JSON with the readiness flag and the pinned digest, pull time and pull duration of every base image
+    """
+    return jsonify(image_warmer.status()), 200
+
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Deployment metrics in the Prometheus text format
+
+    :return: Phase durations, KMS request latencies and external command counters
+    """
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
 
 @api.route('/projects', methods=['DELETE'])
@@ -71,8 +333,7 @@ def delete_project():
     :return: JSON with a message about project deletion or an error message
     """
     data = request.get_json()
-    project = Project.query.join(User).filter(User.tg_id == data.get('id'), Project.name == data.get('name'),
-                                              Project.status != 'Остановлен').first()
+    project = Project.find(data.get('id'), data.get('name'), Project.status != 'Остановлен')
     if not project:
         return jsonify({'error': 'Проект с указанным именем не существует или находится в статусе "Запущен"'}), 400
 
@@ -88,17 +349,9 @@ def create_project():
     :return: JSON with information about the created project or an error message
     """
     data = request.get_json()
-    user = User.query.filter_by(tg_id=data.get('id')).first()
-    if not user:
-        user = User(username=data.get('username'), tg_id=data.get('id'))
-        user.save()
-
-    project = Project.query.filter_by(user=user, name=data.get('name')).first()
-    if project:
-        return jsonify({'error': f'Проект с именем {project.name} уже существует'}), 400
-
-    new_project = Project(name=data.get('name'), description=data.get('description'), user=user)
-    new_project.save()
+    new_project = Project.create(data.get('id'), data.get('username'), data.get('name'), data.get('description'))
+    if not new_project:
+        return jsonify({'error': f"Проект с именем {data.get('name')} уже существует"}), 400
 
     return jsonify({'message': new_project.to_dict()}), 201
 
@@ -107,31 +360,64 @@ def handle_project_action(action, status):
     """
     Processing actions on the project (start, restart, stop)
 
+    The action is executed by a background job, the response contains the job ID.
+
     :param action: Action function (start, restart, stop)
     :param status: Expected project status after action
-    :return: JSON with a message about the result of the action or an error message
+    :return: JSON with the job ID or an error message
     """
     data = request.get_json()
-    project = Project.query.join(User).filter(User.tg_id == data.get('id'),
-                                              Project.name == data.get('name'), Project.status != status).first()
+    project = Project.find(data.get('id'), data.get('name'), Project.status != status)
     if not project:
         return jsonify({'error': f"Проект с именем {data.get('name')} не существует или уже {status}"}), 400
 
-    try:
-        project_data = {
-            'config': data.get('config'),
-            'ext': data.get('ext'),
-            'id': data.get('id'),
-            'name': data.get('name'),
-            'repo_url': data.get('repo_url')
-        }
+    project_data = {
+        'config': data.get('config'),
+        'ext': data.get('ext'),
+        'id': data.get('id'),
+        'name': data.get('name'),
+        'repo_url': data.get('repo_url'),
+        'force_rebuild': bool(data.get('force_rebuild', False)),
+        **project.options()
+    }
+    job = job_queue.submit(action.__name__, (data.get('id'), data.get('name')),
+                           functools.partial(run_project_action, action, status, project.id, project_data))
+    return job_accepted(job)
+
+
+def run_project_action(action, status, project_id, project_data):
+    """
+    Executing an action on the project in a background job
+
+    :param action: Action function (start, restart, stop)
+    :param status: Expected project status after action
+    :param project_id: Project ID
+    :param project_data: Parameters of the action
+    :return: Message about the result of the action
+    :raises RuntimeError: If the project could not be launched
+    """
+    project = db.session.get(Project, project_id)
+    if not project or project.status == status:
+        raise RuntimeError(f"Проект с именем {project_data['name']} не существует или уже {status}")
+
+    with Trace() as trace:
         run_status = action(**project_data)
-        if run_status:
-            project.update(status=status)
-            return jsonify({'message': 'Проект успешно запущен!',
-                            'link': f'Ссылка: http://{project.name}.ewdbot.com'}), 200
-        else:
-            return jsonify({'error': 'Настройки проекта не позволяют запустить проект'}), 400
-
-    except (KeyError, ValueError, FileNotFoundError, json.JSONDecodeError, SecurityIssueError) as e:
-        return jsonify({'error': str(e)}), 400
+    project.update(timings=trace.to_dict())
+    if not run_status:
+        raise RuntimeError('Настройки проекта не позволяют запустить проект')
+
+    project.update(status=status)
+    return {'message': 'Проект успешно запущен!',
+            'link': f'Ссылка: http://{project.name}.ewdbot.com',
+            'timings': trace.to_dict()}
+
+
+def job_accepted(job):
+    """
+    Response for a job added to the queue
+
+    :param job: Queued job
+    :return: JSON with the job ID and the link to its state
+    """
+    return jsonify({'job_id': job.id, 'state': job.state,
+                    'status_url': url_for('api.get_job', job_id=job.id)}), 202
@@ -0,0 +1,281 @@
+from app.deploy.settings import (SHARED_BACKENDS, SHARED_BACKEND_HOST, SHARED_MYSQL_HOST, SHARED_MYSQL_PORT,
+                                 SHARED_MYSQL_USER, SHARED_MYSQL_POOL_SIZE, MYSQL_ROOT_PASSWORD, SHARED_REDIS_HOST,
+                                 SHARED_REDIS_PORT, SHARED_REDIS_PASSWORD, SHARED_REDIS_MODE, SHARED_REDIS_DATABASES,
+                                 SHARED_REDIS_STATE_PATH)
+from app.deploy.container.exceptions import SharedBackendError
+from app.deploy.container.ports import PortAllocator
+from app.deploy.container.templates import templates
+import hashlib
+import hmac
+import logging
+import re
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ('db', 'redis')  # Services of docker-compose.yml replaced by the shared backends
+PORTS = ('REDIS_PORT',)  # Host ports of the replaced services
+
+
+def tenant_name(dir_name, limit):
+    """
+    Name of the database objects of a project on a shared backend
+
+    The name is unique per project and fits the length limit of the backend.
+
+    :param dir_name: Project dir name
+    :param limit: Max length of the name
+    """
+    suffix = hashlib.sha256(dir_name.encode()).hexdigest()[:8]
+    return f"{re.sub(r'[^0-9A-Za-z_]', '_', dir_name)[:limit - len(suffix) - 1]}_{suffix}"
+
+
+class SharedMySQL:
+    """
+    Shared MySQL instance, every project gets its own database and user
+
+    The database and the user are created by the init.sql template, the same one that initializes
+    the db container of a project. The admin connections are pooled.
+    """
+
+    def __init__(self, host=SHARED_MYSQL_HOST, port=SHARED_MYSQL_PORT, user=SHARED_MYSQL_USER,
+                 password=MYSQL_ROOT_PASSWORD, pool_size=SHARED_MYSQL_POOL_SIZE):
+        self.options = {'host': host, 'port': port, 'user': user, 'password': password, 'autocommit': True}
+        self.pool_size = pool_size
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """
+        Obtaining a pooled admin connection, waits while all connections are in use
+        """
+        with self._lock:
+            if self._pool is None:
+                from mysql.connector.pooling import MySQLConnectionPool
+                self._pool = MySQLConnectionPool(pool_name='shared_backends', pool_size=self.pool_size,
+                                                 **self.options)
+        return self._pool.get_connection()
+
+    def execute(self, sql):
+        """
+        Executing SQL statements with an admin connection
+
+        :param sql: One or more statements separated by semicolons
+        :raises SharedBackendError: If a statement failed
+        """
+        with self._slots:
+            try:
+                connection = self.connection()
+            except Exception as e:
+                raise SharedBackendError(f'Общий MySQL недоступен: {e}')
+            try:
+                cursor = connection.cursor()
+                for _ in cursor.execute(sql, multi=True):
+                    pass
+                cursor.close()
+            except Exception as e:
+                raise SharedBackendError(f'Ошибка общего MySQL: {e}')
+            finally:
+                connection.close()  # Returns the connection to the pool
+
+    def provision(self, settings):
+        """
+        Creating the database and the user of a project
+
+        :param settings: Project settings with DATABASE_NAME, DATABASE_USER and DATABASE_PASSWORD
+        """
+        self.execute(templates.render('init.sql', settings))
+
+    def release(self, database, user):
+        """
+        Dropping the database and the user of a project
+        """
+        self.execute(templates.render('drop.sql', {'DATABASE_NAME': database, 'DATABASE_USER': user}))
+
+
+class RedisDatabaseAllocator(PortAllocator):
+    """
+    Allocator of the databases of the shared Redis, the database 0 is kept for the admin
+    """
+
+    def __init__(self, path=SHARED_REDIS_STATE_PATH, databases=SHARED_REDIS_DATABASES):
+        super().__init__(path, {'REDIS_DB': 1})
+        self.databases = databases
+
+    @staticmethod
+    def is_taken(port):
+        return False
+
+    def _allocate(self, pool):
+        index = super()._allocate(pool)
+        if index >= self.databases:
+            raise SharedBackendError(f'Все {self.databases} баз данных общего Redis заняты')
+        return index
+
+
+class SharedRedis:
+    """
+    Shared Redis instance
+
+    In the 'db' mode every project gets its own database index, in the 'acl' mode its own ACL user
+    limited to the keys and channels with the project prefix (Redis 6+).
+    """
+
+    def __init__(self, host=SHARED_REDIS_HOST, port=SHARED_REDIS_PORT, password=SHARED_REDIS_PASSWORD,
+                 mode=SHARED_REDIS_MODE, allocator=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.mode = mode
+        self.allocator = allocator or RedisDatabaseAllocator()
+
+    @staticmethod
+    def encode(args):
+        chunks = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = str(arg).encode()
+            chunks.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        return b''.join(chunks)
+
+    @classmethod
+    def reply(cls, file):
+        line = file.readline()
+        if not line:
+            raise SharedBackendError('Общий Redis закрыл соединение')
+        prefix, value = line[:1], line[1:].rstrip(b'\r\n')
+        if prefix == b'-':
+            raise SharedBackendError(f'Ошибка общего Redis: {value.decode()}')
+        if prefix == b':':
+            return int(value)
+        if prefix == b'$':
+            return None if int(value) < 0 else file.read(int(value) + 2)[:-2].decode()
+        if prefix == b'*':
+            return None if int(value) < 0 else [cls.reply(file) for _ in range(int(value))]
+        return value.decode()
+
+    def call(self, *commands):
+        """
+        Executing commands on one admin connection
+
+        :param commands: Commands as tuples of arguments
+        :return: List of the replies
+        :raises SharedBackendError: If Redis is not available or a command failed
+        """
+        if self.password:
+            commands = (('AUTH', self.password), *commands)
+        try:
+            with socket.create_connection((self.host, self.port), timeout=10) as sock:
+                sock.sendall(b''.join(self.encode(command) for command in commands))
+                with sock.makefile('rb') as file:
+                    replies = [self.reply(file) for _ in commands]
+        except OSError as e:
+            raise SharedBackendError(f'Общий Redis недоступен: {e}')
+        return replies[1:] if self.password else replies
+
+    def user_password(self, user):
+        """
+        Password of the ACL user of a project, derived from the admin password so it is stable across deployments
+        """
+        return hmac.new((self.password or '').encode(), user.encode(), hashlib.sha256).hexdigest()
+
+    def provision(self, dir_name):
+        """
+        Creating the database or the ACL user of a project
+
+        :param dir_name: Project dir name
+        :return: Dict of the Redis connection settings of the project
+        """
+        settings = {'REDIS_HOST': SHARED_BACKEND_HOST, 'REDIS_PORT': str(self.port)}
+        if self.mode == 'acl':
+            if not self.password:
+                raise SharedBackendError('Для ACL-пользователей общего Redis задайте SHARED_REDIS_PASSWORD')
+            user = tenant_name(dir_name, 64)
+            password = self.user_password(user)
+            self.call(('ACL', 'SETUSER', user, 'reset', 'on', f'>{password}', f'~{user}:*', f'&{user}:*',
+                       '+@all', '-@admin', '-@dangerous'))
+            settings.update(REDIS_DB='0', REDIS_USERNAME=user, REDIS_PASSWORD=password, REDIS_KEY_PREFIX=user)
+        else:
+            settings.update(self.allocator.reserve(dir_name))
+        return settings
+
+    def release(self, dir_name):
+        """
+        Deleting the data and the database or the ACL user of a project
+        """
+        if self.mode == 'acl':
+            user = tenant_name(dir_name, 64)
+            cursor = '0'
+            while True:
+                cursor, keys = self.call(('SCAN', cursor, 'MATCH', f'{user}:*', 'COUNT', 1000))[0]
+                if keys:
+                    self.call(('UNLINK', *keys))
+                if cursor == '0':
+                    break
+            self.call(('ACL', 'DELUSER', user))
+        else:
+            index = self.allocator.held(dir_name).get('REDIS_DB')
+            if index is None:
+                return  # The project has no database, e.g. it was deployed before the shared mode was enabled
+            self.call(('SELECT', index), ('FLUSHDB',))
+            self.allocator.release(dir_name)
+
+
+class SharedBackends:
+    """
+    Shared MySQL and Redis of all projects
+
+    Replaces the db and redis containers of every project (SERVICES) with a database and a user
+    on the shared MySQL and a database or an ACL user on the shared Redis, so a project
+    runs only its web and Nginx containers.
+    """
+
+    def __init__(self, enabled=SHARED_BACKENDS, mysql=None, redis=None):
+        self.enabled = enabled
+        self.mysql = mysql or SharedMySQL()
+        self.redis = redis or SharedRedis()
+
+    @property
+    def services(self):
+        """
+        Services of docker-compose.yml that are not started for a project
+        """
+        return SERVICES if self.enabled else ()
+
+    @property
+    def ports(self):
+        """
+        Host ports that are not allocated for a project
+        """
+        return PORTS if self.enabled else ()
+
+    def provision(self, dir_name, settings):
+        """
+        Creating the databases of a project, repeated calls keep the existing ones
+
+        :param dir_name: Project dir name
+        :param settings: Project settings with DATABASE_PASSWORD
+        :return: Dict of the connection settings of the project
+        """
+        shared = {
+            'DATABASE_NAME': tenant_name(dir_name, 64),
+            'DATABASE_USER': tenant_name(dir_name, 32),
+            'DB_HOST': SHARED_BACKEND_HOST,
+            'DB_PORT': str(self.mysql.options['port']),
+        }
+        self.mysql.provision(dict(settings, **shared))
+        shared.update(self.redis.provision(dir_name))
+        logger.info("%s: databases created on the shared backends", dir_name)
+        return shared
+
+    def release(self, dir_name):
+        """
+        Dropping the databases of a project
+        """
+        self.mysql.release(tenant_name(dir_name, 64), tenant_name(dir_name, 32))
+        self.redis.release(dir_name)
+        logger.info("%s: databases dropped from the shared backends", dir_name)
+
+
+shared_backends = SharedBackends()
@@ -0,0 +1,136 @@
+from app.deploy.settings import SCAN_CACHE_PATH, SCAN_CACHE_MAX_ENTRIES
+from deploy.metrics import run_command, scan_cache_lookups, scan_cache_evictions
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+@functools.lru_cache(maxsize=None)
+def bandit_version():
+    """
+    Obtaining the version of the installed bandit
+
+    :return: Version string reported by bandit
+    """
+    result = run_command(['bandit', '--version'], capture_output=True, text=True)
+    return result.stdout.splitlines()[0].strip() if result.stdout else 'unknown'
+
+
+def blob_hash(path):
+    """
+    Calculating the git blob SHA of a file
+
+    :param path: Path to the file
+    :return: Hex digest identical to the output of `git hash-object`
+    """
+    with open(path, 'rb') as file:
+        content = file.read()
+    digest = hashlib.sha1(b'blob %d\0' % len(content))
+    digest.update(content)
+    return digest.hexdigest()
+
+
+class ScanCache:
+    """
+    Persistent content-addressed cache of bandit results
+
+    Results are stored per git blob SHA and scan profile (bandit version, severity and confidence levels),
+    so unchanged files are never scanned twice. The least recently used entries are evicted
+    once the cache grows above the configured size.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS scan_results (
+            blob TEXT NOT NULL,
+            profile TEXT NOT NULL,
+            issues TEXT NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (blob, profile)
+        );
+        CREATE INDEX IF NOT EXISTS scan_results_last_used ON scan_results (last_used);
+    """
+    LOOKUP_CHUNK = 500  # Max number of bound parameters in a single lookup query
+
+    def __init__(self, severity, confidence, path=SCAN_CACHE_PATH, max_entries=SCAN_CACHE_MAX_ENTRIES):
+        """
+        :param severity: Severity level used for the scan
+        :param confidence: Confidence level used for the scan
+        :param path: Path to the SQLite database
+        :param max_entries: Max number of stored results
+        """
+        self.profile = f"{bandit_version()}:{severity}:{confidence}"
+        self.path = path
+        self.max_entries = max_entries
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # The scan uses the cache from the threads of the event loop executor, one call at a time
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.executescript(self.SCHEMA)
+        return self._connection
+
+    def close(self):
+        """
+        Closing the database connection
+        """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def lookup(self, blobs):
+        """
+        Obtaining cached results for a set of blobs
+
+        :param blobs: Iterable of blob SHAs
+        :return: Dict of blob SHA -> list of issues for the cached blobs
+        """
+        blobs = list(set(blobs))
+        found = {}
+        for i in range(0, len(blobs), self.LOOKUP_CHUNK):
+            chunk = blobs[i:i + self.LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT blob, issues FROM scan_results WHERE profile = ? AND blob IN ({placeholders})",
+                [self.profile, *chunk])
+            found.update((blob, json.loads(issues)) for blob, issues in rows)
+
+        if found:
+            with self.connection:
+                self.connection.executemany("UPDATE scan_results SET last_used = ? WHERE blob = ? AND profile = ?",
+                                            [(time.time(), blob, self.profile) for blob in found])
+        scan_cache_lookups.inc(len(found), result='hit')
+        scan_cache_lookups.inc(len(blobs) - len(found), result='miss')
+        return found
+
+    def store(self, results):
+        """
+        Saving scan results and evicting the least recently used entries
+
+        :param results: Dict of blob SHA -> list of issues
+        """
+        if not results:
+            return
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO scan_results VALUES (?, ?, ?, ?)",
+                                        [(blob, self.profile, json.dumps(issues), now)
+                                         for blob, issues in results.items()])
+        self.evict()
+
+    def evict(self):
+        """
+        Removing the least recently used entries above the size limit
+        """
+        with self.connection:
+            count = self.connection.execute("SELECT COUNT(*) FROM scan_results").fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                self.connection.execute("DELETE FROM scan_results WHERE rowid IN "
+                                        "(SELECT rowid FROM scan_results ORDER BY last_used LIMIT ?)", (excess,))
+                scan_cache_evictions.inc(excess)
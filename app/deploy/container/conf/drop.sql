@@ -0,0 +1,2 @@
+DROP DATABASE IF EXISTS {DATABASE_NAME};
+DROP USER IF EXISTS '{DATABASE_USER}'@'%';
@@ -5,3 +5,66 @@ class SecurityIssueError(Exception):
     def __init__(self, message):
         self.message = message
         super().__init__(self.message)
+
+
+class NginxConfigError(Exception):
+    # Custom class to handle exceptions
+    # if the generated Nginx configuration is invalid
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class TemplateError(Exception):
+    # Custom class to handle exceptions
+    # if a value cannot be safely rendered into a configuration template
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class StepTimeoutError(Exception):
+    # Custom class to handle exceptions
+    # if a step of the deployment pipeline exceeded its timeout
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class SharedBackendError(Exception):
+    # Custom class to handle exceptions
+    # if a database of a project cannot be created on the shared MySQL or Redis
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class RepositoryError(Exception):
+    # Custom class to handle exceptions
+    # if the repository of a project cannot be cloned or fetched, or a work tree cannot be updated
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ProjectNotDeployedError(Exception):
+    # Custom class to handle exceptions
+    # if a project to stop has neither a handle nor metadata and its repository is unknown
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class DecryptionError(Exception):
+    # Custom class to handle exceptions
+    # if an encrypted configuration file is truncated or has an invalid format
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,184 @@
+from app.deploy.settings import IMAGE_PINS_PATH, IMAGE_WARMUP, IMAGE_WARMUP_INTERVAL, STEP_TIMEOUTS
+from app.deploy.container.orchestrator import orchestrator, run_process, step
+from app.deploy.container.templates import templates
+from deploy.metrics import image_pull_seconds
+from datetime import datetime
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+FROM_LINE = re.compile(r'^(\s*FROM\s+(?:--\S+\s+)*)(\S+)', re.IGNORECASE | re.MULTILINE)
+
+
+def base_images():
+    """
+    Images the projects are based on: images of the services of docker-compose.yml that are not built
+    and the base images of the Dockerfile
+
+    :return: List of image references in the order of the templates
+    """
+    images = []
+    compose = templates.get('docker-compose.yml').data
+    for service in compose['services'].values():
+        if 'build' not in service and service.get('image'):
+            images.append(service['image'])
+    with open(templates.get('Dockerfile').path) as file:
+        images.extend(match.group(2) for match in FROM_LINE.finditer(file.read()))
+    return list(dict.fromkeys(image for image in images if '{' not in image and '$' not in image))
+
+
+class ImageWarmer:
+    """
+    Pre-pulling and pinning of the base images
+
+    The base images are pulled at the API startup and then every IMAGE_WARMUP_INTERVAL seconds,
+    so deployments do not pull them in the critical path. Every pulled image is pinned
+    by its digest: the generated configuration references the digest, so a moving tag
+    (redis:latest) does not change between a warmup and a deployment. The pins are persisted,
+    so other API processes and the next start use the same images.
+    """
+
+    def __init__(self, path=IMAGE_PINS_PATH, interval=IMAGE_WARMUP_INTERVAL):
+        """
+        :param path: Path to the file with the pinned digests
+        :param interval: Interval of the refresh (in seconds)
+        """
+        self.path = path
+        self.interval = interval
+        self.state = {}  # Image -> digest, pull time, duration and error of the last pull
+        self._future = None
+        self.load()
+
+    def load(self):
+        """
+        Loading the persisted pins
+        """
+        try:
+            with open(self.path) as file:
+                pins = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        for image, pin in pins.items():
+            self.state[image] = {'digest': pin['digest'], 'pulled_at': pin.get('pulled_at'), 'duration': None,
+                                 'error': None}
+
+    def save(self):
+        """
+        Persisting the pins atomically
+        """
+        pins = {image: {'digest': state['digest'], 'pulled_at': state['pulled_at']}
+                for image, state in self.state.items() if state['digest']}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as file:
+            json.dump(pins, file)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def pinned(self, image):
+        """
+        Reference of an image pinned by its digest
+
+        :param image: Image reference from a template
+        :return: The reference with the digest, or the reference itself if the image is not pinned yet
+        """
+        state = self.state.get(image)
+        if not state or not state['digest'] or '@' in image:
+            return image
+        return f"{image}@{state['digest']}"
+
+    def is_ready(self, image):
+        """
+        Whether an image was pulled and pinned
+        """
+        state = self.state.get(image)
+        return bool(state and state['digest'])
+
+    def pin_dockerfile(self, content):
+        """
+        Pinning the base images of a rendered Dockerfile
+
+        :param content: Contents of the Dockerfile
+        :return: Contents with the pinned FROM lines
+        """
+        return FROM_LINE.sub(lambda match: match.group(1) + self.pinned(match.group(2)), content)
+
+    async def pull(self, image):
+        """
+        Pulling an image and pinning its digest
+
+        A failed pull keeps the previous pin.
+
+        :param image: Image reference
+        :return: State of the image
+        """
+        state = self.state.setdefault(image, {'digest': None, 'pulled_at': None, 'duration': None, 'error': None})
+        started = time.monotonic()
+        try:
+            result = await step('image.pull', run_process(['docker', 'pull', '--quiet', image], capture_output=True),
+                                STEP_TIMEOUTS['pull'])
+            if result.returncode != 0:
+                raise RuntimeError(result.stdout.strip() or f'docker pull exited with code {result.returncode}')
+            result = await run_process(['docker', 'image', 'inspect', '-f', '{{json .RepoDigests}}', image],
+                                       capture_output=True)
+            digests = json.loads(result.stdout) if result.returncode == 0 else None
+            if not digests:
+                raise RuntimeError(f'Образ {image} не имеет дайджеста')
+        except Exception as e:
+            state['error'] = str(e)
+            logger.warning("image %s: pull failed: %s", image, e)
+            return state
+        finally:
+            state['duration'] = round(time.monotonic() - started, 3)
+            image_pull_seconds.observe(state['duration'], image=image)
+
+        repository = image.rsplit(':', 1)[0] if ':' in image.rsplit('/', 1)[-1] else image
+        digest = next((d for d in digests if d.split('@')[0] == repository), digests[0]).split('@', 1)[1]
+        if digest != state['digest']:
+            logger.info("image %s pinned to %s (pulled in %.1fs)", image, digest, state['duration'])
+        state.update(digest=digest, pulled_at=datetime.utcnow().isoformat(), error=None)
+        return state
+
+    async def warm(self):
+        """
+        Pulling all base images at the same time and persisting the pins
+        """
+        await asyncio.gather(*(self.pull(image) for image in base_images()))
+        self.save()
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.warm()
+            except Exception:
+                logger.exception("image warmup failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """
+        Starting the warmup and its refresh on the deployment event loop, if enabled by IMAGE_WARMUP
+        """
+        if IMAGE_WARMUP and self._future is None:
+            self._future = orchestrator.submit(self.run_forever())
+
+    def stop(self):
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+
+    def status(self):
+        """
+        Readiness of the image cache
+
+        :return: Dict with the readiness flag and the digest, pull time and duration of every base image
+        :rtype: dict
+        """
+        images = [dict(self.state.get(image, {'digest': None, 'pulled_at': None, 'duration': None, 'error': None}),
+                       image=image) for image in base_images()]
+        return {'ready': all(image['digest'] for image in images), 'images': images}
+
+
+image_warmer = ImageWarmer()
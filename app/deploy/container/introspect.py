@@ -0,0 +1,273 @@
+from app.deploy.settings import SETTINGS_CACHE_SIZE
+from collections import OrderedDict
+from pathlib import PurePosixPath
+import ast
+import hashlib
+import os
+import posixpath
+import threading
+
+# Settings extracted from the Django settings module
+INTROSPECTED_SETTINGS = ('STATIC_URL', 'STATIC_ROOT', 'MEDIA_URL', 'MEDIA_ROOT', 'ALLOWED_HOSTS')
+MAX_IMPORT_DEPTH = 5  # Max depth of the star imports followed between settings modules
+
+
+class Unknown(Exception):
+    """
+    Value that cannot be determined without executing the code
+    """
+
+
+def find_module(root, module, package=None, level=0):
+    """
+    Path to the source of a module of the project
+
+    :param root: Project dir
+    :param module: Dotted module name (relative to the package for relative imports)
+    :param package: Dotted name of the package of the importing module
+    :param level: Number of leading dots of a relative import
+    :return: Path to the module file or None if the module is not a part of the project
+    """
+    parts = (module or '').split('.') if module else []
+    if level:
+        base = package.split('.') if package else []
+        if level - 1 > len(base):
+            return None
+        parts = base[:len(base) - (level - 1)] + parts
+    if not parts:
+        return None
+    path = os.path.join(root, *parts)
+    for candidate in (f'{path}.py', os.path.join(path, '__init__.py')):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+class SettingsEvaluator:
+    """
+    Static evaluation of a Django settings module
+
+    The module is never imported: only top-level assignments built from literals, other settings,
+    path operations (os.path, pathlib) and environment lookups with defaults are evaluated.
+    Settings with other values are treated as missing. Paths are resolved relative to the project dir,
+    which is represented by the filesystem root.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: Project dir
+        """
+        self.root = root
+        self.files = {}  # Paths of the evaluated files -> content hashes
+
+    def evaluate(self, path, depth=0):
+        """
+        Evaluating the settings of a module file
+
+        :param path: Path to the module file
+        :return: Dict of setting name -> value
+        """
+        with open(path, 'rb') as file:
+            content = file.read()
+        self.files[path] = hashlib.sha256(content).hexdigest()
+
+        relative = os.path.relpath(path, self.root)
+        package = os.path.dirname(relative).replace(os.sep, '.')
+        namespace = {'__file__': PurePosixPath('/', relative)}
+        for node in ast.parse(content, filename=path).body:
+            self.statement(node, namespace, package, depth)
+        namespace.pop('__file__')
+        return namespace
+
+    def statement(self, node, namespace, package, depth):
+        if isinstance(node, ast.Assign):
+            try:
+                value = self.value(node.value, namespace)
+            except Unknown:
+                value = Unknown
+            for target in node.targets:
+                self.assign(target, value, namespace)
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            try:
+                self.assign(node.target, self.value(node.value, namespace), namespace)
+            except Unknown:
+                self.assign(node.target, Unknown, namespace)
+        elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+            try:
+                namespace[node.target.id] = self.operation(node.op, self.name(node.target.id, namespace),
+                                                           self.value(node.value, namespace))
+            except Unknown:
+                namespace[node.target.id] = Unknown
+        elif isinstance(node, ast.ImportFrom) and any(alias.name == '*' for alias in node.names):
+            module = find_module(self.root, node.module, package, node.level)
+            if module and depth < MAX_IMPORT_DEPTH and module not in self.files:
+                namespace.update(self.evaluate(module, depth + 1))
+        elif isinstance(node, ast.Try):
+            for child in node.body:
+                self.statement(child, namespace, package, depth)
+
+    @staticmethod
+    def assign(target, value, namespace):
+        if isinstance(target, ast.Name):
+            namespace[target.id] = value
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            for element in target.elts:
+                if isinstance(element, ast.Name):
+                    namespace[element.id] = Unknown
+
+    @staticmethod
+    def name(name, namespace):
+        value = namespace.get(name, Unknown)
+        if value is Unknown:
+            raise Unknown(name)
+        return value
+
+    @staticmethod
+    def operation(op, left, right):
+        if isinstance(op, ast.Add) and type(left) == type(right) and isinstance(left, (str, list, tuple)):
+            return left + right
+        if isinstance(op, ast.Div) and isinstance(left, PurePosixPath) and isinstance(right, (str, PurePosixPath)):
+            return left / right
+        raise Unknown(op)
+
+    def value(self, node, namespace):
+        """
+        Value of an expression
+
+        :raises Unknown: If the value cannot be determined statically
+        """
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, (ast.List, ast.Tuple)):
+            values = [self.value(element, namespace) for element in node.elts]
+            return values if isinstance(node, ast.List) else tuple(values)
+        if isinstance(node, ast.Name):
+            return self.name(node.id, namespace)
+        if isinstance(node, ast.JoinedStr):
+            return ''.join(str(self.value(part.value if isinstance(part, ast.FormattedValue) else part, namespace))
+                           for part in node.values)
+        if isinstance(node, ast.BinOp):
+            return self.operation(node.op, self.value(node.left, namespace), self.value(node.right, namespace))
+        if isinstance(node, ast.Attribute):
+            value = self.value(node.value, namespace)
+            if isinstance(value, PurePosixPath) and node.attr in ('parent', 'name'):
+                return getattr(value, node.attr)
+            raise Unknown(node.attr)
+        if isinstance(node, ast.Call):
+            return self.call(node, namespace)
+        raise Unknown(type(node).__name__)
+
+    def call(self, node, namespace):
+        func = ast.unparse(node.func)
+        args = [self.value(arg, namespace) for arg in node.args]
+        kwargs = {keyword.arg: self.value(keyword.value, namespace) for keyword in node.keywords if keyword.arg}
+
+        if func in ('Path', 'pathlib.Path', 'PurePath', 'pathlib.PurePath'):
+            return PurePosixPath(*map(str, args))
+        if func in ('os.path.join', 'join'):
+            return posixpath.join(*map(str, args))
+        if func in ('os.path.dirname', 'dirname'):
+            return posixpath.dirname(str(args[0]))
+        if func in ('os.path.abspath', 'os.path.realpath', 'os.path.normpath', 'abspath', 'realpath'):
+            return posixpath.normpath(str(args[0]))
+        if func in ('os.getenv', 'os.environ.get', 'environ.get', 'getenv'):
+            # Environment of the build is not known here, the default is used
+            default = args[1] if len(args) > 1 else kwargs.get('default', Unknown)
+            if default is Unknown:
+                raise Unknown(func)
+            return default
+        if func == 'str' and len(args) == 1:
+            return str(args[0])
+        if isinstance(node.func, ast.Attribute) and node.func.attr in ('resolve', 'absolute'):
+            value = self.value(node.func.value, namespace)
+            if isinstance(value, PurePosixPath):
+                return PurePosixPath(posixpath.normpath(str(value)))
+        if isinstance(node.func, ast.Attribute) and node.func.attr == 'joinpath':
+            value = self.value(node.func.value, namespace)
+            if isinstance(value, PurePosixPath):
+                return value.joinpath(*map(str, args))
+        raise Unknown(func)
+
+
+class SettingsCache:
+    """
+    In-memory LRU cache of the introspected settings keyed by the content hash of the settings module
+
+    An entry is valid while the content hashes of all files it was evaluated from
+    (the module and its star imports) are unchanged.
+    """
+
+    def __init__(self, size=SETTINGS_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(path, relative):
+        with open(path, 'rb') as file:
+            return hashlib.sha256(relative.encode() + b'\0' + file.read()).hexdigest()
+
+    def get(self, root, path):
+        """
+        Obtaining the settings of a module file
+
+        :param root: Project dir
+        :param path: Path to the settings module file
+        :return: Dict of setting name -> value of the introspected settings
+        """
+        key = self.digest(path, os.path.relpath(path, root))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and self.is_valid(root, entry):
+            self.hits += 1
+            return dict(entry['values'])
+
+        self.misses += 1
+        evaluator = SettingsEvaluator(root)
+        namespace = evaluator.evaluate(path)
+        values = {name: str(value) if isinstance(value, PurePosixPath) else value
+                  for name, value in namespace.items() if name in INTROSPECTED_SETTINGS and value is not Unknown}
+        dependencies = {os.path.relpath(file, root): digest for file, digest in evaluator.files.items() if file != path}
+        with self._lock:
+            self._entries[key] = {'values': values, 'dependencies': dependencies}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return dict(values)
+
+    @staticmethod
+    def is_valid(root, entry):
+        for relative, digest in entry['dependencies'].items():
+            try:
+                with open(os.path.join(root, relative), 'rb') as file:
+                    if hashlib.sha256(file.read()).hexdigest() != digest:
+                        return False
+            except FileNotFoundError:
+                return False
+        return True
+
+
+settings_cache = SettingsCache()
+
+
+def introspect_settings(root, module):
+    """
+    Extracting the settings of a Django project without importing its code
+
+    :param root: Project dir
+    :param module: Dotted name of the settings module (DJANGO_SETTINGS_MODULE)
+    :return: Path to the settings module file and dict of the introspected settings
+    :rtype: tuple
+    :raises ModuleNotFoundError: If the settings module is not found in the project
+    """
+    path = find_module(root, module)
+    if path is None:
+        raise ModuleNotFoundError(f'Модуль с настройками {module} не найден!')
+    try:
+        return path, settings_cache.get(root, path)
+    except SyntaxError as e:
+        raise ModuleNotFoundError(f'Модуль с настройками {module} содержит синтаксическую ошибку: {e}')
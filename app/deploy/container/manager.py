@@ -1,13 +1,21 @@
+from app.deploy.container.orchestrator import gather, orchestrator, step
 from .prepare import DjangoPrepare
+from .registry import registry
+from app.deploy.container.exceptions import ProjectNotDeployedError
+from deploy.settings import GIT_INCREMENTAL_CLONE, STEP_TIMEOUTS
+from deploy.metrics import span
 from deploy.security.parser import Config
 from deploy.security.encrypt import ConfigStorage
+import asyncio
 
 
 class DjangoManager:
     """
     Manager for managing the deployment of Django projects
 
-    This class provides methods for starting, restarting and stopping projects
+    This class provides methods for starting, restarting and stopping projects.
+    Every method has a coroutine counterpart (start_async, ...) running on the deployment event loop,
+    the blocking methods submit it to the loop and wait for the result.
     """
 
     def __init__(self, **kwargs):
@@ -24,53 +32,255 @@ class DjangoManager:
         Starting a new Django project
 
         1. Creates and encrypts the project configuration
-        2. Builds a Docker container
+        2. Builds a Docker container, the images of the other services are pulled at the same time
         3. Launches project services
+        4. Stops the previous version of the app when deploying to another slot
 
-        :param kwargs: Options for project deployment, including 'config', 'ext', 'id', 'name', and 'repo_url'.
+        A failed deployment is not registered: the previous version keeps serving,
+        a failed first deployment releases its containers, ports and databases.
+
+        :param kwargs: Options for project deployment, including 'config', 'ext', 'id', 'name', 'repo_url'
+                       and optional 'force_rebuild', 'slot', 'previous_slot', 'plan' and 'worker_class'.
         :return: True if the project was launched successfully, otherwise False.
         """
-        # Create and encrypt project configuration
-        config = Config.from_content(content=kwargs['config'], extension=kwargs['ext'])
-        vars = config.convert()
+        return orchestrator.run(cls.start_async(**kwargs))
+
+    @classmethod
+    async def start_async(cls, **kwargs):
+        """
+        Starting a new Django project on the deployment event loop, see start
+        """
+        async with registry.lock(registry.key(kwargs['id'], kwargs['name'])):
+            return await cls._start(**kwargs)
+
+    @staticmethod
+    def configure(**kwargs):
+        """
+        Creating, encrypting and decrypting the project configuration
+
+        :return: Decrypted settings
+        """
+        with span('config.convert'):
+            config = Config.from_content(content=kwargs['config'], extension=kwargs['ext'])
+            vars = config.convert()
         conf_storage = ConfigStorage(user_id=kwargs['id'], project_name=kwargs['name'])
-        conf_storage.create_key()
-        conf_storage.encrypt(vars)
+        with span('config.encrypt'):
+            conf_storage.create_key()
+            conf_storage.encrypt(vars)
+        with span('config.decrypt'):
+            return conf_storage.decrypt()
 
-        # Initialize DjangoManager and start deployment
-        cls.manager = cls(repo_url=kwargs['repo_url'], id=kwargs['id'],
-                          subdomain=kwargs['name'], decrypted_settings=conf_storage.decrypt())
-        build_status = cls.manager.prepare.build_container()
-        up_status = cls.manager.prepare.up_services()
+    @classmethod
+    async def _start(cls, **kwargs):
+        key = registry.key(kwargs['id'], kwargs['name'])
 
-        # Check deployment success
-        return not (build_status or up_status)
+        # Create and encrypt project configuration
+        decrypted_settings = await asyncio.to_thread(cls.configure, **kwargs)
+
+        # Prepare the project and start deployment
+        with span('prepare'):
+            try:
+                prepare = await DjangoPrepare.create(repo_url=kwargs['repo_url'], user_id=kwargs['id'],
+                                                     subdomain=kwargs['name'], decrypted_settings=decrypted_settings,
+                                                     slot=kwargs.get('slot', DjangoPrepare.SLOTS[0]),
+                                                     plan=kwargs.get('plan'), worker_class=kwargs.get('worker_class'))
+            except BaseException:
+                if not kwargs.get('previous_slot'):
+                    # Nothing is running yet, the ports and databases are not kept for a failed first deployment
+                    dir_name = DjangoPrepare.project_dir_name(kwargs['repo_url'], kwargs['id'])
+                    await asyncio.to_thread(DjangoPrepare.discard, dir_name)
+                raise
+        return await cls._deploy(key, prepare, force=kwargs.get('force_rebuild', False),
+                                 previous_slot=kwargs.get('previous_slot'))
+
+    @classmethod
+    async def _deploy(cls, key, prepare, force=False, previous_slot=None):
+        try:
+            build_status, _ = await gather(
+                step('build', prepare.build_container(force=force), STEP_TIMEOUTS['build']),
+                step('pull', prepare.pull_images(), STEP_TIMEOUTS['pull']),
+            )
+            up_status = None
+            if build_status == 0:
+                up_status = await step('up', prepare.up_services(), STEP_TIMEOUTS['up'])
+        except BaseException:
+            await cls._rollback(prepare, previous_slot)
+            raise
+
+        # Check deployment success: both docker compose commands exited with code 0
+        if build_status != 0 or up_status != 0:
+            await cls._rollback(prepare, previous_slot)
+            return False
+
+        # Blue/green deployment: the previous version is stopped only once the new one is ready
+        if previous_slot:
+            await prepare.retire_slot(previous_slot)
+        registry.put(key, prepare)
+        return True
+
+    @staticmethod
+    async def _rollback(prepare, previous_slot=None):
+        """
+        Undoing a failed deployment
+
+        With a previous version the app of the new slot is stopped and the previous version keeps serving.
+        A failed first deployment keeps nothing: its containers are removed, its ports and databases
+        on the shared backends are released.
+
+        :param prepare: Prepared project of the failed deployment
+        :param previous_slot: Slot of the running previous version
+        """
+        if previous_slot:
+            await prepare.retire_slot(prepare.slot)
+        else:
+            await step('down', prepare.down_services(), STEP_TIMEOUTS['down'])
+            await asyncio.to_thread(DjangoPrepare.discard, prepare.dir_name)
 
     @classmethod
     def restart(cls, **kwargs):
         """
         Restarting the current Django project
 
-        Stops the current project and then starts it again
+        The new version is started in the free slot next to the running one, the reverse proxy
+        is switched to it once it passes health checks, and only then the previous version is stopped.
+        Without a running app (or without incremental cloning, which keeps the project dir)
+        the project is stopped and started again.
 
         :param kwargs: Parameters for project deployment
         :return: The result of calling the start method
         """
-        cls.stop(**kwargs)
-        return cls.start(**kwargs)
+        return orchestrator.run(cls.restart_async(**kwargs))
+
+    @classmethod
+    async def restart_async(cls, **kwargs):
+        """
+        Restarting the current Django project on the deployment event loop, see restart
+        """
+        key = registry.key(kwargs['id'], kwargs['name'])
+        async with registry.lock(key):
+            dir_name = DjangoPrepare.project_dir_name(kwargs['repo_url'], kwargs['id'])
+            active_slot = await DjangoPrepare.active_slot(dir_name)
+            if active_slot is None or not GIT_INCREMENTAL_CLONE:
+                await cls._stop(key, kwargs['repo_url'], kwargs['id'])
+                return await cls._start(**kwargs)
+            return await cls._start(slot=DjangoPrepare.other_slot(active_slot), previous_slot=active_slot, **kwargs)
+
+    @classmethod
+    def resize(cls, **kwargs):
+        """
+        Moving a running Django project to another plan or worker class
+
+        The deployed sources and image are copied to the free slot and the app is started there with the new resources,
+        without cloning, scanning and (unless the worker class needs other packages) building the project.
+        The reverse proxy is switched to it once it passes health checks, then the previous slot is stopped.
+
+        :param kwargs: Parameters for identifying the project, including 'id' and 'name',
+                       and optional 'plan' and 'worker_class' (the deployed ones are kept by default)
+        :return: Dict of the applied resource settings, or None if the project is not running
+                 or the app with the new resources is not ready
+        """
+        return orchestrator.run(cls.resize_async(**kwargs))
+
+    @classmethod
+    async def resize_async(cls, **kwargs):
+        """
+        Moving a running Django project to another plan on the deployment event loop, see resize
+        """
+        key = registry.key(kwargs['id'], kwargs['name'])
+        async with registry.lock(key):
+            metadata = registry.metadata(key)
+            active_slot = metadata and await DjangoPrepare.active_slot(metadata['dir_name'])
+            if not active_slot:
+                return None
+
+            conf_storage = ConfigStorage(user_id=kwargs['id'], project_name=kwargs['name'])
+            with span('config.decrypt'):
+                decrypted_settings = await asyncio.to_thread(conf_storage.decrypt)
+            if decrypted_settings is None:
+                raise RuntimeError('Не удалось расшифровать настройки проекта')
+            options = {key: kwargs[key] for key in ('plan', 'worker_class') if kwargs.get(key)}
+            active = DjangoPrepare.reattach(metadata)
+            prepare = DjangoPrepare.reattach(dict(metadata, slot=DjangoPrepare.other_slot(active_slot), **options),
+                                             decrypted_settings)
+            await step('setup', prepare.copy_slot(active), STEP_TIMEOUTS['setup'])
+            await step('setup', asyncio.to_thread(prepare.reconfigure), STEP_TIMEOUTS['setup'])
+            if not await cls._deploy(key, prepare, previous_slot=active_slot):
+                return None
+            return prepare.resources
 
     @classmethod
     def stop(cls, **kwargs):
         """
-        Stopping the current Django project
+        Stopping a Django project
 
         1. Stops and deletes Docker containers and images
-        2. Deletes the project
+        2. Removes the reverse proxy site and releases the project ports
+        3. Deletes the project
+
+        A project started by another API process is stopped through a handle rebuilt from its metadata.
+        A project without metadata is stopped by its docker compose project name, derived from 'repo_url'.
+
+        :param kwargs: Parameters for identifying the project, including 'id' and 'name', and optional 'repo_url'
+        :raises ProjectNotDeployedError: If the project has no metadata and 'repo_url' is not passed
+        """
+        orchestrator.run(cls.stop_async(**kwargs))
+
+    @classmethod
+    async def stop_async(cls, **kwargs):
+        """
+        Stopping a Django project on the deployment event loop, see stop
+        """
+        key = registry.key(kwargs['id'], kwargs['name'])
+        async with registry.lock(key):
+            await cls._stop(key, kwargs.get('repo_url'), kwargs['id'])
+
+    @classmethod
+    async def _stop(cls, key, repo_url=None, user_id=None):
+        prepare = cls.attach(key)
+        if prepare:
+            await step('down', prepare.down_services(), STEP_TIMEOUTS['down'])
+            await prepare.delete_image()
+            await prepare.remove_reverse_nginx()
+            prepare.release_ports()
+            await asyncio.to_thread(prepare.release_backends)
+            await prepare.delete()
+        elif repo_url:
+            await DjangoPrepare.stop_project(DjangoPrepare.project_dir_name(repo_url, user_id))
+        else:
+            raise ProjectNotDeployedError(f'Проект {key} не найден среди развёрнутых, '
+                                          f'передайте repo_url, чтобы остановить его контейнеры')
+        registry.remove(key)
+
+    @classmethod
+    def status(cls, **kwargs):
+        """
+        Obtaining the state of a deployed Django project
+
+        :param kwargs: Parameters for identifying the project, including 'id' and 'name'
+        :return: Dict with the project dir, revision and the running slot, or None if the project is not deployed
+        :rtype: dict or None
+        """
+        prepare = cls.attach(registry.key(kwargs['id'], kwargs['name']))
+        if not prepare:
+            return None
+        return {'dir_name': prepare.dir_name, 'revision': prepare.revision,
+                'slot': orchestrator.run(DjangoPrepare.active_slot(prepare.dir_name)),
+                'plan': prepare.plan, 'worker_class': prepare.worker_class, 'resources': prepare.resources}
+
+    @staticmethod
+    def attach(key):
+        """
+        Obtaining the handle of a deployed project
+
+        The live instance is used when the project was deployed by this process, otherwise the handle
+        is rebuilt from the persisted metadata without cloning or preparing the project again.
 
-        :param kwargs: Parameters for identifying the project
+        :param key: Project key
+        :return: DjangoPrepare or None if the project is not deployed
         """
-        if cls.manager:
-            cls.manager.prepare.down_services()
-            cls.manager.prepare.delete_image()
-            cls.manager.prepare.delete()
-            cls.manager.prepare = None
+        prepare = registry.get(key)
+        if prepare is None:
+            metadata = registry.metadata(key)
+            if metadata:
+                prepare = DjangoPrepare.reattach(metadata)
+        return prepare
@@ -0,0 +1,309 @@
+from app.deploy.settings import NGINX_SITES_AVAILABLE, NGINX_SITES_ENABLED, NGINX_RELOAD_WINDOW
+from app.deploy.container.exceptions import NginxConfigError
+from app.deploy.container.orchestrator import orchestrator, run_process
+from collections import deque
+from concurrent.futures import Future
+import asyncio
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class VhostManager:
+    """
+    Manager of the per-project Nginx virtual hosts
+
+    Every project gets its own site file, so adding or removing a project never touches the others.
+    The changes are applied, validated and reloaded by the ReloadScheduler.
+    """
+
+    def __init__(self, available=NGINX_SITES_AVAILABLE, enabled=NGINX_SITES_ENABLED):
+        """
+        :param available: Dir with the site files
+        :param enabled: Dir with the links to the enabled sites
+        """
+        self.available = available
+        self.enabled = enabled
+
+    def path(self, name):
+        """
+        Path to the site file of a project
+        """
+        return os.path.join(self.available, f'{name}.conf')
+
+    def link(self, name):
+        """
+        Path to the link enabling the site of a project
+        """
+        return os.path.join(self.enabled, f'{name}.conf')
+
+    def read(self, name):
+        """
+        Reading the site file of a project
+
+        :return: Site configuration, or None if the site does not exist
+        """
+        if not os.path.exists(self.path(name)):
+            return None
+        with open(self.path(name)) as file:
+            return file.read()
+
+    def write(self, name, content):
+        """
+        Atomic writing and enabling of a site file
+
+        :param name: Site name (the project dir name)
+        :param content: Site configuration
+        :return: Previous configuration of the site, or None if it did not exist
+        """
+        path = self.path(name)
+        previous = self.read(name)
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+
+        if not os.path.lexists(self.link(name)):
+            os.symlink(path, self.link(name))
+        return previous
+
+    def restore(self, name, previous):
+        """
+        Restoring the previous configuration of a site, the site is removed if it did not exist
+        """
+        if previous is None:
+            self.delete(name)
+        else:
+            self.write(name, previous)
+
+    def delete(self, name):
+        """
+        Removing the site file and its link
+        """
+        for path in (self.link(name), self.path(name)):
+            if os.path.lexists(path):
+                os.remove(path)
+
+    @staticmethod
+    async def validate():
+        """
+        Checking the Nginx configuration
+
+        :return: Error output of `nginx -t`, or None if the configuration is valid
+        """
+        result = await run_process(['sudo', 'nginx', '-t'], capture_output=True, separate_stderr=True)
+        return None if result.returncode == 0 else result.stderr
+
+    @staticmethod
+    async def reload():
+        """
+        Graceful reload of Nginx, open connections are finished by the old workers
+
+        :raises NginxConfigError: If Nginx could not be reloaded
+        """
+        result = await run_process(['sudo', 'nginx', '-s', 'reload'], capture_output=True)
+        if result.returncode != 0:
+            raise NginxConfigError(f"Не удалось перезагрузить Nginx:\n{result.stdout}")
+
+
+class VhostChange:
+    """
+    Pending change of a project site
+
+    Attributes:
+        name (str): Site name (the project dir name)
+        content (str): New site configuration, None to remove the site
+        previous (str): Configuration before the change, None if the site did not exist
+        futures (list): Futures of the callers waiting for the change
+    """
+
+    def __init__(self, name, content):
+        self.name = name
+        self.content = content
+        self.previous = None
+        self.futures = []
+        self.submitted_at = time.monotonic()
+
+    def apply(self, manager):
+        """
+        Writing the change to disk, the previous configuration is saved for a rollback
+        """
+        if self.content is None:
+            self.previous = manager.read(self.name)
+            manager.delete(self.name)
+        else:
+            self.previous = manager.write(self.name, self.content)
+
+    def rollback(self, manager):
+        """
+        Restoring the configuration before the change
+        """
+        manager.restore(self.name, self.previous)
+
+
+class ReloadScheduler:
+    """
+    Coalescer of Nginx reloads for concurrent deployments
+
+    Site changes submitted within the window after the first pending change are written together
+    and applied with a single validation and reload. If the validation fails, only the changes
+    of the sites that Nginx reports as invalid are rolled back. Batches are applied one at a time:
+    changes submitted while a batch is validated or reloaded form the next batch.
+
+    Changes can be submitted from any thread, the batches are applied on the deployment event loop
+    and Nginx is validated and reloaded by asyncio subprocesses.
+    """
+
+    def __init__(self, manager=None, window=NGINX_RELOAD_WINDOW, history=100):
+        """
+        :param manager: Manager of the site files
+        :param window: Time to collect changes before the reload (in seconds)
+        :param history: Number of the last batches kept in the statistics
+        """
+        self.manager = manager or VhostManager()
+        self.window = window
+        self.batches = deque(maxlen=history)  # Size and latency of the last batches
+        self._pending = {}
+        self._timer = None  # Future of the scheduled flush
+        self._lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()  # Held for the whole apply, validation and reload of a batch
+
+    def submit(self, name, content=None):
+        """
+        Scheduling a change of a project site
+
+        A later change of the same site in the same batch replaces the earlier one.
+
+        :param name: Site name (the project dir name)
+        :param content: New site configuration, None to remove the site
+        :return: Future resolved with the batch statistics once the change is live
+        :rtype: Future
+        """
+        future = Future()
+        with self._lock:
+            change = self._pending.get(name)
+            if change is None:
+                change = self._pending[name] = VhostChange(name, content)
+            change.content = content
+            change.futures.append(future)
+
+            if self._timer is None:
+                self._timer = orchestrator.submit(self.flush_later())
+        return future
+
+    async def flush_later(self):
+        """
+        Flushing the pending changes once the window is over
+        """
+        await asyncio.sleep(self.window)
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("nginx: applying the site changes failed")  # The callers get the error by their futures
+
+    async def flush(self):
+        """
+        Applying all pending changes with a single validation and reload
+        """
+        async with self._flush_lock:
+            with self._lock:
+                changes, self._pending, self._timer = list(self._pending.values()), {}, None
+            if changes:
+                await self.apply(changes)
+
+    async def apply(self, changes):
+        """
+        Applying a batch of changes, the futures of the changes are resolved with the result
+
+        If writing or reloading fails, the written changes are rolled back.
+
+        :param changes: Changes of the batch
+        """
+        started = time.monotonic()
+        applied = []
+        failed = {}
+        try:
+            for change in changes:
+                change.apply(self.manager)
+                applied.append(change)
+            failed = await self.validate(changes)
+            if len(failed) < len(changes):
+                await self.manager.reload()
+        except BaseException as e:
+            for change in reversed(applied):
+                if change.name not in failed:
+                    change.rollback(self.manager)
+            for change in changes:
+                for future in change.futures:
+                    if not future.done():
+                        future.set_exception(e if isinstance(e, Exception) else NginxConfigError(
+                            'Применение конфигурации Nginx прервано'))
+            raise
+
+        batch = {'size': len(changes), 'failed': len(failed), 'latency': time.monotonic() - started}
+        self.batches.append(batch)
+        logger.info("nginx: applied %d site change(s), %d rolled back, in %.3fs",
+                    batch['size'] - batch['failed'], batch['failed'], batch['latency'])
+
+        for change in changes:
+            for future in change.futures:
+                if change.name in failed:
+                    future.set_exception(NginxConfigError(
+                        f"Некорректная конфигурация Nginx для {change.name}:\n{failed[change.name]}"))
+                else:
+                    future.set_result(dict(batch, wait=time.monotonic() - change.submitted_at))
+
+    async def validate(self, changes):
+        """
+        Validating the written changes, invalid changes are rolled back
+
+        :param changes: Applied changes
+        :return: Dict of site name -> validation error for the rolled back changes
+        """
+        failed = {}
+        remaining = list(changes)
+        while remaining:
+            error = await self.manager.validate()
+            if not error:
+                return failed
+
+            offending = [change for change in remaining
+                         if self.manager.link(change.name) in error or self.manager.path(change.name) in error]
+            if not offending:
+                # The error can not be attributed to a site, the changes are checked one by one
+                return {**failed, **(await self.isolate(remaining))}
+
+            for change in offending:
+                change.rollback(self.manager)
+                failed[change.name] = error
+                remaining.remove(change)
+        return failed
+
+    async def isolate(self, changes):
+        """
+        Checking the changes one by one, invalid ones are rolled back
+
+        :param changes: Applied changes
+        :return: Dict of site name -> validation error for the rolled back changes
+        """
+        for change in changes:
+            change.rollback(self.manager)
+        error = await self.manager.validate()
+        if error:
+            return {change.name: error for change in changes}  # The configuration is invalid without the batch
+
+        failed = {}
+        for change in changes:
+            change.apply(self.manager)
+            error = await self.manager.validate()
+            if error:
+                change.rollback(self.manager)
+                failed[change.name] = error
+        return failed
+
+
+reload_scheduler = ReloadScheduler()
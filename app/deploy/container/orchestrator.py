@@ -0,0 +1,169 @@
+from app.deploy.settings import PROCESS_KILL_TIMEOUT
+from app.deploy.container.exceptions import StepTimeoutError
+from deploy.metrics import OutputLines, observe_command, span
+import asyncio
+import logging
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopThread:
+    """
+    Event loop of the deployment pipeline running in a background thread
+
+    The steps of all deployments are asyncio tasks of this loop, so a deployment waiting
+    for its commands does not occupy a thread. Blocking code submits a coroutine and waits
+    for its result. The context variables of the caller (the current trace and job) are passed
+    on to the submitted coroutine.
+    """
+
+    def __init__(self, name='deploy-loop'):
+        """
+        :param name: Name of the loop thread
+        """
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """
+        The event loop, started with its thread on first use
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name=self.name, daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def submit(self, coro):
+        """
+        Scheduling a coroutine on the loop
+
+        :param coro: Coroutine
+        :return: Future of the coroutine result, cancelling it cancels the coroutine
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """
+        Running a coroutine on the loop and waiting for its result
+
+        :param coro: Coroutine
+        :param timeout: Max wait time (in seconds), the coroutine is cancelled once it is exceeded
+        :return: Result of the coroutine
+        :raises RuntimeError: If called from the loop thread
+        """
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError('Нельзя ожидать шаг развёртывания из потока цикла событий')
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+
+async def terminate(process):
+    """
+    Stopping a command: SIGTERM first, SIGKILL after PROCESS_KILL_TIMEOUT seconds
+    """
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), PROCESS_KILL_TIMEOUT)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def run_process(args, cwd=None, env=None, capture_output=False, separate_stderr=False):
+    """
+    Running an external command as an asyncio subprocess
+
+    stdout and stderr are merged. The output is passed line by line to the output listeners
+    (see add_output_listener), or returned with capture_output. A cancelled command is terminated.
+    The number and the duration of the commands are recorded like in run_command.
+
+    :param args: Command and its arguments
+    :param cwd: Working dir of the command
+    :param env: Environment of the command, the environment of the API process by default
+    :param capture_output: Return the output instead of passing it to the listeners
+    :param separate_stderr: Capture stderr apart from stdout (with capture_output only)
+    :return: Completed process with the exit code and the captured output
+    :rtype: subprocess.CompletedProcess
+    """
+    started = time.monotonic()
+    process = None
+    try:
+        stderr = subprocess.PIPE if capture_output and separate_stderr else subprocess.STDOUT
+        process = await asyncio.create_subprocess_exec(*args, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                                                       stdout=subprocess.PIPE, stderr=stderr)
+        if capture_output:
+            output, errors = await process.communicate()
+            return subprocess.CompletedProcess(args, process.returncode, output.decode(errors='replace'),
+                                               errors.decode(errors='replace') if errors is not None else None)
+
+        output = OutputLines()
+        while True:
+            chunk = await process.stdout.read(65536)
+            output.feed(chunk)
+            if not chunk:
+                break
+        return subprocess.CompletedProcess(args, await process.wait())
+    except asyncio.CancelledError:
+        if process is not None and process.returncode is None:
+            logger.warning("%s cancelled, terminating pid %d", args[0], process.pid)
+            await terminate(process)
+        raise
+    finally:
+        observe_command(args, time.monotonic() - started)
+
+
+async def step(name, awaitable, timeout=None):
+    """
+    Running a step of the deployment pipeline
+
+    The duration of the step is recorded as a span, the step is cancelled once it exceeds its timeout.
+
+    :param name: Step name
+    :param awaitable: Coroutine or future of the step
+    :param timeout: Max duration of the step (in seconds), unlimited by default
+    :return: Result of the step
+    :raises StepTimeoutError: If the step exceeded its timeout
+    """
+    with span(name):
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            raise StepTimeoutError(f'Шаг {name} не завершился за {timeout} с')
+
+
+async def gather(*awaitables):
+    """
+    Running independent steps at the same time
+
+    If a step fails, the other steps are cancelled and the error is raised.
+
+    :param awaitables: Coroutines or futures of the steps
+    :return: List of the step results
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+orchestrator = EventLoopThread()
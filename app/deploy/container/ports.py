@@ -0,0 +1,117 @@
+from app.deploy.settings import PORTS_STATE_PATH, PORT_RANGES
+from contextlib import contextmanager
+import fcntl
+import heapq
+import json
+import os
+import socket
+
+
+class PortAllocator:
+    """
+    Allocator of the host ports used by the deployed projects
+
+    Allocations are kept in a JSON file shared by all API processes and guarded by a file lock,
+    so concurrent deployments never receive the same port. Released ports are kept in a min-heap
+    free list and reused first, new ports are taken from the high-water mark of each range.
+    Ports found busy on the host are returned to the free list, so they are not lost from the range.
+    """
+
+    def __init__(self, path=PORTS_STATE_PATH, ranges=None):
+        """
+        :param path: Path to the allocation table
+        :param ranges: Dict of port name -> first port of the range
+        """
+        self.path = path
+        self.ranges = ranges or PORT_RANGES
+
+    @contextmanager
+    def _table(self):
+        """
+        Locking and loading the allocation table, the table is saved on exit
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                table = {'pools': {}, 'owners': {}}
+                if os.path.exists(self.path):
+                    with open(self.path) as file:
+                        table = json.load(file)
+                for name, start in self.ranges.items():
+                    table['pools'].setdefault(name, {'next': start, 'free': []})
+
+                yield table
+
+                tmp_path = f'{self.path}.tmp'
+                with open(tmp_path, 'w') as file:
+                    json.dump(table, file)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def is_taken(port):
+        """
+        Checking whether a port is used by a process on the host
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.settimeout(0.2)
+            return sock.connect_ex(('127.0.0.1', port)) == 0
+
+    def _allocate(self, pool):
+        skipped = []  # Ports busy at the moment (e.g. in TIME_WAIT), checked again by the next allocation
+        try:
+            while True:
+                if pool['free']:
+                    port = heapq.heappop(pool['free'])
+                else:
+                    port = pool['next']
+                    pool['next'] += 1
+                if not self.is_taken(port):
+                    return port
+                skipped.append(port)
+        finally:
+            for port in skipped:
+                heapq.heappush(pool['free'], port)
+
+    def reserve(self, owner, names=None):
+        """
+        Reserving a port of every range for an owner
+
+        Repeated calls return the ports already held by the owner.
+
+        :param owner: Owner of the ports (the project dir name)
+        :param names: Names of the ranges, all ranges by default
+        :return: Dict of port name -> port
+        :rtype: dict
+        """
+        names = names or list(self.ranges)
+        with self._table() as table:
+            ports = table['owners'].setdefault(owner, {})
+            for name in names:
+                if name not in ports:
+                    ports[name] = self._allocate(table['pools'][name])
+        return {name: str(ports[name]) for name in names}
+
+    def held(self, owner):
+        """
+        Obtaining the ports held by an owner without reserving new ones
+
+        :param owner: Owner of the ports (the project dir name)
+        :return: Dict of port name -> port, empty if the owner holds no ports
+        :rtype: dict
+        """
+        with self._table() as table:
+            return {name: str(port) for name, port in table['owners'].get(owner, {}).items()}
+
+    def release(self, owner):
+        """
+        Releasing all ports held by an owner
+
+        :param owner: Owner of the ports (the project dir name)
+        """
+        with self._table() as table:
+            for name, port in table['owners'].pop(owner, {}).items():
+                if name in table['pools']:
+                    heapq.heappush(table['pools'][name]['free'], port)
@@ -1,15 +1,35 @@
-from app.deploy.settings import PROJECT_DIR, SSL_PATH, TEMPLATE_CONF_DIR, SSL_CERT_PATH, SSL_KEY_PATH
+from app.deploy.settings import (PROJECT_DIR, SSL_PATH, SSL_CERT_PATH, SSL_KEY_PATH,
+                                 SCAN_SEVERITY_LEVEL, SCAN_CONFIDENCE_LEVEL, GIT_INCREMENTAL_CLONE,
+                                 DOCKER_BUILD_CACHE, BUILD_STATE_DIR, SERVICE_READY_TIMEOUT, PORT_RANGES,
+                                 PROJECT_PORTS, SLOT_PORTS, SLOT_STOP_TIMEOUT, PULLED_SERVICES, STEP_TIMEOUTS,
+                                 DEFAULT_PLAN)
 from dotenv import dotenv_values
-from git import Repo
-from app.deploy.container.exceptions import SecurityIssueError
-import importlib
+from app.deploy.container.backends import shared_backends
+from app.deploy.container.exceptions import RepositoryError, SecurityIssueError, SharedBackendError
+from app.deploy.container.images import image_warmer
+from app.deploy.container.introspect import introspect_settings
+from app.deploy.container.cache import ScanCache
+from app.deploy.container.nginx import reload_scheduler
+from app.deploy.container.orchestrator import orchestrator, run_process, step
+from app.deploy.container.ports import PortAllocator
+from app.deploy.container.resources import RESOURCE_SETTINGS, size
+from app.deploy.container.repository import GitMirror, clone
+from app.deploy.container.scanner import SecurityScanner
+from app.deploy.container.templates import templates, write_files
+from deploy.metrics import span
+import asyncio
+import hashlib
 import io
+import json
+import logging
 import os
 import re
 import stat
-import subprocess
+import time
 import yaml
 
+logger = logging.getLogger(__name__)
+
 
 class ProjectPreparerMeta(type):
     """
@@ -29,49 +49,197 @@ class ProjectPreparerMeta(type):
 class ProjectPrepare(metaclass=ProjectPreparerMeta):
     """
     A class for preparing a project for deployment
+
+    Every slot has its own work tree in the project dir, so the next version of the app is checked out
+    and built next to the running one. The data of the services is kept in the project dir.
     """
     PROJECT_TEMPLATE = "{repo_name}_{user_id}"
+    SLOTS = ('blue', 'green')  # Slots of the app for blue/green deployment
 
-    def __init__(self, repo_url: str, subdomain: str, user_id: int, decrypted_settings: str):
+    def __init__(self, repo_url: str, subdomain: str, user_id: int, decrypted_settings: str, slot: str = SLOTS[0]):
+        if slot not in self.SLOTS:
+            raise ValueError(f"Неизвестный слот {slot}, доступны: {', '.join(self.SLOTS)}")
         self.repo_url = repo_url  # URL repository
         self.subdomain = subdomain  # The project subdomain
         self.user_id = str(user_id)  # User ID
         self.__decrypted_settings = decrypted_settings  # Decrypted settings
+        self.slot = slot  # Slot of the app
 
         self.dir_name = None  # Project dir name
-        self.abs_path = None  # Absolute path to the project
+        self.abs_path = None  # Absolute path to the work tree of the slot
+        self.revision = None  # Hash of the checked out repository tree
 
     def __prepare_project__(self):
         """
         The main method for preparing a project
+
+        The preparation pipeline runs on the deployment event loop, the calling thread waits for it.
+        """
+        orchestrator.run(self.prepare_project())
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        """
+        Creating and preparing a project without blocking the event loop
+
+        The same as calling the class, but the preparation pipeline is awaited by the calling task.
+
+        :return: Prepared project
+        """
+        instance = cls.__new__(cls)
+        instance.__init__(*args, **kwargs)
+        await instance.prepare_project()
+        return instance
+
+    async def prepare_project(self, *steps):
+        """
+        Preparation pipeline
+
+        The project is cloned and checked, then scanned. The scan is the longest step,
+        so the steps of subclasses that do not depend on its result run at the same time.
+        When a step fails, the slot port is released and the work tree of an insecure project is deleted
+        (the project ports of a failed first deployment are released by the caller, see discard).
+        The work tree and the files of the other slot are never touched.
+
+        :param steps: Coroutines of the steps running alongside the scan
         """
         self.generate_project_dir()
-        self.clone()
+        if not GIT_INCREMENTAL_CLONE:
+            await self.delete_work_tree()
+        await step('clone', self.clone(), STEP_TIMEOUTS['clone'])
         self.check_dependencies()
-        self.scan()
+
+        results = await asyncio.gather(step('scan', self.scan(), STEP_TIMEOUTS['scan']), *steps,
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            PortAllocator().release(self.slot_name(self.dir_name, self.slot))
+            if any(isinstance(error, SecurityIssueError) for error in errors):
+                await self.delete_work_tree()
+                raise next(error for error in errors if isinstance(error, SecurityIssueError))
+            raise errors[0]
 
     def generate_project_dir(self):
         """
         Generating the name of the project dir
         """
-        repo_name = re.search(r"/([^/]+).git$", self.repo_url).group(1)
-        self.dir_name = self.PROJECT_TEMPLATE.format(repo_name=repo_name, user_id=self.user_id)
+        self.dir_name = self.project_dir_name(self.repo_url, self.user_id)
+
+    @classmethod
+    def project_dir_name(cls, repo_url, user_id):
+        """
+        Name of the project dir for a repository and a user
+        """
+        repo_name = re.search(r"/([^/]+).git$", repo_url).group(1)
+        return cls.PROJECT_TEMPLATE.format(repo_name=repo_name, user_id=user_id)
+
+    @staticmethod
+    def compose_project(dir_name):
+        """
+        Name of the docker compose project of a project dir
+        """
+        return re.sub(r'[^a-z0-9_-]', '', dir_name.lower())
+
+    @property
+    def project_path(self):
+        """
+        Absolute path to the project dir with the work trees of the slots
+        """
+        return os.path.join(PROJECT_DIR, self.dir_name)
+
+    @staticmethod
+    def slot_path(dir_name, slot):
+        """
+        Absolute path to the work tree of a slot
+        """
+        return os.path.join(PROJECT_DIR, dir_name, slot)
+
+    def metadata(self):
+        """
+        Metadata identifying the deployed project, persisted by the project registry
+
+        :return: Dict with the project metadata
+        """
+        return {
+            'repo_url': self.repo_url,
+            'subdomain': self.subdomain,
+            'user_id': self.user_id,
+            'slot': self.slot,
+            'dir_name': self.dir_name,
+            'abs_path': self.abs_path,
+            'revision': self.revision,
+        }
+
+    @classmethod
+    def reattach(cls, metadata, decrypted_settings=''):
+        """
+        Building the handle of a deployed project from its persisted metadata
+
+        The metaclass preparation is bypassed: the project is not cloned, scanned or set up again,
+        so the handle is cheap enough for stop and status calls.
+
+        :param metadata: Metadata saved by the project registry
+        :param decrypted_settings: Decrypted settings, only needed to build or start the project again
+        :return: Handle of the project
+        """
+        instance = cls.__new__(cls)
+        instance.__init__(metadata['repo_url'], metadata['subdomain'], metadata['user_id'], decrypted_settings,
+                          metadata['slot'])
+        instance.restore(metadata)
+        return instance
+
+    def restore(self, metadata):
+        """
+        Restoring the state of a prepared project from its metadata
+        """
+        self.dir_name = metadata['dir_name']
+        self.abs_path = metadata['abs_path']
+        self.revision = metadata.get('revision')
+
+    @classmethod
+    def other_slot(cls, slot):
+        """
+        The slot to deploy the next version of the app to
+        """
+        return cls.SLOTS[(cls.SLOTS.index(slot) + 1) % len(cls.SLOTS)]
+
+    @staticmethod
+    def slot_name(dir_name, slot):
+        """
+        Name of the app in a slot, used for its container and ports
+        """
+        return f"{dir_name}-web-{slot}"
+
+    async def clone(self):
+        """
+        Cloning a git repository into the work tree of the slot
+
+        In incremental mode only new objects are fetched into the project mirror
+        and the existing work tree is updated in place, otherwise the work tree
+        must be deleted before. git runs as an asyncio subprocess.
+        """
+        self.abs_path = self.slot_path(self.dir_name, self.slot)
+        if GIT_INCREMENTAL_CLONE:
+            mirror = GitMirror(self.repo_url, self.dir_name)
+            self.revision = await mirror.sync()
+            await mirror.checkout(self.abs_path)
+        else:
+            self.revision = await clone(self.repo_url, self.abs_path)
 
-    def clone(self):
+    async def delete(self):
         """
-        Cloning a git repository
+        Deleting an existing project dir with the work trees of all slots
         """
-        self.abs_path = os.path.join(PROJECT_DIR, self.dir_name)
-        self.delete()
-        Repo.clone_from(self.repo_url, self.abs_path)
+        if os.path.exists(self.project_path):
+            await run_process(["sudo", "rm", "-rf", self.project_path])
 
-    def delete(self):
+    async def delete_work_tree(self):
         """
-        Deleting an existing project dir
+        Deleting the work tree of the slot
         """
+        self.abs_path = self.abs_path or self.slot_path(self.dir_name, self.slot)
         if os.path.exists(self.abs_path):
-            command = ["sudo", "rm", "-rf", self.abs_path]
-            subprocess.run(command)
+            await run_process(["sudo", "rm", "-rf", self.abs_path])
 
     # @staticmethod
     # def onerror(func, path, exc_info):
@@ -81,6 +249,7 @@ class ProjectPrepare(metaclass=ProjectPreparerMeta):
     #     os.chmod(path, stat.S_IWRITE)
     #     func(path)
 
+    @span('check_dependencies')
     def check_dependencies(self):
         """
         Checking for a dependency file
@@ -89,29 +258,24 @@ class ProjectPrepare(metaclass=ProjectPreparerMeta):
         if not os.path.exists(requirements_file):
             raise FileNotFoundError("requirements.txt file not found.")
 
-    def scan(self):
+    async def scan(self):
         """
         Scanning a project for vulnerabilities
-        """
-        files_to_scan = []
-
-        for root, dirs, files in os.walk(self.abs_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                files_to_scan.append(file_path)
-
-        issues_found = False
 
-        for file_path in files_to_scan:
-            command = f"bandit -r {file_path} --severity-level medium --confidence-level high"
-            result = subprocess.run(command, shell=True, capture_output=True, text=True)
+        bandit runs as asyncio subprocesses, they are terminated when the scan is cancelled.
 
-            if result.returncode != 0:
-                issues_found = True
+        :return: Aggregated scan report
+        :raises SecurityIssueError: If bandit found blocking issues
+        """
+        cache = await asyncio.to_thread(ScanCache, severity=SCAN_SEVERITY_LEVEL, confidence=SCAN_CONFIDENCE_LEVEL)
+        try:
+            report = await SecurityScanner(cache=cache).scan(self.abs_path)
+        finally:
+            cache.close()
 
-            if issues_found:
-                self.delete()
-                raise SecurityIssueError(f"В проекте обнаружены ошибки безопасности \n{result.stdout}")
+        if report.blocking:
+            raise SecurityIssueError(f"В проекте обнаружены ошибки безопасности \n{report}")
+        return report
 
     def settings_to_dict(self):
         """
@@ -122,24 +286,87 @@ class ProjectPrepare(metaclass=ProjectPreparerMeta):
     def get_app_ports(self):
         """
         Obtaining free ports for an app.
+
+        The app port belongs to the slot, so two versions of the app can run side by side.
         """
-        port_scripts = [
-            'get_free_app_port.sh',
-            'get_free_nginx_port.sh',
-            'get_free_redis_port.sh'
-        ]
+        allocator = PortAllocator()
+        ports = allocator.reserve(self.dir_name, names=[name for name in PROJECT_PORTS
+                                                        if name not in shared_backends.ports])
+        ports.update(allocator.reserve(self.slot_name(self.dir_name, self.slot), names=SLOT_PORTS))
+        return ports
+
+    def release_ports(self):
+        """
+        Releasing the ports of an app.
+        """
+        self.release_project_ports(self.dir_name)
 
-        port_keys = ['APP_PORT', 'NGINX_PORT', 'REDIS_PORT']
-        ports = {}
+    @classmethod
+    def release_project_ports(cls, dir_name):
+        """
+        Releasing the ports of the project and of all its slots
 
-        for script, key in zip(port_scripts, port_keys):
+        :param dir_name: Project dir name
+        """
+        allocator = PortAllocator()
+        allocator.release(dir_name)
+        for slot in cls.SLOTS:
+            allocator.release(cls.slot_name(dir_name, slot))
+
+    @classmethod
+    async def down_project(cls, dir_name):
+        """
+        Stopping and removing the containers of all slots and services of a project
+
+        The containers are found by the docker compose project name, so no compose file is needed.
+
+        :param dir_name: Project dir name
+        :return: Exit code of docker compose
+        """
+        result = await run_process(['docker', 'compose', '-p', cls.compose_project(dir_name), 'down',
+                                    '--remove-orphans'])
+        return result.returncode
+
+    @classmethod
+    async def stop_project(cls, dir_name):
+        """
+        Stopping a project known only by its dir name, e.g. when its metadata is lost
+
+        The containers are found by the docker compose project name. The reverse proxy site, the ports,
+        the databases on the shared backends and the project dir are removed like in a regular stop.
+
+        :param dir_name: Project dir name
+        """
+        await step('down', cls.down_project(dir_name), STEP_TIMEOUTS['down'])
+        await asyncio.wrap_future(reload_scheduler.submit(dir_name))
+        await asyncio.to_thread(cls.discard, dir_name)
+        abs_path = os.path.join(PROJECT_DIR, dir_name)
+        if os.path.exists(abs_path):
+            await run_process(["sudo", "rm", "-rf", abs_path])
+
+    @classmethod
+    def discard(cls, dir_name):
+        """
+        Releasing the ports and the databases on the shared backends of a project that is not running,
+        e.g. the ones reserved by a first deployment that failed to prepare
+
+        Must not be called while a previous version of the project is running.
+
+        :param dir_name: Project dir name
+        """
+        cls.release_project_ports(dir_name)
+        if shared_backends.enabled:
             try:
-                result = subprocess.check_output(['bash', '-c', f'source {TEMPLATE_CONF_DIR}{script} && echo $PORT'])
-                ports[key] = result.decode('utf-8').strip()
-            except subprocess.CalledProcessError as e:
-                raise RuntimeError(f"Failed to get port from {script}: {e.output}")
+                shared_backends.release(dir_name)
+            except SharedBackendError:
+                logger.exception("%s: dropping the databases of the failed deployment failed", dir_name)
 
-        return ports
+    def release_backends(self):
+        """
+        Dropping the databases of the project from the shared backends, if enabled
+        """
+        if shared_backends.enabled:
+            shared_backends.release(self.dir_name)
 
 
 class DjangoPrepare(ProjectPrepare):
@@ -147,9 +374,22 @@ class DjangoPrepare(ProjectPrepare):
     A class for preparing a Django project for deployment.
     """
 
-    def __init__(self, repo_url, subdomain, user_id, decrypted_settings):
-        super().__init__(repo_url, subdomain, user_id, decrypted_settings)
-        self.settings_module = ''
+    # Generated settings that are persisted with the project metadata
+    PUBLIC_SETTINGS = ('SETTINGS_MODULE', 'SUBDOMAIN', 'DIR_NAME', 'SSL_PATH', 'SSL_CERT_PATH', 'SSL_KEY_PATH',
+                       'STATIC_URL', 'STATIC_ROOT', 'MEDIA_URL', 'MEDIA_ROOT', 'GUNICORN_EXTRAS', *RESOURCE_SETTINGS,
+                       *PORT_RANGES)
+
+    def __init__(self, repo_url, subdomain, user_id, decrypted_settings, slot=ProjectPrepare.SLOTS[0], plan=None,
+                 worker_class=None):
+        super().__init__(repo_url, subdomain, user_id, decrypted_settings, slot)
+        self.plan = plan  # Resource plan, DEFAULT_PLAN if not chosen
+        self.worker_class = worker_class  # Gunicorn worker class, DEFAULT_WORKER_CLASS if not chosen
+        self.settings_file = None  # Path to the Django settings module
+        self.django_settings = {}  # Settings introspected from the Django settings module
+        self.image = None  # Name of the web service image
+        self.time_to_ready = None  # Time from the services start until they pass health checks
+        self.ready = False  # Whether the services passed health checks
+        self.switch_latency = None  # Time of switching the reverse proxy to the app
         self.__settings_dict = None
 
     def __prepare_project__(self):
@@ -157,30 +397,73 @@ class DjangoPrepare(ProjectPrepare):
         Basic method for preparing a Django project
         """
         super().__prepare_project__()
-        self.setup()
+
+    async def prepare_project(self, *steps):
+        """
+        Preparation pipeline of a Django project
+
+        The ports are allocated and the configuration is rendered while the project is scanned.
+        """
+        await super().prepare_project(step('setup', asyncio.to_thread(self.setup), STEP_TIMEOUTS['setup']), *steps)
 
     def setup(self):
         """
         Project setup
+
+        The configuration files are rendered from the compiled templates and written in one pass:
+        the Dockerfile into the work tree of the slot, the compose file of the slot and init.sql
+        into the project dir.
         """
         self.extend_settings()
-        self.setup_dockerfile()
-        self.setup_sql()
-        self.setup_reverse_nginx()
-        self.setup_compose()
+        with span('render'):
+            files = {
+                os.path.join(self.work_tree, 'Dockerfile'): self.render_dockerfile(),
+                'init.sql': self.render_sql(),
+                self.compose_file: self.render_compose(),
+            }
+        write_files(self.project_path, files)
+        self.setup_dockerignore()
         self.set_host()
 
-    def __check_settings_module(self, module: str):
+    def reconfigure(self):
+        """
+        Rendering the configuration of a deployed project again for its current slot
+
+        The project is not cloned or scanned again and only the compose file of the slot is rendered,
+        so the web image is rebuilt only when the build args change (e.g. gevent workers need the gevent package).
+        Used to move a running project to another plan, after the slot is prepared with copy_slot.
         """
-        Checking the presence of the settings module
+        self.extend_settings()
+        with span('render'):
+            files = {self.compose_file: self.render_compose()}
+        write_files(self.project_path, files)
+
+    async def copy_slot(self, source):
         """
+        Preparing the slot from the work tree and the web image of the running slot
+
+        The work tree is copied and the image is tagged for the slot together with its build fingerprint,
+        so the deployed sources are started in the slot without cloning and building them again.
+
+        :param source: Handle of the running slot
+        :raises RepositoryError: If the work tree cannot be copied
+        """
+        self.abs_path = self.slot_path(self.dir_name, self.slot)
+        self.image = self.slot_image(self.dir_name, self.slot)
+        await self.delete_work_tree()
+        result = await run_process(["sudo", "cp", "-a", source.abs_path, self.abs_path], capture_output=True)
+        if result.returncode != 0:
+            raise RepositoryError(f'Не удалось скопировать рабочую копию {source.abs_path}: {result.stdout.strip()}')
+
+        result = await run_process(['docker', 'tag', source.image, self.image], capture_output=True)
         try:
-            prev_dir = os.getcwd()
-            os.chdir(self.abs_path)
-            self.settings_module = importlib.import_module(module)
-            os.chdir(prev_dir)
-        except ModuleNotFoundError:
-            raise ModuleNotFoundError(f'Модуль с настройками {module} не найден!')
+            with open(source.build_state_file()) as file:
+                state = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if result.returncode == 0 and state.get('image') == source.image:
+            with open(self.build_state_file(), 'w') as file:
+                json.dump(dict(state, image=self.image), file)
 
     def extend_settings(self):
         """
@@ -189,7 +472,7 @@ class DjangoPrepare(ProjectPrepare):
         self.__settings_dict = self.settings_to_dict()
 
         django_settings_module = self.__settings_dict.get('DJANGO_SETTINGS_MODULE')
-        self.__check_settings_module(django_settings_module)
+        self.settings_file, self.django_settings = introspect_settings(self.abs_path, django_settings_module)
 
         required_settings = {
             'MYSQL_ROOT_PASSWORD': self.__settings_dict['DATABASE_PASSWORD'],
@@ -199,115 +482,400 @@ class DjangoPrepare(ProjectPrepare):
             'SSL_PATH': SSL_PATH,
             'SSL_CERT_PATH': SSL_CERT_PATH,
             'SSL_KEY_PATH': SSL_KEY_PATH,
-            'STATIC_URL': getattr(self.settings_module, 'STATIC_URL', '/static/'),
-            'STATIC_ROOT': os.path.basename(getattr(self.settings_module, 'STATIC_ROOT', self.abs_path + '/static/')),
-            'MEDIA_URL': getattr(self.settings_module, 'MEDIA_URL', '/media/'),
-            'MEDIA_ROOT': os.path.basename(getattr(self.settings_module, 'MEDIA_ROOT', self.abs_path + '/media/')),
+            'STATIC_URL': self.django_settings.get('STATIC_URL', '/static/'),
+            'STATIC_ROOT': os.path.basename(self.django_settings.get('STATIC_ROOT', self.abs_path + '/static/')),
+            'MEDIA_URL': self.django_settings.get('MEDIA_URL', '/media/'),
+            'MEDIA_ROOT': os.path.basename(self.django_settings.get('MEDIA_ROOT', self.abs_path + '/media/')),
         }
         self.__settings_dict.update(required_settings)
+        if shared_backends.enabled:
+            # The database and Redis of the project are created on the shared backends
+            del self.__settings_dict['MYSQL_ROOT_PASSWORD']
+            self.__settings_dict.update(shared_backends.provision(self.dir_name, self.__settings_dict))
         self.__settings_dict.update(self.get_app_ports())
+        self.__settings_dict.update(self.size_resources())
+
+    def size_resources(self):
+        """
+        Sizing the web container and gunicorn from the plan of the project and the host resources
+
+        :return: Dict of the resource settings
+        """
+        resources = size(self.plan, self.worker_class)
+        logger.info("%s: %s plan, %s %s worker(s) with %s thread(s), %s CPU, %s of memory", self.dir_name,
+                    self.plan or DEFAULT_PLAN, resources['GUNICORN_WORKERS'], resources['GUNICORN_WORKER_CLASS'],
+                    resources['GUNICORN_THREADS'], resources['CPUS'], resources['MEM_LIMIT'])
+        return resources
 
     def set_host(self):
         """
         Setting the host in Django settings
         """
-        with open(self.settings_module.__file__, 'r') as f:
-            content = f.read()
+        with open(self.settings_file, 'r') as f:
+            original = f.read()
 
         content = re.sub(pattern=r'(ALLOWED_HOSTS\s*=\s*\[).*?(\])',
                          repl=rf'\1"{self.subdomain}.ewdbot.com"\2',
-                         string=content, flags=re.DOTALL)
+                         string=original, flags=re.DOTALL)
         content = re.sub(pattern=r'(CSRF_TRUSTED_ORIGINS\s*=\s*\[).*?(\])',
                          repl=rf'\1"https://{self.subdomain}.ewdbot.com"\2',
                          string=content, flags=re.DOTALL)
 
-        with open(self.settings_module.__file__, 'w') as file:
-            file.write(content)
+        if content != original:
+            # The file is replaced atomically, the project may be scanned at the same time
+            write_files(os.path.dirname(self.settings_file), {os.path.basename(self.settings_file): content})
 
     def update_env(self):
         """
         Update environment variables
+
+        :return: Environment of the docker compose commands and the build args
+        :rtype: tuple
         """
-        env_args = " ".join([f"{key}={value}" for key, value in self.__settings_dict.items()])
-        build_args = " ".join([f"--build-arg {key}={value}" for key, value in self.__settings_dict.items()])
-        return env_args, build_args
+        settings = {key: '' if value is None else str(value) for key, value in self.__settings_dict.items()}
+        env = dict(os.environ, **settings)
+        build_args = [arg for key, value in settings.items() for arg in ('--build-arg', f'{key}={value}')]
+        return env, build_args
 
-    def setup_compose(self):
+    async def compose(self, *args, env=None):
         """
-        Setting up docker-compose.yml file
+        Running a docker compose command with the compose file of the slot, its output is streamed to the deployment log
+
+        The compose files of all slots belong to the same docker compose project, so the slots share
+        the db and redis services.
+
+        :param args: Arguments of docker compose
+        :param env: Environment of the command
+        :return: Exit code of docker compose
         """
-        with open(f'{TEMPLATE_CONF_DIR}docker-compose.yml', 'r') as file:
-            compose_data = yaml.safe_load(file)
-        compose_data['services']['web']['build']['args'].extend([f"{key}=${{{key}}}" for key in self.__settings_dict])
-        compose_data['services']['web']['environment'].update({key: f"${{{key}}}" for key in self.__settings_dict})
-        compose_data['services']['web']['volumes'] = [f'.:/{self.dir_name}']
+        result = await run_process(['docker', 'compose', '-p', self.compose_project(self.dir_name),
+                                    '-f', self.compose_file, *args],
+                                   cwd=self.project_path, env=env or self.update_env()[0])
+        return result.returncode
 
-        with open(os.path.join(self.abs_path, 'docker-compose.yml'), 'w') as file:
-            yaml.dump(compose_data, file, indent=2)
+    @property
+    def compose_file(self):
+        """
+        Name of the compose file of the slot in the project dir
+        """
+        return f"docker-compose.{self.slot}.yml"
 
-    def setup_dockerfile(self):
+    @property
+    def work_tree(self):
         """
-        Dockerfile setup
+        Path to the work tree of the slot relative to the project dir
         """
-        with open(f"{TEMPLATE_CONF_DIR}Dockerfile") as file:
-            content = file.read()
+        return os.path.relpath(self.abs_path, self.project_path)
 
-        with open(os.path.join(self.abs_path, 'Dockerfile'), 'w') as file:
-            file.write(content.format(DIR_NAME=self.__settings_dict['DIR_NAME']))
+    @classmethod
+    def slot_image(cls, dir_name, slot):
+        """
+        Name of the web image of a slot
+        """
+        return cls.slot_name(dir_name, slot).lower()
 
-    def setup_sql(self):
+    def render_compose(self):
         """
-        Setting up the init.sql file
+        Rendering the compose file of the slot
+
+        The images of the services reference the digests pinned by the image warmer.
+        In the shared backend mode the db and redis services are replaced by the shared backends.
+        The web service is built from the work tree of the slot into the image of the slot,
+        the volumes of the other services are kept in the project dir.
+
+        :return: Contents of the file
         """
-        with open(f"{TEMPLATE_CONF_DIR}init.sql") as file:
-            content = file.read()
+        compose_data = templates.render('docker-compose.yml')
+        for service in compose_data['services'].values():
+            if 'image' in service and 'build' not in service:
+                service['image'] = image_warmer.pinned(service['image'])
+        web = compose_data['services'].pop('web')
+        if shared_backends.enabled:
+            for name in shared_backends.services:
+                compose_data['services'].pop(name, None)
+            web.pop('depends_on', None)
+            web['build']['args'] = [arg for arg in web['build']['args'] if not arg.startswith('DB_HOST=')]
+            web['environment'].pop('DB_HOST', None)
+            web['extra_hosts'] = ['host.docker.internal:host-gateway']
+        web['build']['args'].extend([f"{key}=${{{key}}}" for key in self.__settings_dict])
+        web['environment'].update({key: f"${{{key}}}" for key in self.__settings_dict})
+        web['build']['context'] = f'./{self.work_tree}'
+        web['volumes'] = [f'./{self.work_tree}:/{self.dir_name}']
+        web['image'] = self.image = self.slot_image(self.dir_name, self.slot)
+        web['container_name'] = self.slot_name(self.dir_name, self.slot)
+        compose_data['services'][self.web_service] = web
+        return yaml.dump(compose_data, indent=2)
 
-        with open(os.path.join(self.abs_path, 'init.sql'), 'w') as file:
-            file.write(content.format(**self.__settings_dict))
+    def render_dockerfile(self):
+        """
+        Rendering the Dockerfile
+
+        The base image references the digest pinned by the image warmer, so the build fingerprint
+        changes when a new base image is pulled.
+
+        :return: Contents of the file
+        """
+        content = templates.render('Dockerfile', {'DIR_NAME': self.__settings_dict['DIR_NAME']})
+        return image_warmer.pin_dockerfile(content)
+
+    def render_sql(self):
+        """
+        Rendering the init.sql file
+
+        :return: Contents of the file
+        """
+        return templates.render('init.sql', self.__settings_dict)
+
+    def setup_dockerignore(self):
+        """
+        Keeping volumes and git metadata out of the build context so they do not invalidate the layer cache
+        """
+        dockerignore = os.path.join(self.abs_path, '.dockerignore')
+        if not os.path.exists(dockerignore):
+            write_files(self.abs_path, {'.dockerignore': '.git\ndata/db\ndata/redis\n'})
 
     def setup_nginx_container(self):
         """
         Setting up configuration for Nginx container
         """
-        with open(f"{TEMPLATE_CONF_DIR}nginx.conf") as file:
-            content = file.read()
+        write_files(self.abs_path, {os.path.join('config', 'nginx.conf'): templates.render('nginx.conf',
+                                                                                         self.__settings_dict)})
 
-        config_dir = os.path.join(self.abs_path, 'config')
-        os.makedirs(config_dir, exist_ok=True)
+    @property
+    def resources(self):
+        """
+        Resource settings of the web container and gunicorn of the deployment
+        """
+        return {key: value for key, value in (self.__settings_dict or {}).items() if key in RESOURCE_SETTINGS}
 
-        with open(os.path.join(config_dir, 'nginx.conf'), 'w') as file:
-            file.write(content.format(**self.__settings_dict))
+    @property
+    def web_service(self):
+        """
+        Name of the web service of the slot in docker-compose.yml
+        """
+        return f"web-{self.slot}"
 
-    def setup_reverse_nginx(self):
+    async def setup_reverse_nginx(self):
         """
         Setting up a reverse proxy for Nginx
+
+        The project has its own site file, applied together with the changes of other projects
+        by a single validated graceful reload. Returns once the site is live.
+
+        :return: Statistics of the reload batch
+        :rtype: dict
+        """
+        content = templates.render('reverse_nginx', self.__settings_dict)
+        return await asyncio.wrap_future(reload_scheduler.submit(self.dir_name, content))
+
+    async def remove_reverse_nginx(self):
         """
-        with open(f"{TEMPLATE_CONF_DIR}reverse_nginx") as file:
-            content = file.read()
+        Removing the reverse proxy site of the project
+        """
+        await asyncio.wrap_future(reload_scheduler.submit(self.dir_name))
 
-        with open('/etc/nginx/sites-available/default', 'a') as file:
-            file.write(content.format(**self.__settings_dict))
+    async def switch_proxy(self):
+        """
+        Pointing the reverse proxy to the app of the current slot
 
-    def build_container(self):
+        Nginx is reloaded gracefully: connections to the previous slot are finished by the old workers.
+        The switch time is saved in switch_latency.
+        """
+        started = time.monotonic()
+        batch = await step('proxy', self.setup_reverse_nginx(), STEP_TIMEOUTS['proxy'])
+        self.switch_latency = time.monotonic() - started
+        logger.info("%s: proxy switched to the %s slot in %.3fs (reload batch of %d site(s) took %.3fs)",
+                    self.dir_name, self.slot, self.switch_latency, batch['size'], batch['latency'])
+
+    @classmethod
+    async def active_slot(cls, dir_name):
+        """
+        Obtaining the slot of the running app
+
+        The containers of all slots are inspected at the same time.
+
+        :param dir_name: Project dir name
+        :return: Slot of the running web container, or None if the app is not running
+        """
+        results = await asyncio.gather(*(
+            run_process(['docker', 'inspect', '-f', '{{.State.Running}}', cls.slot_name(dir_name, slot)],
+                        capture_output=True)
+            for slot in cls.SLOTS))
+        for slot, result in zip(cls.SLOTS, results):
+            if result.returncode == 0 and result.stdout.strip() == 'true':
+                return slot
+        return None
+
+    async def retire_slot(self, slot):
+        """
+        Gracefully stopping the app of a slot and releasing its port
+
+        The work tree, the compose file and the image of the slot are kept.
+
+        :param slot: Slot of the app to stop
+        """
+        name = self.slot_name(self.dir_name, slot)
+        await run_process(['docker', 'stop', '-t', str(SLOT_STOP_TIMEOUT), name], capture_output=True)
+        await run_process(['docker', 'rm', '-f', name], capture_output=True)
+        PortAllocator().release(name)
+
+    def build_fingerprint(self):
+        """
+        Calculating the hash of everything the web image is built from:
+        the repository tree, the rendered Dockerfile and the build args
+        """
+        digest = hashlib.sha256((self.revision or '').encode())
+        with open(os.path.join(self.abs_path, 'Dockerfile'), 'rb') as file:
+            digest.update(file.read())
+        for key, value in sorted(self.__settings_dict.items()):
+            if key in PORT_RANGES or key in RESOURCE_SETTINGS:
+                continue  # Ports and resources are chosen per deployment and do not change the image
+            digest.update(f'\0{key}={value}'.encode())
+        return digest.hexdigest()
+
+    def build_state_file(self, slot=None):
+        """
+        Path to the file with the fingerprint of the last successful build of the image of a slot
+
+        :param slot: Slot of the image, the current slot by default
+        """
+        return os.path.join(BUILD_STATE_DIR, f'{self.slot_name(self.dir_name, slot or self.slot)}.json')
+
+    async def is_image_up_to_date(self, fingerprint):
+        """
+        Checking whether the existing image was built from the same sources
+        """
+        try:
+            with open(self.build_state_file()) as file:
+                state = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        if state.get('fingerprint') != fingerprint or state.get('image') != self.image:
+            return False
+        result = await run_process(['docker', 'image', 'inspect', self.image], capture_output=True)
+        return result.returncode == 0
+
+    async def build_container(self, force=False):
         """
         Building a Docker container
+
+        The layer cache is kept unless DOCKER_BUILD_CACHE is disabled or a rebuild is forced,
+        the build is skipped when the image was already built from the same sources.
+
+        The build output is streamed to the deployment log.
+
+        :param force: Rebuild the image from scratch
+        :return: Exit code of the build, 0 if the build was skipped
+        """
+        fingerprint = self.build_fingerprint()
+        use_cache = DOCKER_BUILD_CACHE and not force
+        if use_cache and await self.is_image_up_to_date(fingerprint):
+            logger.info("%s: image %s is up to date, build skipped", self.dir_name, self.image)
+            return 0
+
+        env, build_args = self.update_env()
+        env.update(DOCKER_BUILDKIT='1', COMPOSE_DOCKER_CLI_BUILD='1')
+        returncode = await self.compose('build', *build_args, *([] if use_cache else ['--no-cache']), env=env)
+
+        if returncode == 0:
+            os.makedirs(BUILD_STATE_DIR, exist_ok=True)
+            with open(self.build_state_file(), 'w') as file:
+                json.dump({'fingerprint': fingerprint, 'image': self.image}, file)
+        else:
+            logger.error("%s: build failed with exit code %d", self.dir_name, returncode)
+        return returncode
+
+    async def pull_images(self):
+        """
+        Pulling the images of the services that are not built (PULLED_SERVICES)
+
+        Runs alongside the build of the web image, so the services start without waiting for the pull.
+        Images already pulled and pinned by the image warmer are skipped.
+        A failed pull is not fatal: the images are pulled again when the services are started.
+
+        :return: Exit code of docker compose
         """
-        env_args, build_args = self.update_env()
-        command = env_args + ' docker compose build ' + build_args + ' --no-cache'
-        subprocess.run(command, cwd=self.abs_path, shell=True)
+        services = templates.get('docker-compose.yml').data['services']
+        pulled = [name for name in PULLED_SERVICES if name not in shared_backends.services
+                  and not image_warmer.is_ready(services.get(name, {}).get('image'))]
+        if not pulled:
+            return 0
+        returncode = await self.compose('pull', '--quiet', *pulled)
+        if returncode != 0:
+            logger.warning("%s: pulling images of %s failed with exit code %d",
+                           self.dir_name, ', '.join(pulled), returncode)
+        return returncode
 
-    def up_services(self):
+    async def delete_image(self, force=False):
+        """
+        Deleting the web service images of all slots
+
+        In the layer cache mode the images are kept for the next start unless the deletion is forced.
+
+        :param force: Delete the images regardless of the build mode
+        """
+        if DOCKER_BUILD_CACHE and not force:
+            return
+        images = [self.slot_image(self.dir_name, slot) for slot in self.SLOTS]
+        if self.image and self.image not in images:
+            images.append(self.image)  # Image of a project deployed before the slots had their own images
+        await run_process(['docker', 'image', 'rm', '-f', *images], capture_output=True)
+        for slot in self.SLOTS:
+            if os.path.exists(self.build_state_file(slot)):
+                os.remove(self.build_state_file(slot))
+
+    async def up_services(self):
         """
         Running Docker services
+
+        Starts the web service of the current slot with its dependencies and waits until they pass
+        their health checks (at most SERVICE_READY_TIMEOUT seconds), the measured time is saved
+        in time_to_ready. The reverse proxy is switched to the slot once it is ready.
+        The output of docker compose is streamed to the deployment log.
+
+        :return: Exit code of docker compose
+        """
+        started = time.monotonic()
+        returncode = await self.compose('up', '-d', '--wait', '--wait-timeout', str(SERVICE_READY_TIMEOUT),
+                                        self.web_service)
+        self.time_to_ready = time.monotonic() - started
+        self.ready = returncode == 0
+
+        if self.ready:
+            logger.info("%s: services are ready in %.1fs", self.dir_name, self.time_to_ready)
+            await self.switch_proxy()
+        else:
+            logger.warning("%s: services are not ready after %.1fs (exit code %d)",
+                           self.dir_name, self.time_to_ready, returncode)
+        return returncode
+
+    def metadata(self):
         """
-        env_args, _ = self.update_env()
-        command = env_args + ' docker compose up -d'
-        subprocess.run(command, cwd=self.abs_path, shell=True)
-        subprocess.run(['sudo', 'service', 'nginx', 'restart'])
+        Metadata identifying the deployed project, persisted by the project registry
+
+        Only the settings generated for the deployment are saved, the settings of the user
+        (passwords, secret keys) stay encrypted in the configuration storage.
 
-    def down_services(self):
+        :return: Dict with the project metadata
         """
-        Stopping Docker services
+        settings = {key: value for key, value in (self.__settings_dict or {}).items() if key in self.PUBLIC_SETTINGS}
+        return dict(super().metadata(), image=self.image, plan=self.plan, worker_class=self.worker_class,
+                    settings=settings)
+
+    def restore(self, metadata):
+        """
+        Restoring the state of a prepared Django project from its metadata
+        """
+        super().restore(metadata)
+        self.image = metadata.get('image')
+        self.plan = metadata.get('plan')
+        self.worker_class = metadata.get('worker_class')
+        self.__settings_dict = dict(metadata.get('settings', {}), **self.settings_to_dict())
+
+    async def down_services(self):
+        """
+        Stopping Docker services of all slots
+
+        :return: Exit code of docker compose
         """
-        env_args, _ = self.update_env()
-        subprocess.run(env_args + ' docker compose down', cwd=self.abs_path, shell=True)
+        return await self.down_project(self.dir_name)
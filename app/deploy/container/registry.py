@@ -0,0 +1,112 @@
+from app.deploy.settings import PROJECT_REGISTRY_DIR, PROJECT_LOCK_DIR
+from contextlib import asynccontextmanager
+import asyncio
+import fcntl
+import json
+import os
+import re
+
+LOCK_POLL_INTERVAL = 0.1  # Interval of the lock file checks while another process holds the lock (in seconds)
+
+
+class ProjectRegistry:
+    """
+    Project-keyed registry of the deployed projects
+
+    Live DjangoPrepare instances are kept in memory, their metadata (project dir, slot, image, ...)
+    is persisted as one JSON file per project, so a project started by a previous API process
+    can still be found and stopped. Operations on a project are serialized by a per-project lock
+    held across the tasks of the deployment event loop and across processes, operations
+    on different projects run in parallel.
+    """
+
+    def __init__(self, path=PROJECT_REGISTRY_DIR, lock_dir=PROJECT_LOCK_DIR):
+        """
+        :param path: Dir with the metadata files
+        :param lock_dir: Dir with the lock files
+        """
+        self.path = path
+        self.lock_dir = lock_dir
+        self._instances = {}
+        self._locks = {}
+
+    @staticmethod
+    def key(user_id, name):
+        """
+        Key of a project
+
+        :param user_id: Telegram user ID
+        :param name: Project name
+        """
+        return re.sub(r'[^\w.-]', '_', f'{user_id}-{name}')
+
+    @asynccontextmanager
+    async def lock(self, key):
+        """
+        Locking a project
+
+        Must be used on the deployment event loop. A task waiting for the lock is suspended,
+        the lock file of another process is polled without blocking the loop.
+        """
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            os.makedirs(self.lock_dir, exist_ok=True)
+            with open(os.path.join(self.lock_dir, f'{key}.lock'), 'w') as lock_file:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        await asyncio.sleep(LOCK_POLL_INTERVAL)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def metadata_file(self, key):
+        return os.path.join(self.path, f'{key}.json')
+
+    def get(self, key):
+        """
+        Obtaining the live instance of a project
+
+        :return: DjangoPrepare or None if the project was not deployed by this process
+        """
+        return self._instances.get(key)
+
+    def metadata(self, key):
+        """
+        Obtaining the persisted metadata of a project
+
+        :return: Dict with the project metadata or None if the project is not registered
+        :rtype: dict or None
+        """
+        try:
+            with open(self.metadata_file(key)) as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, key, instance):
+        """
+        Registering the live instance of a project and persisting its metadata
+
+        :param key: Project key
+        :param instance: DjangoPrepare of the deployed project
+        """
+        self._instances[key] = instance
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f'{self.metadata_file(key)}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(instance.metadata(), file)
+        os.replace(tmp_path, self.metadata_file(key))
+
+    def remove(self, key):
+        """
+        Removing a project from the registry
+        """
+        self._instances.pop(key, None)
+        if os.path.exists(self.metadata_file(key)):
+            os.remove(self.metadata_file(key))
+
+
+registry = ProjectRegistry()
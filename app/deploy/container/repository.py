@@ -0,0 +1,105 @@
+from app.deploy.settings import GIT_MIRROR_DIR
+from app.deploy.container.exceptions import RepositoryError
+from app.deploy.container.orchestrator import run_process
+import os
+
+
+async def git(*args, capture_output=False, env=None):
+    """
+    Running a git command as an asyncio subprocess
+
+    :param args: Arguments of git
+    :param capture_output: Return the output instead of passing it to the deployment log
+    :param env: Environment of the command, the environment of the API process by default
+    :return: Completed process
+    """
+    return await run_process(['git', *args], capture_output=capture_output, env=env)
+
+
+async def tree_hash(git_dir):
+    """
+    Hash of the tree checked out at HEAD of a repository
+
+    :param git_dir: Path to the git dir of the repository
+    :raises RepositoryError: If the repository has no HEAD
+    """
+    result = await git(f'--git-dir={git_dir}', 'rev-parse', 'HEAD^{tree}', capture_output=True)
+    if result.returncode != 0:
+        raise RepositoryError(f'Не удалось определить ревизию репозитория: {result.stdout.strip()}')
+    return result.stdout.strip()
+
+
+class GitMirror:
+    """
+    Local bare mirror of a project repository
+
+    The mirror is cloned once and then only fetches new objects, so redeploys do not
+    download the whole repository again. The work trees of the slots of the project are checked out
+    from the mirror, every work tree has its own index.
+    """
+
+    # Shallow and blobless clone, falls back to a full clone for servers without support
+    CLONE_OPTIONS = ('--depth=1', '--filter=blob:none')
+
+    def __init__(self, repo_url: str, name: str, mirror_dir: str = GIT_MIRROR_DIR):
+        """
+        :param repo_url: URL of the repository
+        :param name: Unique name of the mirror (the project dir name)
+        :param mirror_dir: Dir where the mirrors are kept
+        """
+        self.repo_url = repo_url
+        self.path = os.path.join(mirror_dir, f'{name}.git')
+
+    async def sync(self):
+        """
+        Cloning the mirror or fetching new objects into the existing one
+
+        :return: Hash of the tree at HEAD of the mirror
+        :raises RepositoryError: If the repository cannot be cloned or fetched
+        """
+        if os.path.isdir(self.path):
+            await git(f'--git-dir={self.path}', 'remote', 'set-url', 'origin', self.repo_url, capture_output=True)
+            result = await git(f'--git-dir={self.path}', 'fetch', 'origin', '--prune', '--depth=1')
+            if result.returncode != 0:
+                result = await git(f'--git-dir={self.path}', 'fetch', 'origin', '--prune')
+            if result.returncode != 0:
+                raise RepositoryError(f'Не удалось получить изменения репозитория {self.repo_url}')
+        else:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            await clone(self.repo_url, self.path, '--mirror')
+        return await tree_hash(self.path)
+
+    async def checkout(self, work_tree: str):
+        """
+        Updating a work tree to the current HEAD of the mirror
+
+        Tracked files are overwritten and files removed upstream are deleted, untracked files are kept.
+
+        :param work_tree: Path to the work tree of a slot
+        :raises RepositoryError: If the work tree cannot be updated
+        """
+        os.makedirs(work_tree, exist_ok=True)
+        # A shared index would make git compare a work tree with the files of the other one
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(self.path, f'index.{os.path.basename(work_tree)}'))
+        result = await git(f'--git-dir={self.path}', f'--work-tree={work_tree}', 'reset', '--hard', '--quiet', 'HEAD',
+                           env=env)
+        if result.returncode != 0:
+            raise RepositoryError(f'Не удалось обновить рабочую копию {work_tree}')
+
+
+async def clone(repo_url: str, path: str, *options):
+    """
+    Shallow and blobless cloning of a repository
+
+    :param repo_url: URL of the repository
+    :param path: Target path
+    :param options: Additional git clone options
+    :return: Hash of the tree at HEAD of the cloned repository
+    :raises RepositoryError: If the repository cannot be cloned
+    """
+    result = await git('clone', '--quiet', *GitMirror.CLONE_OPTIONS, *options, repo_url, path)
+    if result.returncode != 0:
+        result = await git('clone', '--quiet', *options, repo_url, path)
+    if result.returncode != 0:
+        raise RepositoryError(f'Не удалось клонировать репозиторий {repo_url}')
+    return await tree_hash(path if '--mirror' in options else os.path.join(path, '.git'))
@@ -0,0 +1,73 @@
+from app.deploy.settings import (RESOURCE_PLANS, DEFAULT_PLAN, WORKER_CLASSES, DEFAULT_WORKER_CLASS, WORKER_MEMORY,
+                                 WORKER_CONNECTIONS)
+import math
+import os
+
+# Settings of the web container and gunicorn, applied by recreating the container without a rebuild
+RESOURCE_SETTINGS = ('GUNICORN_WORKERS', 'GUNICORN_THREADS', 'GUNICORN_WORKER_CLASS', 'GUNICORN_WORKER_CONNECTIONS',
+                     'CPUS', 'MEM_LIMIT')
+WORKER_EXTRAS = {'gevent': '[gevent]'}  # Extras of the gunicorn package needed by a worker class
+
+
+def host_resources():
+    """
+    Obtaining the CPU cores and the available memory of the host
+
+    :return: Number of cores and available memory (in MB)
+    :rtype: tuple
+    """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return cores, int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return cores, os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') // 2 ** 20
+
+
+def size(plan=None, worker_class=None):
+    """
+    Sizing the web container and gunicorn of a project
+
+    The limits of the plan are capped by the cores and the available memory of the host.
+    Sync workers follow the gunicorn recommendation of 2 x cores + 1 workers, a gthread worker
+    serves several requests with its threads and a gevent worker serves WORKER_CONNECTIONS clients,
+    so they need one worker per core. Every worker takes WORKER_MEMORY MB, the number of workers
+    is capped by the memory limit.
+
+    :param plan: Name of the plan from RESOURCE_PLANS, DEFAULT_PLAN by default
+    :param worker_class: Gunicorn worker class from WORKER_CLASSES, DEFAULT_WORKER_CLASS by default
+    :return: Dict of RESOURCE_SETTINGS and GUNICORN_EXTRAS (extras of the gunicorn package)
+    :raises ValueError: If the plan or the worker class is unknown
+    """
+    plan = plan or DEFAULT_PLAN
+    worker_class = worker_class or DEFAULT_WORKER_CLASS
+    if plan not in RESOURCE_PLANS:
+        raise ValueError(f"Неизвестный план {plan}, доступны: {', '.join(RESOURCE_PLANS)}")
+    if worker_class not in WORKER_CLASSES:
+        raise ValueError(f"Неизвестный класс воркеров {worker_class}, доступны: {', '.join(WORKER_CLASSES)}")
+
+    limits = RESOURCE_PLANS[plan]
+    cores, available_memory = host_resources()
+    cpus = min(limits['cpus'], cores)
+    memory = max(min(limits['memory'], available_memory), WORKER_MEMORY)
+
+    threads = 1
+    if worker_class == 'sync':
+        workers = 2 * math.ceil(cpus) + 1
+    elif worker_class == 'gthread':
+        workers, threads = math.ceil(cpus) + 1, limits['threads']
+    else:
+        workers = math.ceil(cpus)
+
+    return {
+        'GUNICORN_WORKERS': str(max(min(workers, memory // WORKER_MEMORY), 1)),
+        'GUNICORN_THREADS': str(threads),
+        'GUNICORN_WORKER_CLASS': worker_class,
+        'GUNICORN_WORKER_CONNECTIONS': str(WORKER_CONNECTIONS),
+        'GUNICORN_EXTRAS': WORKER_EXTRAS.get(worker_class, ''),
+        'CPUS': f'{cpus:g}',
+        'MEM_LIMIT': f'{memory}m',
+    }
@@ -0,0 +1,238 @@
+from app.deploy.settings import (SCAN_WORKERS, SCAN_BATCH_SIZE, SCAN_SEVERITY_LEVEL, SCAN_CONFIDENCE_LEVEL,
+                                 SCAN_EXTENSIONS, SCAN_EXCLUDED_DIRS)
+from app.deploy.container.cache import blob_hash
+from app.deploy.container.orchestrator import run_process
+import asyncio
+import json
+import os
+import time
+
+
+class ScanReport:
+    """
+    Aggregated result of a project security scan
+
+    Attributes:
+        issues (list): Blocking issues found by bandit
+        errors (list): Files that bandit failed to analyze
+        failures (list): Bandit invocations that did not produce a report
+        files_scanned (int): Number of analyzed files
+        batches (int): Number of bandit invocations
+        duration (float): Scan wall time in seconds
+        stopped_early (bool): Whether the scan was interrupted by a blocking issue
+        cache_hits (int): Number of files whose results were taken from the cache
+        cache_misses (int): Number of files that had to be scanned
+    """
+
+    def __init__(self):
+        self.issues = []
+        self.errors = []
+        self.failures = []
+        self.files_scanned = 0
+        self.batches = 0
+        self.duration = 0.0
+        self.stopped_early = False
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def blocking(self):
+        """
+        Whether the project must not be deployed
+        """
+        return bool(self.issues or self.failures)
+
+    def to_dict(self):
+        """
+        Convert the report to a dictionary
+
+        :return: Dictionary with scan results
+        """
+        return {
+            'issues': self.issues,
+            'errors': self.errors,
+            'failures': self.failures,
+            'files_scanned': self.files_scanned,
+            'batches': self.batches,
+            'duration': round(self.duration, 3),
+            'stopped_early': self.stopped_early,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+        }
+
+    def __str__(self):
+        lines = [f"{issue['filename']}:{issue['line_number']} "
+                 f"[{issue['issue_severity']}/{issue['issue_confidence']}] "
+                 f"{issue['test_id']}: {issue['issue_text']}" for issue in self.issues]
+        lines.extend(self.failures)
+        return "\n".join(lines)
+
+
+class SecurityScanner:
+    """
+    Security scanner running bandit over batches of project sources in parallel
+
+    The bandit processes are asyncio subprocesses, cancelling the scan terminates them.
+    """
+
+    def __init__(self, workers=SCAN_WORKERS, batch_size=SCAN_BATCH_SIZE,
+                 severity=SCAN_SEVERITY_LEVEL, confidence=SCAN_CONFIDENCE_LEVEL, fail_fast=True, cache=None):
+        """
+        :param workers: Number of bandit processes running at the same time
+        :param batch_size: Max number of files passed to a single bandit process
+        :param severity: Min severity level of the reported issues
+        :param confidence: Min confidence level of the reported issues
+        :param fail_fast: Stop the scan on the first blocking issue
+        :param cache: ScanCache with results of the previous scans
+        """
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.severity = severity
+        self.confidence = confidence
+        self.fail_fast = fail_fast
+        self.cache = cache
+
+    @staticmethod
+    def collect(root):
+        """
+        Collecting the files that can be analyzed by bandit
+
+        :param root: Project root dir
+        :return: Sorted list of absolute paths to the source files
+        """
+        sources = []
+        for current, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if d not in SCAN_EXCLUDED_DIRS]
+            sources.extend(os.path.join(current, file) for file in files if file.endswith(SCAN_EXTENSIONS))
+        return sorted(sources)
+
+    def batches(self, files):
+        """
+        Splitting the files into batches for separate bandit invocations
+
+        Files are spread evenly so that every worker receives work.
+
+        :param files: List of files to scan
+        :return: List of file batches
+        """
+        if not files:
+            return []
+        count = max(-(-len(files) // self.batch_size), min(self.workers, len(files)))
+        return [files[i::count] for i in range(count)]
+
+    def command(self, files):
+        """
+        Building the bandit command line for a batch of files
+        """
+        return ['bandit', '-f', 'json', '-q',
+                '--severity-level', self.severity,
+                '--confidence-level', self.confidence, *files]
+
+    async def scan_batch(self, files):
+        """
+        Running bandit on a batch of files
+
+        :param files: List of files to scan
+        :return: Parsed bandit report
+        """
+        result = await run_process(self.command(files), capture_output=True, separate_stderr=True)
+        try:
+            return json.loads(result.stdout)
+        except json.JSONDecodeError:
+            return {'failure': f"bandit exited with code {result.returncode}: {result.stderr.strip()}"}
+
+    async def scan(self, root, files=None):
+        """
+        Scanning a project for vulnerabilities
+
+        At most `workers` bandit processes run at the same time. With fail_fast the remaining
+        batches are cancelled on the first blocking issue.
+
+        :param root: Project root dir
+        :param files: Files to scan, all project sources by default
+        :return: Aggregated scan report
+        :rtype: ScanReport
+        """
+        started = time.monotonic()
+        report = ScanReport()
+
+        files = await asyncio.to_thread(self.collect, root) if files is None else files
+        blobs = {}
+        if self.cache is not None:
+            blobs = await asyncio.to_thread(lambda: {file: blob_hash(file) for file in files})
+            files = await asyncio.to_thread(self.apply_cache, report, blobs)
+            if report.blocking and self.fail_fast:
+                report.stopped_early = bool(files)
+                files = []
+
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def scan_limited(batch):
+            async with semaphore:
+                return batch, await self.scan_batch(batch)
+
+        tasks = [asyncio.ensure_future(scan_limited(batch)) for batch in self.batches(files)]
+        try:
+            for finished, next_result in enumerate(asyncio.as_completed(tasks), 1):
+                batch, result = await next_result
+                self.merge(report, batch, result)
+                await asyncio.to_thread(self.save_to_cache, batch, result, blobs)
+                if report.blocking and self.fail_fast and finished < len(tasks):
+                    report.stopped_early = True
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        report.duration = time.monotonic() - started
+        return report
+
+    @staticmethod
+    def merge(report, batch, result):
+        """
+        Adding results of a single bandit invocation to the report
+        """
+        report.batches += 1
+        if 'failure' in result:
+            report.failures.append(result['failure'])
+            return
+        report.files_scanned += len(batch)
+        report.issues.extend(result.get('results', []))
+        report.errors.extend(result.get('errors', []))
+
+    def apply_cache(self, report, blobs):
+        """
+        Adding cached results to the report
+
+        :param report: Scan report
+        :param blobs: Dict of file path -> blob SHA
+        :return: List of files missing from the cache
+        """
+        cached = self.cache.lookup(blobs.values())
+        missing = []
+        for file, blob in blobs.items():
+            if blob not in cached:
+                missing.append(file)
+                continue
+            report.issues.extend(dict(issue, filename=file) for issue in cached[blob])
+
+        report.cache_hits = len(blobs) - len(missing)
+        report.cache_misses = len(missing)
+        report.files_scanned += report.cache_hits
+        return missing
+
+    def save_to_cache(self, batch, result, blobs):
+        """
+        Saving results of a single bandit invocation to the cache
+
+        Files that bandit failed to analyze are not cached.
+        """
+        if self.cache is None or 'failure' in result:
+            return
+        failed = {error.get('filename') for error in result.get('errors', [])}
+        results = {blobs[file]: [] for file in batch if file not in failed}
+        for issue in result.get('results', []):
+            if issue['filename'] in blobs and issue['filename'] not in failed:
+                results[blobs[issue['filename']]].append(issue)
+        self.cache.store(results)
@@ -0,0 +1,235 @@
+from app.deploy.settings import TEMPLATE_CONF_DIR
+from app.deploy.container.exceptions import TemplateError
+from deploy.metrics import template_render_seconds
+import copy
+import os
+import re
+import string
+import threading
+import time
+import yaml
+
+
+def escape_sql(value, context):
+    """
+    Escaping a value for MySQL: string literals are escaped, identifiers are quoted with backticks
+    """
+    if context == 'string':
+        return value.replace('\\', '\\\\').replace("'", "''")
+    if '\0' in value:
+        raise TemplateError(f'Недопустимый символ в идентификаторе SQL: {value!r}')
+    return '`' + value.replace('`', '``') + '`'
+
+
+NGINX_SAFE = re.compile(r'[^\s;{}"\'$\\#]*')
+
+
+def escape_nginx(value, context):
+    """
+    Escaping a value for Nginx: a whole directive argument is quoted when needed,
+    a part of an argument must not contain special characters
+    """
+    if NGINX_SAFE.fullmatch(value):
+        return value
+    if context == 'token' and '$' not in value and '\n' not in value:
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    raise TemplateError(f'Значение {value!r} нельзя использовать в конфигурации Nginx')
+
+
+def escape_dockerfile(value, context):
+    """
+    Escaping a value for a Dockerfile: variable substitution is disabled, line breaks and spaces are rejected
+    """
+    if re.search(r'\s', value):
+        raise TemplateError(f'Значение {value!r} нельзя использовать в Dockerfile')
+    return value.replace('\\', '\\\\').replace('$', '\\$')
+
+
+ESCAPERS = {'sql': escape_sql, 'nginx': escape_nginx, 'dockerfile': escape_dockerfile}
+
+# Templates of TEMPLATE_CONF_DIR and the formats they are rendered to
+TEMPLATE_TARGETS = {
+    'Dockerfile': 'dockerfile',
+    'init.sql': 'sql',
+    'drop.sql': 'sql',
+    'nginx.conf': 'nginx',
+    'reverse_nginx': 'nginx',
+    'docker-compose.yml': 'yaml',
+}
+
+
+def field_context(target, before, after):
+    """
+    Context of a template field, determined once when the template is compiled
+
+    :param target: Format of the template
+    :param before: Template text before the field
+    :param after: Template text after the field
+    """
+    if target == 'sql':
+        return 'string' if before.count("'") % 2 else 'identifier'
+    if target == 'nginx':
+        starts_token = not before or before[-1].isspace()
+        ends_token = not after or after[0].isspace() or after[0] == ';'
+        return 'token' if starts_token and ends_token else 'partial'
+    return None
+
+
+class Template:
+    """
+    Compiled configuration template
+
+    Text templates use the str.format syntax ({NAME}, {{ and }} for braces) and are split into literal
+    parts and fields once, every field is escaped for the format of the template when rendered.
+    YAML templates are parsed once and rendered as a copy of the parsed data.
+    """
+
+    def __init__(self, path, target):
+        """
+        :param path: Path to the template
+        :param target: Format of the template (sql, nginx, dockerfile or yaml)
+        """
+        self.path = path
+        self.target = target
+        self.mtime = None
+        self.parts = None  # List of (literal, field name, format spec, field context)
+        self.data = None  # Parsed YAML template
+        self.compile()
+
+    def compile(self):
+        """
+        Loading and compiling the template
+        """
+        self.mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path) as file:
+            source = file.read()
+
+        if self.target == 'yaml':
+            self.data = yaml.safe_load(source)
+            return
+
+        parsed = list(string.Formatter().parse(source))
+        self.parts = []
+        before = ''
+        for index, (literal, field, spec, _) in enumerate(parsed):
+            before += literal
+            after = parsed[index + 1][0] if index + 1 < len(parsed) else ''
+            context = field_context(self.target, before, after) if field is not None else None
+            self.parts.append((literal, field, spec, context))
+
+    @property
+    def is_stale(self):
+        """
+        Whether the template file was changed after it was compiled
+        """
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except FileNotFoundError:
+            return False
+
+    def render(self, values=None):
+        """
+        Rendering the template
+
+        :param values: Dict of field name -> value
+        :return: Rendered text, or a copy of the data for YAML templates
+        :raises KeyError: If a value of a field is missing
+        :raises TemplateError: If a value cannot be safely rendered
+        """
+        if self.target == 'yaml':
+            return copy.deepcopy(self.data)
+
+        escape = ESCAPERS.get(self.target)
+        chunks = []
+        for literal, field, spec, context in self.parts:
+            chunks.append(literal)
+            if field is not None:
+                value = format(values[field], spec) if spec else str(values[field])
+                chunks.append(escape(value, context) if escape else value)
+        return ''.join(chunks)
+
+
+class TemplateLoader:
+    """
+    Cache of the compiled configuration templates
+
+    All templates are compiled when the loader is created, a template is compiled again
+    when its file is modified.
+    """
+
+    def __init__(self, directory=TEMPLATE_CONF_DIR, targets=None):
+        """
+        :param directory: Dir with the templates
+        :param targets: Dict of template name -> format, TEMPLATE_TARGETS by default
+        """
+        self.directory = directory
+        self.targets = targets or TEMPLATE_TARGETS
+        self._templates = {}
+        self._lock = threading.Lock()
+        if directory and os.path.isdir(directory):
+            self.load_all()
+
+    def load_all(self):
+        """
+        Compiling all templates of the dir
+        """
+        for name in self.targets:
+            if os.path.exists(os.path.join(self.directory, name)):
+                self.get(name)
+
+    def get(self, name):
+        """
+        Obtaining a compiled template
+
+        :param name: Template file name
+        :return: Compiled template
+        :rtype: Template
+        """
+        with self._lock:
+            template = self._templates.get(name)
+            if template is None or template.is_stale:
+                template = self._templates[name] = Template(os.path.join(self.directory, name), self.targets[name])
+            return template
+
+    def render(self, name, values=None):
+        """
+        Rendering a template, the rendering time is recorded in the metrics
+
+        :param name: Template file name
+        :param values: Dict of field name -> value
+        :return: Rendered template
+        """
+        started = time.monotonic()
+        try:
+            return self.get(name).render(values)
+        finally:
+            template_render_seconds.observe(time.monotonic() - started, template=name)
+
+
+def write_files(directory, files):
+    """
+    Atomic writing of rendered files
+
+    All files are written to temporary files first and then moved into place,
+    so a failed write never leaves a part of the configuration updated.
+
+    :param directory: Target dir
+    :param files: Dict of file name -> content
+    """
+    written = []
+    try:
+        for name, content in files.items():
+            path = os.path.join(directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f'{path}.tmp', 'w') as file:
+                file.write(content)
+            written.append(path)
+    except OSError:
+        for path in written:
+            os.remove(f'{path}.tmp')
+        raise
+    for path in written:
+        os.replace(f'{path}.tmp', path)
+
+
+templates = TemplateLoader()
@@ -0,0 +1,288 @@
+from contextvars import ContextVar
+from functools import wraps
+import codecs
+import subprocess
+import threading
+import time
+
+# Upper bounds of the histogram buckets (in seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+OUTPUT_LINE_LIMIT = 4096  # Max length of an output line of an external command, longer lines are split
+
+
+class Metric:
+    """
+    Base class of the metrics exported in the Prometheus text format
+    """
+
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _format_labels(labels, **extra):
+        pairs = list(labels) + sorted(extra.items())
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        """
+        Rendering the metric in the Prometheus text format
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            lines.extend(self._samples())
+        return '\n'.join(lines)
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """
+        Current value of the counter with the given labels
+        """
+        with self._lock:
+            return self._values.get(self._labels(labels), 0)
+
+    def _samples(self):
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """
+    Histogram of observed durations
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{self._format_labels(key, le=bound)} {bucket_count}')
+            lines.append(f'{self.name}_bucket{self._format_labels(key, le="+Inf")} {count}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {count}')
+        return lines
+
+
+class Registry:
+    """
+    Registry of the deployment metrics
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """
+        Rendering all metrics in the Prometheus text format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+phase_seconds = registry.register(Histogram('deploy_phase_seconds', 'Duration of the deployment phases'))
+kms_request_seconds = registry.register(Histogram('kms_request_seconds', 'Latency of the KMS requests'))
+kms_request_errors = registry.register(Counter('kms_request_errors_total', 'Number of failed KMS requests'))
+subprocess_seconds = registry.register(Histogram('subprocess_seconds', 'Duration of the external commands'))
+subprocess_total = registry.register(Counter('subprocess_total', 'Number of the started external commands'))
+image_pull_seconds = registry.register(Histogram('image_pull_seconds', 'Duration of the base image pulls'))
+scan_cache_lookups = registry.register(Counter('scan_cache_lookups_total',
+                                              'Number of the files looked up in the scan cache by result'))
+scan_cache_evictions = registry.register(Counter('scan_cache_evictions_total',
+                                                'Number of the results evicted from the scan cache'))
+template_render_seconds = registry.register(Histogram('template_render_seconds',
+                                                     'Duration of the configuration template rendering',
+                                                     buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)))
+
+_trace = ContextVar('trace', default=None)
+_listeners = []
+_output_listeners = []
+
+
+def add_span_listener(listener):
+    """
+    Registering a function called with the name and the duration of every finished span
+    """
+    _listeners.append(listener)
+
+
+def add_output_listener(listener):
+    """
+    Registering a function called with every output line of the commands started by run_process
+    """
+    _output_listeners.append(listener)
+
+
+class Trace:
+    """
+    Timing breakdown of a single deployment
+
+    Collects all spans finished in the current thread while the trace is active, including the spans
+    of the asyncio tasks started from it (the trace is kept in a context variable).
+    """
+
+    def __enter__(self):
+        self.spans = []
+        self._token = _trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _trace.reset(self._token)
+
+    def to_dict(self):
+        """
+        Durations of the spans by name, repeated spans are summed up
+        """
+        timings = {}
+        for name, duration in self.spans:
+            timings[name] = round(timings.get(name, 0) + duration, 3)
+        return timings
+
+
+class span:
+    """
+    Measuring the duration of a deployment phase
+
+    Can be used as a context manager or as a function decorator.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.monotonic() - self._started
+        phase_seconds.observe(duration, phase=self.name)
+        trace = _trace.get()
+        if trace is not None:
+            trace.spans.append((self.name, duration))
+        for listener in _listeners:
+            listener(self.name, duration)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def command_name(args):
+    """
+    Name of the program started by a command, used as the metric label
+    """
+    words = args.split() if isinstance(args, str) else list(args)
+    words = [word for word in words if '=' not in word and word != 'sudo']
+    return words[0] if words else 'unknown'
+
+
+def observe_command(args, duration):
+    """
+    Recording an external command started outside of run_command
+    """
+    name = command_name(args)
+    subprocess_total.inc(command=name)
+    subprocess_seconds.observe(duration, command=name)
+    trace = _trace.get()
+    if trace is not None:
+        trace.spans.append((f'subprocess.{name}', duration))
+
+
+def run_command(args, **kwargs):
+    """
+    subprocess.run that records the number and the duration of the external commands
+    """
+    started = time.monotonic()
+    try:
+        return subprocess.run(args, **kwargs)
+    finally:
+        observe_command(args, time.monotonic() - started)
+
+
+class OutputLines:
+    """
+    Splitting the output of a command into lines passed to the output listeners
+
+    Lines longer than OUTPUT_LINE_LIMIT are split, so the memory used does not depend on the output size.
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._pending = ''
+
+    def feed(self, chunk):
+        """
+        Adding a chunk of the output
+
+        :param chunk: Bytes read from the command, an empty chunk marks the end of the output
+        """
+        self._pending += self._decoder.decode(chunk, final=not chunk)
+        *lines, self._pending = self._pending.split('\n')
+        while len(self._pending) > OUTPUT_LINE_LIMIT:
+            lines.append(self._pending[:OUTPUT_LINE_LIMIT])
+            self._pending = self._pending[OUTPUT_LINE_LIMIT:]
+        for line in lines:
+            emit_output(line)
+        if not chunk and self._pending:
+            emit_output(self._pending)
+            self._pending = ''
+
+
+def emit_output(line):
+    """
+    Passing an output line of an external command to the output listeners
+    """
+    line = line.rstrip('\r')
+    for start in range(0, max(len(line), 1), OUTPUT_LINE_LIMIT):
+        for listener in _output_listeners:
+            listener(line[start:start + OUTPUT_LINE_LIMIT])
@@ -1,10 +1,221 @@
 from deploy.settings import *
+from deploy.container.exceptions import DecryptionError
+from deploy.metrics import kms_request_seconds, kms_request_errors
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
+import hashlib
 import os
 import requests
+import struct
+import threading
+import time
 import urllib.parse
 
 
+def parse_envelope(content):
+    """
+    Splitting an encrypted file in the envelope format into its parts
+
+    :param content: Contents of the encrypted file
+    :type content: bytes
+    :return: Wrapped data key, nonce and ciphertext, or None for files in the legacy format
+    :rtype: tuple or None
+    :raises DecryptionError: If the file is truncated
+    """
+    if not content.startswith(ENVELOPE_MAGIC):
+        return None
+    offset = len(ENVELOPE_MAGIC)
+    if len(content) < offset + 4:
+        raise DecryptionError('Зашифрованный файл повреждён: отсутствует размер ключа данных')
+    (key_size,) = struct.unpack_from('>I', content, offset)
+    offset += 4
+    if len(content) < offset + key_size + ENVELOPE_NONCE_SIZE:
+        raise DecryptionError('Зашифрованный файл повреждён: ключ данных или nonce обрезаны')
+    wrapped_key = content[offset:offset + key_size]
+    offset += key_size
+    return wrapped_key, content[offset:offset + ENVELOPE_NONCE_SIZE], content[offset + ENVELOPE_NONCE_SIZE:]
+
+
+def create_session(allowed_methods=frozenset({'GET', 'POST'})):
+    """
+    Creating an HTTP session for KMS requests
+
+    Connections are kept alive and reused, requests of the allowed methods that failed with 429 or 5xx
+    are retried with exponential backoff. Requests of other methods are retried only when the connection
+    could not be established. Once the retries are exhausted the last response is returned,
+    so callers handle it like any failed request.
+
+    :param allowed_methods: HTTP methods retried after a failed response
+    :return: HTTP session
+    :rtype: requests.Session
+    """
+    retry = Retry(total=YC_KMS_RETRIES, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=allowed_methods, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def kms_request(operation, method, url, idempotent=True, **kwargs):
+    """
+    Sending a request to KMS through the shared session, the latency is recorded in the metrics
+
+    :param operation: Name of the KMS operation, used as the metric label
+    :param method: HTTP method
+    :param url: Request URL
+    :param idempotent: Whether the request may be retried after a failed response,
+                       key creation and rotation must not be repeated
+    :return: HTTP response
+    :rtype: requests.Response
+    """
+    started = time.monotonic()
+    try:
+        response = (session if idempotent else key_session).request(method, url, **kwargs)
+    except requests.RequestException:
+        kms_request_errors.inc(operation=operation)
+        raise
+    finally:
+        kms_request_seconds.observe(time.monotonic() - started, operation=operation)
+    if response.status_code != 200:
+        kms_request_errors.inc(operation=operation)
+    return response
+
+
+class KeyIndex:
+    """
+    Cached index of the KMS keys of the folder by user ID (key description)
+
+    The index is rebuilt from the paginated key list once its lifetime expires
+    or after it is invalidated by key creation or rotation. Only one thread rebuilds the index,
+    readers of a valid index are not blocked by the rebuild.
+    """
+
+    def __init__(self, ttl=YC_KMS_KEY_CACHE_TTL):
+        """
+        :param ttl: Lifetime of the index (in seconds)
+        """
+        self.ttl = ttl
+        self._keys = None
+        self._expires_at = 0
+        self._generation = 0  # Incremented by every invalidation
+        self._lock = threading.Lock()  # Guards the cached index
+        self._refresh_lock = threading.Lock()  # Held while the index is rebuilt
+
+    def _is_valid(self):
+        return self._keys is not None and time.monotonic() < self._expires_at
+
+    def get(self, user_id):
+        """
+        Obtaining key metadata by user ID
+
+        :param user_id: User ID
+        :return: Information about the key, or None if the key is not found.
+        :rtype: dict or None
+        """
+        with self._lock:
+            if self._is_valid():
+                return self._keys.get(str(user_id))
+
+        with self._refresh_lock:
+            with self._lock:
+                if self._is_valid():
+                    return self._keys.get(str(user_id))  # Rebuilt by another thread
+                generation = self._generation
+
+            keys = self.load()
+            if keys is None:
+                return None
+            with self._lock:
+                self._keys = keys
+                # An index loaded before an invalidation is used once and rebuilt by the next call
+                self._expires_at = time.monotonic() + self.ttl if generation == self._generation else 0
+            return keys.get(str(user_id))
+
+    def invalidate(self):
+        """
+        Dropping the cached index
+        """
+        with self._lock:
+            self._keys = None
+            self._generation += 1
+
+    @staticmethod
+    def load():
+        """
+        Loading all keys of the folder page by page
+
+        :return: Dict of key description -> key, or None if the list could not be retrieved
+        :rtype: dict or None
+        """
+        keys = {}
+        params = {"folderId": urllib.parse.quote(YC_FOLDER_ID), "pageSize": YC_KMS_PAGE_SIZE}
+        while True:
+            response = kms_request('list', 'GET', YC_KMS_ENDPOINT['list'], params=params,
+                                   timeout=YC_KMS_TIMEOUT, headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
+            if response.status_code != 200:
+                print(f"Failed to retrieve keys with status code {response.status_code} - {response.text}")
+                return None
+
+            data = response.json()
+            for key in data.get('keys', []):
+                keys.setdefault(key.get("description"), key)
+
+            params["pageToken"] = data.get('nextPageToken')
+            if not params["pageToken"]:
+                return keys
+
+
+class DataKeyCache:
+    """
+    Short-lived in-memory cache of unwrapped data keys
+    """
+
+    def __init__(self, ttl=YC_KMS_DATA_KEY_CACHE_TTL):
+        """
+        :param ttl: Lifetime of a cached key (in seconds)
+        """
+        self.ttl = ttl
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def get(self, wrapped_key):
+        """
+        Obtaining the plaintext of a wrapped data key
+
+        :return: Plaintext data key, or None if it is not cached or expired
+        """
+        digest = hashlib.sha256(wrapped_key).digest()
+        with self._lock:
+            plaintext_key, expires_at = self._keys.get(digest, (None, 0))
+            if time.monotonic() >= expires_at:
+                self._keys.pop(digest, None)
+                return None
+            return plaintext_key
+
+    def put(self, wrapped_key, plaintext_key):
+        """
+        Caching the plaintext of a wrapped data key
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._keys = {digest: item for digest, item in self._keys.items() if item[1] > now}
+            self._keys[hashlib.sha256(wrapped_key).digest()] = (plaintext_key, now + self.ttl)
+
+
+ENVELOPE_MAGIC = b'PMENV\x01'  # Header of the envelope format, the last byte is the format version
+ENVELOPE_NONCE_SIZE = 12  # AES-GCM nonce size (in bytes)
+
+session = create_session()  # Encryption, decryption and data key requests are retried
+key_session = create_session(allowed_methods=frozenset({'GET'}))  # Key creation and rotation are not repeated
+key_index = KeyIndex()
+data_key_cache = DataKeyCache()
+
+
 class ConfigStorage:
     """
     A class for managing and working with encryption of confidential data using the Yandex Cloud KMS (Key Management Service) cloud service.
@@ -42,9 +253,10 @@ class ConfigStorage:
                 "deletionProtection": False
             }
 
-            response = requests.post(YC_KMS_ENDPOINT['create'],
-                                     json=payload,
-                                     headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
+            response = kms_request('create', 'POST', YC_KMS_ENDPOINT['create'], idempotent=False,
+                                   json=payload, timeout=YC_KMS_TIMEOUT,
+                                   headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
+            key_index.invalidate()
 
             if response.status_code == 200:
                 key_id = response.json().get('id')
@@ -63,18 +275,25 @@ class ConfigStorage:
         :return: Information about the key, or None if the key is not found.
         :rtype: dict or None
         """
-        response = requests.get(YC_KMS_ENDPOINT['list'],
-                                params={"folderId": urllib.parse.quote(YC_FOLDER_ID)},
-                                headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
+        return key_index.get(user_id)
 
-        if response.status_code == 200:
-            data = response.json()
-            keys = data.get('keys', [])
+    def rotate_key(self):
+        """
+        Rotating the user key in Yandex Cloud KMS.
 
-            matching_keys = filter(lambda key: key["description"] == str(user_id), keys)
-            return next(matching_keys, None)
-        else:
-            print(f"Failed to retrieve keys with status code {response.status_code} - {response.text}")
+        :return: Information about the rotated key, or None if rotation failed.
+        :rtype: dict or None
+        """
+        key = ConfigStorage.get_key(self.user_id)
+        if key:
+            response = kms_request('rotate', 'POST', YC_KMS_ENDPOINT['rotate'].format(keyId=key['id']),
+                                   idempotent=False, timeout=YC_KMS_TIMEOUT, headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
+            key_index.invalidate()
+
+            if response.status_code == 200:
+                return response.json()
+            else:
+                print(f"Key rotation failed with status code {response.status_code} - {response.text}")
         return None
 
     @staticmethod
@@ -90,33 +309,50 @@ class ConfigStorage:
         key = ConfigStorage.get_key(user_id)
         return key["primaryVersion"]["keyId"] if key else None
 
+    @property
+    def target_file(self):
+        """
+        Path to the encrypted configuration file.
+        """
+        return os.path.join(CONFIG_DIR, str(self.user_id), self.project_name)
+
+    @property
+    def aad(self):
+        """
+        Associated data binding the local ciphertext to the user and the project.
+        """
+        return f"{self.user_id}/{self.project_name}".encode('utf-8')
+
     def encrypt(self, file_content):
         """
         Encrypts the file contents and saves the encrypted contents to disk.
 
+        In envelope mode the contents are encrypted locally with the project data key,
+        otherwise they are sent to KMS.
+
         :param file_content: Contents of the file to be encrypted.
-        :type file_content: bytes
+        :type file_content: bytes or str
         :return: Key ID or None in case of error.
         :rtype: str or None
         """
-        encoded_content = base64.b64encode(file_content).decode('utf-8')
+        if isinstance(file_content, str):
+            file_content = file_content.encode('utf-8')
         key = ConfigStorage.get_key(self.user_id)
 
         if key:
-            payload = {
-                "versionId": key["primaryVersion"]["id"],
-                "plaintext": encoded_content
-            }
-
-            response = requests.post(YC_KMS_ENDPOINT['encrypt'].format(keyId=key['id']), json=payload,
-                                     headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
-
-            if response.status_code == 200:
-                encrypted_content = response.json().get('ciphertext')
-                self.to_file(encrypted_content)
-                return key["primaryVersion"]["keyId"]
+            if CONFIG_ENCRYPTION == 'envelope':
+                data_key = self.get_data_key(key)
+                if data_key:
+                    plaintext_key, wrapped_key = data_key
+                    nonce = os.urandom(ENVELOPE_NONCE_SIZE)
+                    ciphertext = AESGCM(plaintext_key).encrypt(nonce, file_content, self.aad)
+                    self.write(ENVELOPE_MAGIC + struct.pack('>I', len(wrapped_key)) + wrapped_key + nonce + ciphertext)
+                    return key["primaryVersion"]["keyId"]
             else:
-                print(f"Encryption failed with status code {response.status_code} - {response.text}")
+                encrypted_content = self.kms_encrypt(key, file_content)
+                if encrypted_content is not None:
+                    self.write(encrypted_content)
+                    return key["primaryVersion"]["keyId"]
         return None
 
     def to_file(self, ciphertext):
@@ -126,39 +362,165 @@ class ConfigStorage:
         :param ciphertext: Encrypted content.
         :type ciphertext: str
         """
-        target_dir = os.path.join(CONFIG_DIR, str(self.user_id))
-        os.makedirs(target_dir, exist_ok=True)
+        self.write(base64.b64decode(ciphertext))
+
+    def write(self, content):
+        """
+        Atomic saving of the encrypted file.
 
-        with open(os.path.join(target_dir, self.project_name), 'wb') as file:
-            file.write(base64.b64decode(ciphertext))
+        :param content: Encrypted file contents.
+        :type content: bytes
+        """
+        os.makedirs(os.path.dirname(self.target_file), exist_ok=True)
+
+        tmp_file = f"{self.target_file}.tmp"
+        with open(tmp_file, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_file, self.target_file)
 
     def decrypt(self):
         """
         Decrypts the contents of the file and returns the decrypted text.
 
+        Files in the envelope format are decrypted locally, files written before
+        the envelope format was introduced are decrypted by KMS.
+
         :return: The decrypted contents of the file, or None in case of error.
         :rtype: str or None
         """
-        target_file = os.path.join(CONFIG_DIR, str(self.user_id), self.project_name)
-
-        if os.path.exists(target_file):
+        if os.path.exists(self.target_file):
             key = ConfigStorage.get_key(self.user_id)
 
             if key:
-                with open(target_file, 'rb') as file:
+                with open(self.target_file, 'rb') as file:
                     encrypted_content = file.read()
 
-                payload = {
-                    "versionId": key["primaryVersion"]["id"],
-                    "ciphertext": base64.b64encode(encrypted_content).decode('utf-8')
-                }
+                try:
+                    envelope = parse_envelope(encrypted_content)
+                except DecryptionError as e:
+                    print(f"Decryption failed: {self.target_file} - {e}")
+                    return None
+                if envelope:
+                    wrapped_key, nonce, ciphertext = envelope
+                    plaintext_key = self.unwrap_data_key(key, wrapped_key)
+                    if plaintext_key:
+                        try:
+                            return AESGCM(plaintext_key).decrypt(nonce, ciphertext, self.aad).decode('utf-8')
+                        except InvalidTag:
+                            print(f"Decryption failed: {self.target_file} is corrupted or was encrypted for another project")
+                else:
+                    decrypted_content = self.kms_decrypt(key, encrypted_content)
+                    if decrypted_content is not None:
+                        return decrypted_content.decode('utf-8')
+        return None
 
-                response = requests.post(YC_KMS_ENDPOINT['decrypt'].format(keyId=key['id']), json=payload,
-                                         headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
+    def get_data_key(self, key):
+        """
+        Obtaining the project data key.
 
-                if response.status_code == 200:
-                    decrypted_content = base64.b64decode(response.json().get('plaintext')).decode('utf-8')
-                    return decrypted_content
-                else:
-                    print(f"Decryption failed with status code {response.status_code} - {response.text}")
+        The data key of the existing envelope file is reused, a new one is generated by KMS otherwise
+        (also when the existing file is truncated, it is overwritten by the caller).
+
+        :param key: Information about the KMS key.
+        :type key: dict
+        :return: Plaintext and KMS-wrapped data key, or None in case of error.
+        :rtype: tuple or None
+        """
+        if os.path.exists(self.target_file):
+            with open(self.target_file, 'rb') as file:
+                content = file.read()
+            try:
+                envelope = parse_envelope(content)
+            except DecryptionError:
+                envelope = None
+            if envelope:
+                plaintext_key = self.unwrap_data_key(key, envelope[0])
+                return (plaintext_key, envelope[0]) if plaintext_key else None
+
+        payload = {
+            "versionId": key["primaryVersion"]["id"],
+            "dataKeySpec": YC_KMS_ALGORITHM
+        }
+
+        response = kms_request('generate', 'POST', YC_KMS_ENDPOINT['generate'].format(keyId=key['id']), json=payload,
+                               timeout=YC_KMS_TIMEOUT, headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
+
+        if response.status_code == 200:
+            data = response.json()
+            plaintext_key = base64.b64decode(data['dataKeyPlaintext'])
+            wrapped_key = base64.b64decode(data['dataKeyCiphertext'])
+            data_key_cache.put(wrapped_key, plaintext_key)
+            return plaintext_key, wrapped_key
+        else:
+            print(f"Data key generation failed with status code {response.status_code} - {response.text}")
+        return None
+
+    def unwrap_data_key(self, key, wrapped_key):
+        """
+        Decrypting a data key, recently used keys are taken from the in-memory cache.
+
+        :param key: Information about the KMS key.
+        :type key: dict
+        :param wrapped_key: KMS-wrapped data key.
+        :type wrapped_key: bytes
+        :return: Plaintext data key, or None in case of error.
+        :rtype: bytes or None
+        """
+        plaintext_key = data_key_cache.get(wrapped_key)
+        if plaintext_key is None:
+            plaintext_key = self.kms_decrypt(key, wrapped_key)
+            if plaintext_key is not None:
+                data_key_cache.put(wrapped_key, plaintext_key)
+        return plaintext_key
+
+    @staticmethod
+    def kms_encrypt(key, plaintext):
+        """
+        Encrypting data with the KMS key.
+
+        :param key: Information about the KMS key.
+        :type key: dict
+        :param plaintext: Data to encrypt.
+        :type plaintext: bytes
+        :return: Encrypted data, or None in case of error.
+        :rtype: bytes or None
+        """
+        payload = {
+            "versionId": key["primaryVersion"]["id"],
+            "plaintext": base64.b64encode(plaintext).decode('utf-8')
+        }
+
+        response = kms_request('encrypt', 'POST', YC_KMS_ENDPOINT['encrypt'].format(keyId=key['id']), json=payload,
+                               timeout=YC_KMS_TIMEOUT, headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
+
+        if response.status_code == 200:
+            return base64.b64decode(response.json().get('ciphertext'))
+        else:
+            print(f"Encryption failed with status code {response.status_code} - {response.text}")
+        return None
+
+    @staticmethod
+    def kms_decrypt(key, ciphertext):
+        """
+        Decrypting data with the KMS key.
+
+        :param key: Information about the KMS key.
+        :type key: dict
+        :param ciphertext: Data encrypted by KMS.
+        :type ciphertext: bytes
+        :return: Decrypted data, or None in case of error.
+        :rtype: bytes or None
+        """
+        payload = {
+            "versionId": key["primaryVersion"]["id"],
+            "ciphertext": base64.b64encode(ciphertext).decode('utf-8')
+        }
+
+        response = kms_request('decrypt', 'POST', YC_KMS_ENDPOINT['decrypt'].format(keyId=key['id']), json=payload,
+                               timeout=YC_KMS_TIMEOUT, headers={"Authorization": f"Bearer {YC_IAM_TOKEN}"})
+
+        if response.status_code == 200:
+            return base64.b64decode(response.json().get('plaintext'))
+        else:
+            print(f"Decryption failed with status code {response.status_code} - {response.text}")
         return None
@@ -4,6 +4,56 @@ import os
 CONFIG_DIR = os.getenv('CONFIG_DIR', '/path/to/config')  # Сonfiguration dir
 PROJECT_DIR = os.getenv('PROJECT_DIR', '/path/to/project')  # Project dir
 
+# Registry of the deployed projects
+PROJECT_REGISTRY_DIR = os.path.join(CONFIG_DIR, 'registry')  # Metadata of the deployed projects
+PROJECT_LOCK_DIR = os.path.join(CONFIG_DIR, 'locks')  # Lock files serializing the operations on a project
+
+# Git mirrors of the project repositories
+GIT_MIRROR_DIR = os.getenv('GIT_MIRROR_DIR', os.path.join(PROJECT_DIR, '.mirrors'))
+GIT_INCREMENTAL_CLONE = os.getenv('GIT_INCREMENTAL_CLONE', 'true').lower() == 'true'  # Fetch into a local mirror
+
+# Docker build configuration
+DOCKER_BUILD_CACHE = os.getenv('DOCKER_BUILD_CACHE', 'true').lower() == 'true'  # Reuse layer cache and built images
+BUILD_STATE_DIR = os.path.join(CONFIG_DIR, 'builds')  # Fingerprints of the last successful builds
+SERVICE_READY_TIMEOUT = int(os.getenv('SERVICE_READY_TIMEOUT', 600))  # Max wait for healthy services (in seconds)
+SLOT_STOP_TIMEOUT = int(os.getenv('SLOT_STOP_TIMEOUT', 30))  # Graceful stop timeout of the previous app version
+PULLED_SERVICES = ('db', 'redis')  # Services with prebuilt images, pulled while the web image is built
+
+# Resources of the web container and gunicorn workers
+RESOURCE_PLANS = {  # CPU cores, memory (in MB) and threads of a gthread worker of every plan
+    'small': {'cpus': 0.5, 'memory': 512, 'threads': 2},
+    'medium': {'cpus': 1, 'memory': 1024, 'threads': 4},
+    'large': {'cpus': 2, 'memory': 2048, 'threads': 4},
+}
+DEFAULT_PLAN = os.getenv('DEFAULT_PLAN', 'small')  # Plan of the projects without a chosen plan
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')  # Supported gunicorn worker classes
+DEFAULT_WORKER_CLASS = os.getenv('DEFAULT_WORKER_CLASS', 'gthread')  # Worker class of the projects without a choice
+WORKER_MEMORY = int(os.getenv('WORKER_MEMORY', 128))  # Memory needed by a gunicorn worker (in MB)
+WORKER_CONNECTIONS = int(os.getenv('WORKER_CONNECTIONS', 1000))  # Max simultaneous clients of a gevent worker
+
+# Base images of the projects (docker-compose.yml and Dockerfile templates)
+IMAGE_WARMUP = os.getenv('IMAGE_WARMUP', 'true').lower() == 'true'  # Pre-pull and pin the base images by digest
+IMAGE_WARMUP_INTERVAL = int(os.getenv('IMAGE_WARMUP_INTERVAL', 21600))  # Interval of the base image refresh (in seconds)
+IMAGE_PINS_PATH = os.getenv('IMAGE_PINS_PATH', os.path.join(CONFIG_DIR, 'images.json'))  # Pinned image digests
+
+# Deployment pipeline steps (asyncio orchestration)
+STEP_TIMEOUTS = {  # Max duration of every step (in seconds), the step is cancelled once it is exceeded
+    'clone': int(os.getenv('CLONE_TIMEOUT', 600)),
+    'scan': int(os.getenv('SCAN_TIMEOUT', 900)),
+    'setup': int(os.getenv('SETUP_TIMEOUT', 120)),
+    'build': int(os.getenv('BUILD_TIMEOUT', 3600)),
+    'pull': int(os.getenv('PULL_TIMEOUT', 900)),
+    'up': SERVICE_READY_TIMEOUT + 60,
+    'down': int(os.getenv('DOWN_TIMEOUT', 300)),
+    'proxy': int(os.getenv('PROXY_TIMEOUT', 120)),
+}
+PROCESS_KILL_TIMEOUT = int(os.getenv('PROCESS_KILL_TIMEOUT', 10))  # Wait after SIGTERM of a cancelled command
+
+# Nginx reverse proxy sites
+NGINX_SITES_AVAILABLE = os.getenv('NGINX_SITES_AVAILABLE', '/etc/nginx/sites-available')  # Project site files
+NGINX_SITES_ENABLED = os.getenv('NGINX_SITES_ENABLED', '/etc/nginx/sites-enabled')  # Links to enabled sites
+NGINX_RELOAD_WINDOW = float(os.getenv('NGINX_RELOAD_WINDOW', 0.5))  # Time to batch site changes before a reload
+
 # Configuration template dir
 TEMPLATE_CONF_DIR = os.getenv('TEMPLATE_CONF_DIR')
 
@@ -12,9 +62,42 @@ SSL_PATH = os.getenv('SSL_PATH')  # Common path to SSL files
 SSL_CERT_PATH = os.getenv('SSL_CERT_PATH')  # Path to the SSL certificate
 SSL_KEY_PATH = os.getenv('SSL_KEY_PATH')  # Path to the SSL key
 
+# Security scan configuration (bandit)
+SCAN_WORKERS = int(os.getenv('SCAN_WORKERS', os.cpu_count() or 1))  # Number of parallel bandit processes
+SCAN_BATCH_SIZE = int(os.getenv('SCAN_BATCH_SIZE', 200))  # Max number of files per bandit invocation
+SCAN_SEVERITY_LEVEL = os.getenv('SCAN_SEVERITY_LEVEL', 'medium')  # Min severity of a blocking issue
+SCAN_CONFIDENCE_LEVEL = os.getenv('SCAN_CONFIDENCE_LEVEL', 'high')  # Min confidence of a blocking issue
+SCAN_EXTENSIONS = ('.py',)  # Extensions of the files that bandit can analyze
+SCAN_EXCLUDED_DIRS = ('.git', '__pycache__', 'node_modules', 'venv', '.venv', 'env', 'site-packages')  # Skipped dirs
+SCAN_CACHE_PATH = os.getenv('SCAN_CACHE_PATH', os.path.join(CONFIG_DIR, 'scan_cache.sqlite3'))  # Scan result cache
+SCAN_CACHE_MAX_ENTRIES = int(os.getenv('SCAN_CACHE_MAX_ENTRIES', 200000))  # Max number of cached file results
+
+# Django settings introspection
+SETTINGS_CACHE_SIZE = int(os.getenv('SETTINGS_CACHE_SIZE', 1024))  # Max number of cached settings modules
+
+# Host port allocation
+PORTS_STATE_PATH = os.getenv('PORTS_STATE_PATH', os.path.join(CONFIG_DIR, 'ports.json'))  # Port allocation table
+PORT_RANGES = {'APP_PORT': 8000, 'NGINX_PORT': 444, 'REDIS_PORT': 6379}  # First port of every range
+PROJECT_PORTS = ('NGINX_PORT', 'REDIS_PORT')  # Ports shared by all versions of the project
+SLOT_PORTS = ('APP_PORT',)  # Ports of a single version of the app (blue/green slot)
+
 # MySQL root user password
 MYSQL_ROOT_PASSWORD = os.getenv('MYSQL_ROOT_PASSWORD')
 
+# Shared MySQL and Redis of all projects instead of the db and redis containers of every project
+SHARED_BACKENDS = os.getenv('SHARED_BACKENDS', 'false').lower() == 'true'  # Enable the shared backend mode
+SHARED_BACKEND_HOST = os.getenv('SHARED_BACKEND_HOST', 'host.docker.internal')  # Backend host seen from the projects
+SHARED_MYSQL_HOST = os.getenv('SHARED_MYSQL_HOST', '127.0.0.1')  # Host of the shared MySQL seen from the API
+SHARED_MYSQL_PORT = int(os.getenv('SHARED_MYSQL_PORT', 3306))  # Port of the shared MySQL
+SHARED_MYSQL_USER = os.getenv('SHARED_MYSQL_USER', 'root')  # Admin user of the shared MySQL (password: MYSQL_ROOT_PASSWORD)
+SHARED_MYSQL_POOL_SIZE = int(os.getenv('SHARED_MYSQL_POOL_SIZE', 4))  # Number of pooled admin connections
+SHARED_REDIS_HOST = os.getenv('SHARED_REDIS_HOST', '127.0.0.1')  # Host of the shared Redis seen from the API
+SHARED_REDIS_PORT = int(os.getenv('SHARED_REDIS_PORT', 6379))  # Port of the shared Redis
+SHARED_REDIS_PASSWORD = os.getenv('SHARED_REDIS_PASSWORD')  # Password of the admin (default) user of the shared Redis
+SHARED_REDIS_MODE = os.getenv('SHARED_REDIS_MODE', 'db')  # 'db' - a database per project, 'acl' - an ACL user per project
+SHARED_REDIS_DATABASES = int(os.getenv('SHARED_REDIS_DATABASES', 16))  # Number of databases of the shared Redis
+SHARED_REDIS_STATE_PATH = os.path.join(CONFIG_DIR, 'redis_databases.json')  # Allocation table of the Redis databases
+
 # Yandex Cloud configuration
 # Yandex Cloud folder ID
 # https://yandex.cloud/ru/docs/resource-manager/operations/folder/create
@@ -29,13 +112,27 @@ YC_KMS_ALGORITHM = 'AES_256'  # KMS algorithm
 YC_KMS_ROTATION_PERIOD = '604800s'  # KMS key rotation period (in seconds)
 
 # KMS API endpoints
+YC_KMS_API_URL = os.getenv('YC_KMS_API_URL', 'https://kms.api.cloud.yandex.net')  # Key management API
+YC_KMS_CRYPTO_URL = os.getenv('YC_KMS_CRYPTO_URL', 'https://kms.yandex')  # Data encryption API
 YC_KMS_ENDPOINT = {
-    'create': 'https://kms.api.cloud.yandex.net/kms/v1/keys/',  # Endpoint for generating keys
-    'list': 'https://kms.api.cloud.yandex.net/kms/v1/keys/',  # Endpoint for getting a list of keys
-    'encrypt': 'https://kms.yandex/kms/v1/keys/{keyId}:encrypt',  # Endpoint for data encryption
-    'decrypt': 'https://kms.yandex/kms/v1/keys/{keyId}:decrypt',  # Endpoint for data decryption
+    'create': f'{YC_KMS_API_URL}/kms/v1/keys/',  # Endpoint for generating keys
+    'list': f'{YC_KMS_API_URL}/kms/v1/keys/',  # Endpoint for getting a list of keys
+    'rotate': f'{YC_KMS_API_URL}/kms/v1/keys/{{keyId}}:rotate',  # Endpoint for key rotation
+    'encrypt': f'{YC_KMS_CRYPTO_URL}/kms/v1/keys/{{keyId}}:encrypt',  # Endpoint for data encryption
+    'decrypt': f'{YC_KMS_CRYPTO_URL}/kms/v1/keys/{{keyId}}:decrypt',  # Endpoint for data decryption
+    'generate': f'{YC_KMS_CRYPTO_URL}/kms/v1/keys/{{keyId}}:generateDataKey',  # Endpoint for data key generation
 }
 
+# KMS client configuration
+YC_KMS_KEY_CACHE_TTL = int(os.getenv('YC_KMS_KEY_CACHE_TTL', 300))  # Lifetime of the cached key list (in seconds)
+YC_KMS_PAGE_SIZE = 1000  # Number of keys requested per page
+YC_KMS_RETRIES = 3  # Number of retries of a failed KMS request
+YC_KMS_TIMEOUT = 10  # KMS request timeout (in seconds)
+
+# Configuration encryption mode: 'envelope' - local AES-GCM with a KMS-wrapped data key, 'kms' - remote KMS encryption
+CONFIG_ENCRYPTION = os.getenv('CONFIG_ENCRYPTION', 'envelope')
+YC_KMS_DATA_KEY_CACHE_TTL = int(os.getenv('YC_KMS_DATA_KEY_CACHE_TTL', 300))  # Lifetime of unwrapped data keys
+
 # Necessary variables for starting and running a web project (for now only Django projects!)
 REQUIRED_VARIABLES = {
     'SETTINGS': ['DJANGO_SETTINGS_MODULE', 'SECRET_KEY'],  # Переменные настройки Django
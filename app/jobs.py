@@ -0,0 +1,248 @@
+from deploy.metrics import add_output_listener, add_span_listener
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+import logging
+import threading
+import time
+import uuid
+
+_current_job = ContextVar('job', default=None)
+
+
+def current_job():
+    """
+    Obtaining the job executed by the current thread
+
+    The job is kept in a context variable, so it is also seen by the asyncio tasks
+    of the deployment pipeline started by the job.
+
+    :return: Current job or None outside of the job workers
+    """
+    return _current_job.get()
+
+
+class Job:
+    """
+    Deployment job
+
+    Attributes:
+        id (str): Unique job identifier
+        action (str): Action name (start, restart, stop)
+        project (tuple): Telegram user ID and project name
+        state (str): Job state (queued, running, succeeded or failed)
+        phases (list): Names and durations of the executed phases
+        logs (deque): Last log lines of the job
+        result (dict): Result returned by the job function
+        error (str): Error message of a failed job
+    """
+
+    QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+
+    def __init__(self, action, project, func, log_limit):
+        self.id = uuid.uuid4().hex
+        self.action = action
+        self.project = project
+        self.func = func
+        self.state = self.QUEUED
+        self.phases = []
+        self.logs = deque(maxlen=log_limit)
+        self.log_offset = 0  # Number of log lines dropped from the beginning
+        self.result = None
+        self.error = None
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    @property
+    def finished(self):
+        return self.state in (self.SUCCEEDED, self.FAILED)
+
+    def log(self, message):
+        """
+        Adding a line to the job log
+        """
+        with self._lock:
+            if len(self.logs) == self.logs.maxlen:
+                self.log_offset += 1
+            self.logs.append(f"{datetime.utcnow().strftime('%H:%M:%S')} {message}")
+            self._changed.notify_all()
+
+    def get_logs(self, offset=0):
+        """
+        Obtaining log lines starting from an offset
+
+        :param offset: Number of the first line
+        :return: Offset of the first returned line and the list of lines
+        """
+        with self._lock:
+            start = max(offset, self.log_offset)
+            return start, list(self.logs)[start - self.log_offset:]
+
+    def wait_for_logs(self, offset, timeout):
+        """
+        Waiting until a log line with the given offset is added or the job is finished
+
+        :param offset: Number of the expected line
+        :param timeout: Max wait time (in seconds)
+        :return: True if there are new lines or the job is finished
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self.log_offset + len(self.logs) > offset or self.finished, timeout)
+
+    def notify(self):
+        """
+        Waking up the clients waiting for the job log
+        """
+        with self._changed:
+            self._changed.notify_all()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measuring the duration of a job phase
+        """
+        started = time.monotonic()
+        self.log(f"{name}: started")
+        try:
+            yield
+        finally:
+            duration = round(time.monotonic() - started, 3)
+            self.phases.append({'name': name, 'duration': duration})
+            self.log(f"{name}: finished in {duration}s")
+
+    def to_dict(self):
+        """
+        Convert the job to a dictionary
+
+        :return: Dictionary with job data
+        """
+        return {
+            'id': self.id,
+            'action': self.action,
+            'project': self.project[1],
+            'state': self.state,
+            'phases': self.phases,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class JobLogHandler(logging.Handler):
+    """
+    Logging handler copying records emitted by job workers to the job log
+    """
+
+    def emit(self, record):
+        job = current_job()
+        if job is not None:
+            job.log(self.format(record))
+
+
+class JobQueue:
+    """
+    Queue of deployment jobs executed by a bounded pool of background workers
+
+    Jobs of the same project are executed one after another in the order of submission,
+    jobs of different projects run in parallel.
+    """
+
+    def __init__(self, app, workers=4, history=1000, log_limit=500):
+        """
+        :param app: Flask application, jobs are executed inside its context
+        :param workers: Max number of jobs running at the same time
+        :param history: Max number of finished jobs kept in memory
+        :param log_limit: Max number of log lines kept per job
+        """
+        self.app = app
+        self.history = history
+        self.log_limit = log_limit
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='deploy')
+        self._jobs = OrderedDict()
+        self._queues = {}  # project -> deque of jobs waiting for the running one
+        self._lock = threading.Lock()
+        logging.getLogger().addHandler(JobLogHandler())
+        add_span_listener(self._on_span)
+        add_output_listener(self._on_output)
+
+    def submit(self, action, project, func):
+        """
+        Adding a job to the queue
+
+        :param action: Action name
+        :param project: Project key (Telegram user ID, project name)
+        :param func: Function executing the job, its return value becomes the job result
+        :return: Created job
+        :rtype: Job
+        """
+        job = Job(action, project, func, self.log_limit)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+            waiting = self._queues.get(project)
+            if waiting is None:
+                self._queues[project] = deque()
+                self._executor.submit(self._run, job)
+            else:
+                waiting.append(job)
+                job.log(f"waiting for {len(waiting)} job(s) of the project")
+        return job
+
+    def get(self, job_id):
+        """
+        Obtaining a job by its ID
+
+        :return: Job or None if the job does not exist
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job):
+        token = _current_job.set(job)
+        job.state = Job.RUNNING
+        job.started_at = datetime.utcnow()
+        try:
+            with self.app.app_context(), job.phase(job.action):
+                job.result = job.func()
+            job.state = Job.SUCCEEDED
+        except Exception as e:
+            job.error = str(e)
+            job.state = Job.FAILED
+            job.log(f"failed: {e!r}")
+        finally:
+            job.finished_at = datetime.utcnow()
+            _current_job.reset(token)
+            job.notify()
+            self._next(job.project)
+
+    @staticmethod
+    def _on_span(name, duration):
+        job = current_job()
+        if job is not None:
+            job.phases.append({'name': name, 'duration': round(duration, 3)})
+
+    @staticmethod
+    def _on_output(line):
+        job = current_job()
+        if job is not None:
+            job.log(line)
+
+    def _next(self, project):
+        with self._lock:
+            waiting = self._queues[project]
+            if waiting:
+                self._executor.submit(self._run, waiting.popleft())
+            else:
+                del self._queues[project]
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self._jobs) - self.history)]:
+            del self._jobs[job_id]
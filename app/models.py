@@ -1,4 +1,6 @@
 from datetime import datetime
+from sqlalchemy import and_, tuple_
+from sqlalchemy.orm import contains_eager
 from run import db
 
 
@@ -24,7 +26,7 @@ class User(db.Model):
 
         :return: List of user projects
         """
-        return self.projects.all()
+        return self.projects.order_by(Project.name).all()
 
     def save(self):
         """
@@ -57,9 +59,16 @@ class Project(db.Model):
         user_id (int): Identifier of the user who owns the project
         user (User): Link to the user model
         status (str): Project status (Running or Stopped)
+        timings (dict): Durations of the phases of the last deployment (in seconds)
+        plan (str): Resource plan of the web container, the default plan if not chosen
+        worker_class (str): Gunicorn worker class, the default worker class if not chosen
     """
 
     __tablename__ = 'projects'
+    __table_args__ = (
+        db.Index('ix_projects_user_id_name', 'user_id', 'name'),  # Lookups and keyset pages of user projects
+        db.Index('ix_projects_status', 'status'),  # Selection of projects by status
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(50), nullable=False, unique=True)
@@ -67,8 +76,110 @@ class Project(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    user = db.relationship('User', backref='projects', cascade='all,delete')
+    user = db.relationship('User', backref=db.backref('projects', lazy='dynamic'), cascade='all,delete')
     status = db.Column(db.Enum('Запущен', 'Остановлен'), default='Остановлен', nullable=False)
+    timings = db.Column(db.JSON, nullable=True)
+    plan = db.Column(db.String(20), nullable=True)
+    worker_class = db.Column(db.String(20), nullable=True)
+
+    # Columns returned by the project list
+    LIST_COLUMNS = ('name', 'description', 'created_at', 'status')
+
+    @classmethod
+    def find(cls, tg_id, name, *criteria):
+        """
+        Searching for a user project with a single indexed query
+
+        The user is loaded by the same query.
+
+        :param tg_id: Telegram user ID
+        :param name: Project name
+        :param criteria: Additional filter conditions (e.g. on the project status)
+        :return: Project or None if the project is not found
+        """
+        return (cls.query.join(cls.user).options(contains_eager(cls.user))
+                .filter(User.tg_id == tg_id, cls.name == name, *criteria).first())
+
+    @classmethod
+    def find_many(cls, keys):
+        """
+        Obtaining IDs, statuses and resource options of many user projects with a single query
+
+        :param keys: Iterable of (Telegram user ID, project name)
+        :return: Dict of (Telegram user ID, project name) -> (project ID, status, dict of the chosen 'plan'
+                 and 'worker_class') for the existing projects
+        :rtype: dict
+        """
+        keys = list(set(keys))
+        if not keys:
+            return {}
+        rows = (db.session.query(User.tg_id, cls.name, cls.id, cls.status, cls.plan, cls.worker_class)
+                .join(cls.user).filter(tuple_(User.tg_id, cls.name).in_(keys)).all())
+        return {(row.tg_id, row.name): (row.id, row.status, cls.row_options(row)) for row in rows}
+
+    @classmethod
+    def update_many(cls, changes):
+        """
+        Updating many projects in a single transaction
+
+        :param changes: List of dicts with the project 'id' and the new column values
+        """
+        if not changes:
+            return
+        now = datetime.utcnow()
+        db.session.bulk_update_mappings(cls, [dict(change, updated_at=now) for change in changes])
+        db.session.commit()
+
+    @classmethod
+    def list_page(cls, tg_id, limit, after=None):
+        """
+        Obtaining a page of user projects ordered by name
+
+        Keyset pagination: the page starts after the given project name, so the cost of a page
+        does not depend on its position. Only the columns of the list are loaded.
+
+        :param tg_id: Telegram user ID
+        :param limit: Max number of projects on the page
+        :param after: Name of the last project of the previous page
+        :return: List of project dicts and the cursor of the next page (None on the last page),
+                 or None if the user is not found
+        :rtype: tuple or None
+        """
+        join_condition = cls.user_id == User.id
+        if after:
+            join_condition = and_(join_condition, cls.name > after)
+        columns = [getattr(cls, column) for column in cls.LIST_COLUMNS]
+        rows = (db.session.query(User.id, *columns).outerjoin(cls, join_condition)
+                .filter(User.tg_id == tg_id).order_by(cls.name).limit(limit + 1).all())
+        if not rows:
+            return None
+
+        projects = [cls.row_to_dict(row) for row in rows[:limit] if row.name is not None]
+        next_cursor = projects[-1]['name'] if len(rows) > limit else None
+        return projects, next_cursor
+
+    @classmethod
+    def create(cls, tg_id, username, name, description=None):
+        """
+        Creating a project, the user is created along with the first project
+
+        The existence checks are done by a single query and everything is saved by a single commit.
+
+        :param tg_id: Telegram user ID
+        :param username: Username, used when the user does not exist yet
+        :param name: Project name
+        :param description: Description of the project
+        :return: Created project, or None if the user already has a project with this name
+        """
+        row = (db.session.query(User, cls.id).outerjoin(cls, and_(cls.user_id == User.id, cls.name == name))
+               .filter(User.tg_id == tg_id).first())
+        if row and row[1] is not None:
+            return None
+
+        user = row[0] if row else User(username=username, tg_id=tg_id)
+        project = cls(name=name, description=description, user=user)
+        project.save()
+        return project
 
     def save(self):
         """
@@ -84,13 +195,16 @@ class Project(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def update(self, name=None, description=None, status=None):
+    def update(self, name=None, description=None, status=None, timings=None, plan=None, worker_class=None):
         """
         Update project data
 
         :param name: New project name
         :param description: New description of the project
         :param status: New project status
+        :param timings: Durations of the deployment phases
+        :param plan: New resource plan
+        :param worker_class: New gunicorn worker class
         """
         for key, value in locals().items():
             if key != 'self' and value is not None:
@@ -102,11 +216,39 @@ class Project(db.Model):
         """
         Convert a project object to a dictionary
 
+        :return: Dictionary with project data
+        """
+        return self.row_to_dict(self)
+
+    @staticmethod
+    def row_to_dict(row):
+        """
+        Convert a project or a row with the list columns to a dictionary
+
+        :param row: Project or query row with the LIST_COLUMNS columns
         :return: Dictionary with project data
         """
         return {
-            'name': self.name,
-            'description': self.description,
-            'created_at': self.created_at.strftime('%d.%m.%y %H:%M'),
-            'status': self.status
+            'name': row.name,
+            'description': row.description,
+            'created_at': row.created_at.strftime('%d.%m.%y %H:%M'),
+            'status': row.status
         }
+
+    def options(self):
+        """
+        Deployment options chosen for the project
+
+        :return: Dict of the chosen 'plan' and 'worker_class'
+        """
+        return self.row_options(self)
+
+    @staticmethod
+    def row_options(row):
+        """
+        Deployment options of a project or a row with the plan and worker_class columns
+
+        :param row: Project or query row
+        :return: Dict of the chosen 'plan' and 'worker_class', options that were not chosen are omitted
+        """
+        return {key: getattr(row, key) for key in ('plan', 'worker_class') if getattr(row, key)}
@@ -1,7 +1,10 @@
 from flask import Flask
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+from app.deploy.container.images import image_warmer
 from config import Config
+from jobs import JobQueue
+import logging
 
 
 app = Flask(__name__)
@@ -11,6 +14,14 @@ app.config.from_object(Config())  # Load configuration
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+# Initialize the deployment job queue
+logging.basicConfig(level=logging.INFO)
+job_queue = JobQueue(app, workers=app.config['JOB_WORKERS'],
+                     history=app.config['JOB_HISTORY'], log_limit=app.config['JOB_LOG_LIMIT'])
+
+# Pre-pull and pin the base images of the projects
+image_warmer.start()
+
 # Register controllers
 from controllers import api
 app.register_blueprint(api, url_prefix='/api')
@@ -0,0 +1,230 @@
+"""
+Deployment benchmark
+
+Runs DjangoManager.start, restart and stop end to end against local stand-ins: the fake
+docker, sudo and nginx binaries from benchmarks/bin, local bare git repositories of the
+requested sizes and a stub HTTP KMS. Every action is executed by N concurrent deployments
+of different projects, the report contains the latency percentiles and the throughput
+of the actions and of their phases.
+
+Usage (from the repository root):
+
+    python benchmarks/bench_deploy.py --files 10,1000,50000 --concurrency 1,4 --output results.json
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from kms import StubKMS
+from repos import SETTINGS_MODULE, make_repo
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+ACTIONS = ('start', 'restart', 'stop')
+PERCENTILES = (50, 90, 99)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark of the deployment pipeline')
+    parser.add_argument('--files', type=int_list, default=[10, 1000],
+                        help='Comma-separated numbers of files in the benchmark repositories')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 4],
+                        help='Comma-separated numbers of concurrent deployments')
+    parser.add_argument('--actions', type=lambda value: value.split(','), default=list(ACTIONS),
+                        help='Comma-separated actions executed by every deployment in this order')
+    parser.add_argument('--rounds', type=int, default=1, help='Number of repetitions of every scenario')
+    parser.add_argument('--build-delay', type=float, default=0.0, help='Duration of a fake image build (s)')
+    parser.add_argument('--up-delay', type=float, default=0.0, help='Duration of a fake services start (s)')
+    parser.add_argument('--kms-latency', type=float, default=0.0, help='Latency of the stub KMS requests (s)')
+    parser.add_argument('--workdir', help='Dir for the repositories, projects and state (temporary by default)')
+    parser.add_argument('--keep', action='store_true', help='Keep the work dir after the run')
+    parser.add_argument('--output', help='Path to the JSON report, printed to stdout by default')
+    return parser.parse_args()
+
+
+def configure_environment(args, workdir, kms):
+    """
+    Pointing the deploy settings to the work dir and the stand-ins
+
+    Must be called before the deploy package is imported, its settings are read on import.
+    """
+    os.environ.update({
+        'PATH': os.path.join(BENCHMARKS_DIR, 'bin') + os.pathsep + os.environ.get('PATH', ''),
+        'CONFIG_DIR': os.path.join(workdir, 'config'),
+        'PROJECT_DIR': os.path.join(workdir, 'projects'),
+        'TEMPLATE_CONF_DIR': os.path.join(ROOT_DIR, 'app', 'deploy', 'container', 'conf') + os.sep,
+        'NGINX_SITES_AVAILABLE': os.path.join(workdir, 'nginx', 'sites-available'),
+        'NGINX_SITES_ENABLED': os.path.join(workdir, 'nginx', 'sites-enabled'),
+        'YC_KMS_API_URL': kms.url,
+        'YC_KMS_CRYPTO_URL': kms.url,
+        'YC_FOLDER_ID': 'benchmark',
+        'YC_IAM_TOKEN': 'benchmark',
+        'FAKE_DOCKER_STATE': os.path.join(workdir, 'docker'),
+        'FAKE_DOCKER_BUILD_DELAY': str(args.build_delay),
+        'FAKE_DOCKER_UP_DELAY': str(args.up_delay),
+    })
+    for name in ('NGINX_SITES_AVAILABLE', 'NGINX_SITES_ENABLED'):
+        os.makedirs(os.environ[name], exist_ok=True)
+    sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, 'app')]
+
+
+def project_config(user_id):
+    """
+    JSON config of a benchmark project
+
+    The sections satisfy the required variables check, only the top-level variables
+    are converted to the environment of the project.
+    """
+    sections = {
+        'SETTINGS': {'DJANGO_SETTINGS_MODULE': SETTINGS_MODULE, 'SECRET_KEY': f'benchmark-secret-{user_id}'},
+        'DB': {'DATABASE_NAME': 'benchmark', 'DATABASE_USER': 'benchmark', 'DATABASE_PASSWORD': 'benchmark'},
+        'ADMIN': {'ADMIN_USERNAME': 'admin', 'ADMIN_EMAIL': 'admin@localhost', 'ADMIN_PASSWORD': 'admin'},
+    }
+    variables = {key: value for section in sections.values() for key, value in section.items()}
+    return json.dumps(dict(sections, **variables))
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(durations, wall):
+    """
+    Latency percentiles and throughput of a set of durations
+
+    :param durations: Durations of the executions (in seconds)
+    :param wall: Wall time of the wave the executions belong to (in seconds)
+    """
+    values = sorted(durations)
+    summary = {'count': len(values), 'throughput': round(len(values) / wall, 3) if wall else None}
+    if values:
+        summary['mean'] = round(sum(values) / len(values), 4)
+        summary.update({f'p{percent}': round(percentile(values, percent), 4) for percent in PERCENTILES})
+        summary['max'] = round(values[-1], 4)
+    return summary
+
+
+def run_action(manager, action, kwargs):
+    """
+    Executing an action of a single deployment and collecting its phases
+    """
+    from deploy.metrics import Trace
+
+    started = time.monotonic()
+    error = None
+    with Trace() as trace:
+        try:
+            result = getattr(manager, action)(**kwargs)
+            if action != 'stop' and not result:
+                error = 'the action reported a failure'
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            logging.debug(traceback.format_exc())
+    return {'duration': time.monotonic() - started, 'spans': trace.spans, 'error': error}
+
+
+def run_wave(manager, action, projects):
+    """
+    Executing an action of all projects concurrently
+
+    :return: Report of the wave
+    :rtype: dict
+    """
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(projects)) as executor:
+        samples = list(executor.map(lambda kwargs: run_action(manager, action, kwargs), projects))
+    wall = time.monotonic() - started
+
+    phases = {}
+    for sample in samples:
+        for name, duration in sample['spans']:
+            phases.setdefault(name, []).append(duration)
+    errors = [sample['error'] for sample in samples if sample['error']]
+    return {
+        'action': action,
+        'wall': round(wall, 4),
+        'errors': len(errors),
+        'error_messages': sorted(set(errors))[:5],
+        'latency': summarize([sample['duration'] for sample in samples if not sample['error']], wall),
+        'phases': {name: summarize(durations, wall) for name, durations in sorted(phases.items())},
+    }
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='deploy-bench-')
+    kms = StubKMS(latency=args.kms_latency).start()
+    configure_environment(args, workdir, kms)
+
+    from app.deploy.container.images import image_warmer
+    from app.deploy.container.orchestrator import orchestrator
+    from deploy.container.manager import DjangoManager
+    from deploy.metrics import scan_cache_evictions, scan_cache_lookups
+
+    # Like the API startup: the base images are pulled before the first deployment
+    orchestrator.run(image_warmer.warm())
+
+    report = {
+        'meta': {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'options': {key: value for key, value in vars(args).items() if key not in ('workdir', 'output')},
+        },
+        'scenarios': [],
+    }
+    user_id = 0
+    try:
+        for files in args.files:
+            url = make_repo(os.path.join(workdir, 'repos', f'bench-{files}.git'), files)
+            for concurrency in args.concurrency:
+                for round_number in range(args.rounds):
+                    projects = []
+                    for _ in range(concurrency):
+                        user_id += 1
+                        projects.append({'config': project_config(user_id), 'ext': 'json', 'id': user_id,
+                                         'name': f'bench{user_id}', 'repo_url': url})
+                    for action in args.actions:
+                        wave = run_wave(DjangoManager, action, projects)
+                        wave.update({'files': files, 'concurrency': concurrency, 'round': round_number})
+                        report['scenarios'].append(wave)
+                        print(f"files={files} concurrency={concurrency} {action}: "
+                              f"p50={wave['latency'].get('p50')}s errors={wave['errors']}", file=sys.stderr)
+    finally:
+        report['kms_requests'] = kms.requests
+        report['scan_cache'] = {'hits': scan_cache_lookups.value(result='hit'),
+                                'misses': scan_cache_lookups.value(result='miss'),
+                                'evictions': scan_cache_evictions.value()}
+        report['images'] = image_warmer.status()
+        kms.stop()
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    content = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(content + '\n')
+    else:
+        print(content)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import base64
+import json
+import os
+import threading
+import time
+import urllib.parse
+import uuid
+
+
+class StubKMS:
+    """
+    In-process stand-in for the Yandex Cloud KMS API
+
+    Serves the key management (list, create, rotate) and the data encryption endpoints
+    (encrypt, decrypt, generateDataKey) used by ConfigStorage. Data keys are "wrapped"
+    by a reversible XOR, every request is delayed by the configured latency.
+    """
+
+    def __init__(self, latency=0.0, page_size=100):
+        """
+        :param latency: Delay of every request (in seconds)
+        :param page_size: Max number of keys returned per page of the key list
+        """
+        self.latency = latency
+        self.page_size = page_size
+        self.keys = []
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def wrap(data):
+        return bytes(byte ^ 0x5a for byte in data)
+
+    def list_keys(self, query):
+        start = int(query.get('pageToken', ['0'])[0] or 0)
+        size = min(int(query.get('pageSize', [self.page_size])[0]), self.page_size)
+        with self._lock:
+            keys = self.keys[start:start + size]
+            next_token = str(start + size) if start + size < len(self.keys) else ''
+        return {'keys': keys, 'nextPageToken': next_token}
+
+    def create_key(self, body):
+        key_id = uuid.uuid4().hex[:20]
+        key = {'id': key_id, 'folderId': body.get('folderId'), 'name': body.get('name'),
+               'description': body.get('description'),
+               'primaryVersion': {'id': uuid.uuid4().hex[:20], 'keyId': key_id}}
+        with self._lock:
+            self.keys.append(key)
+        return key
+
+    def crypto(self, operation, body):
+        if operation == 'generateDataKey':
+            key = os.urandom(32)
+            return {'dataKeyPlaintext': base64.b64encode(key).decode(),
+                    'dataKeyCiphertext': base64.b64encode(self.wrap(key)).decode()}
+        if operation == 'encrypt':
+            return {'ciphertext': base64.b64encode(self.wrap(base64.b64decode(body['plaintext']))).decode()}
+        if operation == 'decrypt':
+            return {'plaintext': base64.b64encode(self.wrap(base64.b64decode(body['ciphertext']))).decode()}
+        return {}
+
+    def _handler(self):
+        kms = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                self.respond(kms.list_keys(urllib.parse.parse_qs(url.query)))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                path = urllib.parse.urlparse(self.path).path
+                if ':' in path:
+                    self.respond(kms.crypto(path.rsplit(':', 1)[1], body))
+                else:
+                    self.respond(kms.create_key(body))
+
+            def respond(self, body):
+                with kms._lock:
+                    kms.requests += 1
+                time.sleep(kms.latency)
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
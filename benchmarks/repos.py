@@ -0,0 +1,64 @@
+import os
+import subprocess
+
+SETTINGS_MODULE = 'benchproject.settings'
+
+TEMPLATE_FILES = {
+    'manage.py': "import os\nimport sys\n\n"
+                 "if __name__ == '__main__':\n"
+                 "    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchproject.settings')\n"
+                 "    print(sys.argv)\n",
+    'requirements.txt': 'Django==4.2\n',
+    'benchproject/__init__.py': '',
+    'benchproject/settings.py': "ALLOWED_HOSTS = []\n"
+                                "CSRF_TRUSTED_ORIGINS = []\n"
+                                "STATIC_URL = '/static/'\n"
+                                "MEDIA_URL = '/media/'\n",
+    'benchproject/wsgi.py': "application = None\n",
+}
+MODULES_PER_PACKAGE = 500
+
+
+def module_source(number):
+    return (f"def handler_{number}(request):\n"
+            f"    values = [item * {number} for item in range(10)]\n"
+            f"    return sum(values) + len(request)\n")
+
+
+def iter_files(count):
+    """
+    Paths and contents of a Django-like project with the given number of files
+    """
+    for path, content in TEMPLATE_FILES.items():
+        yield path, content
+    for number in range(max(0, count - len(TEMPLATE_FILES))):
+        package = f'app{number // MODULES_PER_PACKAGE:03d}'
+        yield f'{package}/module_{number:05d}.py', module_source(number)
+
+
+def make_repo(path, files):
+    """
+    Creating a local bare repository with a single commit
+
+    The commit is written by git fast-import, so repositories with tens of thousands
+    of files are generated in seconds.
+
+    :param path: Path to the bare repository, reused if it already exists
+    :param files: Number of files in the repository
+    :return: file:// URL of the repository
+    """
+    url = f'file://{os.path.abspath(path)}'
+    if os.path.isdir(path):
+        return url
+
+    subprocess.run(['git', 'init', '--quiet', '--bare', path], check=True)
+    subprocess.run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=path, check=True)
+
+    chunks = [b'commit refs/heads/master\n',
+              b'committer Benchmark <benchmark@localhost> 0 +0000\n',
+              b'data 9\nbenchmark\n']
+    for file_path, content in iter_files(files):
+        data = content.encode()
+        chunks.append(b'M 644 inline %s\ndata %d\n%s\n' % (file_path.encode(), len(data), data))
+    subprocess.run(['git', 'fast-import', '--quiet'], cwd=path, input=b''.join(chunks), check=True)
+    return url
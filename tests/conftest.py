@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The deploy package is imported both as app.deploy and as deploy, like in the API process
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, 'app')]
+# The deploy settings are read on import, state files of the tests are kept in a temporary dir
+os.environ.setdefault('CONFIG_DIR', tempfile.mkdtemp(prefix='deploy-tests-'))
@@ -0,0 +1,44 @@
+from app.deploy.container.cache import ScanCache, blob_hash
+from deploy.metrics import scan_cache_evictions, scan_cache_lookups
+import subprocess
+import time
+
+
+def test_blob_hash_matches_git(tmp_path):
+    path = tmp_path / 'module.py'
+    path.write_bytes(b'print("hello")\n')
+    expected = subprocess.run(['git', 'hash-object', str(path)], capture_output=True, text=True).stdout.strip()
+
+    assert blob_hash(str(path)) == expected
+
+
+def test_lookup_and_eviction(tmp_path):
+    cache = ScanCache('LOW', 'LOW', path=str(tmp_path / 'cache.sqlite3'), max_entries=2)
+    hits, misses = scan_cache_lookups.value(result='hit'), scan_cache_lookups.value(result='miss')
+    evictions = scan_cache_evictions.value()
+    try:
+        cache.store({'a': [], 'b': [{'test_id': 'B101'}]})
+        time.sleep(0.01)
+        assert cache.lookup(['a', 'x']) == {'a': []}  # 'a' becomes the most recently used entry
+        time.sleep(0.01)
+        cache.store({'c': []})
+
+        assert cache.lookup(['a', 'b', 'c']) == {'a': [], 'c': []}
+        assert scan_cache_lookups.value(result='hit') - hits == 3
+        assert scan_cache_lookups.value(result='miss') - misses == 2
+        assert scan_cache_evictions.value() - evictions == 1
+    finally:
+        cache.close()
+
+
+def test_results_are_kept_per_profile(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    low, high = ScanCache('LOW', 'LOW', path=path), ScanCache('HIGH', 'HIGH', path=path)
+    try:
+        low.store({'a': [{'test_id': 'B101'}]})
+
+        assert low.lookup(['a']) == {'a': [{'test_id': 'B101'}]}
+        assert high.lookup(['a']) == {}
+    finally:
+        low.close()
+        high.close()
@@ -0,0 +1,35 @@
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from deploy.container.exceptions import DecryptionError
+from deploy.security.encrypt import ENVELOPE_MAGIC, ENVELOPE_NONCE_SIZE, parse_envelope
+import os
+import pytest
+import struct
+
+
+def envelope(wrapped_key, nonce, ciphertext):
+    return ENVELOPE_MAGIC + struct.pack('>I', len(wrapped_key)) + wrapped_key + nonce + ciphertext
+
+
+def test_legacy_content_is_not_an_envelope():
+    assert parse_envelope(b'legacy KMS ciphertext') is None
+
+
+def test_round_trip():
+    key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(ENVELOPE_NONCE_SIZE)
+    ciphertext = AESGCM(key).encrypt(nonce, b'SECRET_KEY=value', b'1/project')
+
+    wrapped_key, parsed_nonce, parsed_ciphertext = parse_envelope(envelope(b'wrapped-key', nonce, ciphertext))
+
+    assert wrapped_key == b'wrapped-key'
+    assert parsed_nonce == nonce
+    assert AESGCM(key).decrypt(parsed_nonce, parsed_ciphertext, b'1/project') == b'SECRET_KEY=value'
+
+
+@pytest.mark.parametrize('length', [len(ENVELOPE_MAGIC), len(ENVELOPE_MAGIC) + 3, len(ENVELOPE_MAGIC) + 4 + 5,
+                                    len(ENVELOPE_MAGIC) + 4 + 11 + ENVELOPE_NONCE_SIZE - 1])
+def test_truncated_envelope(length):
+    content = envelope(b'wrapped-key', b'n' * ENVELOPE_NONCE_SIZE, b'ciphertext')
+
+    with pytest.raises(DecryptionError):
+        parse_envelope(content[:length])
@@ -0,0 +1,52 @@
+from app.deploy.container.introspect import SettingsEvaluator, Unknown, introspect_settings
+import pytest
+
+
+@pytest.fixture
+def project(tmp_path):
+    package = tmp_path / 'mysite'
+    package.mkdir()
+    (package / '__init__.py').write_text('')
+    (package / 'base.py').write_text(
+        'import os\n'
+        'from pathlib import Path\n'
+        'BASE_DIR = Path(__file__).resolve().parent.parent\n'
+        "STATIC_URL = '/static/'\n"
+        "STATIC_ROOT = BASE_DIR / 'staticfiles'\n"
+    )
+    (package / 'settings.py').write_text(
+        'from .base import *\n'
+        "MEDIA_ROOT = os.path.join(str(BASE_DIR), 'media')\n"
+        "MEDIA_URL = os.getenv('MEDIA_URL', '/uploads/')\n"
+        "SECRET_KEY = os.environ['SECRET_KEY']\n"
+        "ALLOWED_HOSTS = ['localhost'] + ['example.com']\n"
+        'try:\n'
+        "    STATIC_URL = f'{STATIC_URL}v2/'\n"
+        'except ImportError:\n'
+        '    pass\n'
+    )
+    return tmp_path
+
+
+def test_evaluation_follows_star_imports(project):
+    namespace = SettingsEvaluator(str(project)).evaluate(str(project / 'mysite' / 'settings.py'))
+
+    assert str(namespace['STATIC_ROOT']) == '/staticfiles'
+    assert namespace['MEDIA_ROOT'] == '/media'
+    assert namespace['MEDIA_URL'] == '/uploads/'
+    assert namespace['STATIC_URL'] == '/static/v2/'
+    assert namespace['ALLOWED_HOSTS'] == ['localhost', 'example.com']
+    assert namespace['SECRET_KEY'] is Unknown
+
+
+def test_introspect_settings(project):
+    path, settings = introspect_settings(str(project), 'mysite.settings')
+
+    assert path == str(project / 'mysite' / 'settings.py')
+    assert settings == {'STATIC_URL': '/static/v2/', 'STATIC_ROOT': '/staticfiles', 'MEDIA_URL': '/uploads/',
+                        'MEDIA_ROOT': '/media', 'ALLOWED_HOSTS': ['localhost', 'example.com']}
+
+
+def test_missing_settings_module(project):
+    with pytest.raises(ModuleNotFoundError):
+        introspect_settings(str(project), 'mysite.missing')
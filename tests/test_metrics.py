@@ -0,0 +1,45 @@
+from deploy import metrics
+from deploy.metrics import OUTPUT_LINE_LIMIT, OutputLines
+import pytest
+
+
+@pytest.fixture
+def lines(monkeypatch):
+    received = []
+    monkeypatch.setattr(metrics, '_output_listeners', [received.append])
+    return received
+
+
+def test_lines_split_across_chunks(lines):
+    output = OutputLines()
+    for chunk in (b'first li', b'ne\r\nsecond\nthi', b'rd', b''):
+        output.feed(chunk)
+
+    assert lines == ['first line', 'second', 'third']
+
+
+def test_multibyte_characters_split_across_chunks(lines):
+    output = OutputLines()
+    data = 'Шаг сборки\n'.encode()
+    for chunk in (data[:1], data[1:], b''):
+        output.feed(chunk)
+
+    assert lines == ['Шаг сборки']
+
+
+def test_long_lines_are_split(lines):
+    output = OutputLines()
+    output.feed(b'x' * (OUTPUT_LINE_LIMIT * 2 + 10) + b'\n')
+    output.feed(b'')
+
+    assert [len(line) for line in lines] == [OUTPUT_LINE_LIMIT, OUTPUT_LINE_LIMIT, 10]
+
+
+def test_counter_values():
+    counter = metrics.Counter('test_total', 'Test counter')
+    counter.inc(2, result='hit')
+    counter.inc(result='hit')
+
+    assert counter.value(result='hit') == 3
+    assert counter.value(result='miss') == 0
+    assert 'test_total{result="hit"} 3' in counter.render()
@@ -0,0 +1,47 @@
+from app.deploy.container.ports import PortAllocator
+import pytest
+
+
+@pytest.fixture
+def allocator(tmp_path, monkeypatch):
+    monkeypatch.setattr(PortAllocator, 'is_taken', staticmethod(lambda port: False))
+    return PortAllocator(str(tmp_path / 'ports.json'), {'APP_PORT': 8000, 'REDIS_PORT': 6379})
+
+
+def test_reserve_is_unique_and_repeatable(allocator):
+    first = allocator.reserve('a')
+    second = allocator.reserve('b')
+
+    assert first == {'APP_PORT': '8000', 'REDIS_PORT': '6379'}
+    assert second == {'APP_PORT': '8001', 'REDIS_PORT': '6380'}
+    assert allocator.reserve('a') == first
+
+
+def test_reserve_named_ranges(allocator):
+    assert allocator.reserve('a', names=['REDIS_PORT']) == {'REDIS_PORT': '6379'}
+    assert allocator.held('a') == {'REDIS_PORT': '6379'}
+
+
+def test_released_ports_are_reused_lowest_first(allocator):
+    for owner in ('a', 'b', 'c'):
+        allocator.reserve(owner, names=['APP_PORT'])
+    allocator.release('c')
+    allocator.release('a')
+
+    assert allocator.reserve('d', names=['APP_PORT']) == {'APP_PORT': '8000'}
+    assert allocator.reserve('e', names=['APP_PORT']) == {'APP_PORT': '8002'}
+    assert allocator.reserve('f', names=['APP_PORT']) == {'APP_PORT': '8003'}
+
+
+def test_held_does_not_allocate(allocator):
+    assert allocator.held('unknown') == {}
+    assert allocator.reserve('a', names=['APP_PORT']) == {'APP_PORT': '8000'}
+
+
+def test_busy_ports_are_skipped_and_kept(allocator, monkeypatch):
+    busy = {8000}
+    monkeypatch.setattr(PortAllocator, 'is_taken', staticmethod(lambda port: port in busy))
+
+    assert allocator.reserve('a', names=['APP_PORT']) == {'APP_PORT': '8001'}
+    busy.clear()
+    assert allocator.reserve('b', names=['APP_PORT']) == {'APP_PORT': '8000'}
@@ -0,0 +1,44 @@
+from app.deploy.container.exceptions import TemplateError
+from app.deploy.container.templates import Template, escape_dockerfile, escape_nginx, escape_sql
+import pytest
+
+
+def test_escape_sql():
+    assert escape_sql("it's \\", 'string') == "it''s \\\\"
+    assert escape_sql('db`name', 'identifier') == '`db``name`'
+    with pytest.raises(TemplateError):
+        escape_sql('db\0', 'identifier')
+
+
+def test_escape_nginx():
+    assert escape_nginx('project.example.com', 'partial') == 'project.example.com'
+    assert escape_nginx('a b"c', 'token') == '"a b\\"c"'
+    for value, context in (('a b', 'partial'), ('$host', 'token'), ('a;\nb', 'token'), ('}', 'partial')):
+        with pytest.raises(TemplateError):
+            escape_nginx(value, context)
+
+
+def test_escape_dockerfile():
+    assert escape_dockerfile('app_$HOME\\', None) == 'app_\\$HOME\\\\'
+    with pytest.raises(TemplateError):
+        escape_dockerfile('app\nRUN rm -rf /', None)
+
+
+def test_fields_are_escaped_by_context(tmp_path):
+    path = tmp_path / 'init.sql'
+    path.write_text("CREATE DATABASE {NAME};\nCREATE USER 'u' IDENTIFIED BY '{PASSWORD}';\n")
+
+    rendered = Template(str(path), 'sql').render({'NAME': 'db`x', 'PASSWORD': "p'w"})
+
+    assert rendered == "CREATE DATABASE `db``x`;\nCREATE USER 'u' IDENTIFIED BY 'p''w';\n"
+
+
+def test_nginx_token_and_partial_fields(tmp_path):
+    path = tmp_path / 'site'
+    path.write_text('server_name {SUBDOMAIN}.example.com;\nroot {ROOT};\n')
+    template = Template(str(path), 'nginx')
+
+    assert template.render({'SUBDOMAIN': 'app', 'ROOT': '/srv/my app'}) == \
+        'server_name app.example.com;\nroot "/srv/my app";\n'
+    with pytest.raises(TemplateError):
+        template.render({'SUBDOMAIN': 'app; include /etc/passwd', 'ROOT': '/srv'})